@@ -0,0 +1,98 @@
+"""
+Memory held per open chat websocket connection, measured with tracemalloc.
+
+Opens N connections (N / 2 rooms with two users each) through the ASGI application with WebsocketCommunicator
+and reports traced bytes per connection, minus the same measurement for a bare AsyncWebsocketConsumer,
+so the test harness overhead is not counted. Needs the Redis and Mongo configured in settings.
+
+Usage (from the app directory):
+    python -m benchmarks.connection_memory [connections]
+"""
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from channels.generic.websocket import AsyncWebsocketConsumer  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.sessions.backends.cache import SessionStore  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from chat.consumers import ChatConsumer  # noqa: E402
+from chat.models import ChatRoom, create_chat_room  # noqa: E402
+from chat.services.chat_service import ChatService  # noqa: E402
+from config.asgi import application  # noqa: E402
+from config.redis_pool import get_redis  # noqa: E402
+
+
+class BareConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        await self.accept()
+
+
+async def open_connections(application, room_ids, session_keys):
+    communicators = []
+    for room_id, session_key in zip(room_ids, session_keys):
+        cookie = f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode()
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{room_id}/', headers=[(b'cookie', cookie)])
+        connected, _ = await communicator.connect(timeout=30)
+        assert connected
+        communicators.append(communicator)
+    await asyncio.sleep(0.1)  # let join events settle
+    return communicators
+
+
+async def measure(application, room_ids, session_keys) -> tuple[float, list]:
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    communicators = await open_connections(application, room_ids, session_keys)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / len(room_ids), communicators
+
+
+async def main(connections: int):
+    rooms = [create_chat_room(topic='memory', my_gender='male', search_gender='female')
+             for _ in range(connections // 2)]
+    room_ids = [str(room.id) for room in rooms for _ in range(2)]
+    session_keys = []
+    for _ in room_ids:
+        session = SessionStore()
+        session.create()
+        session_keys.append(session.session_key)
+
+    tracemalloc.start()
+    bare, bare_communicators = await measure(URLRouter([path('ws/chat/<room_id>/', BareConsumer.as_asgi())]),
+                                             room_ids, session_keys)
+    for communicator in bare_communicators:
+        await communicator.disconnect()
+
+    chat, communicators = await measure(application, room_ids, session_keys)
+    tracemalloc.stop()
+
+    print(f'connections: {connections}')
+    print(f'bare consumer + harness: {bare:,.0f} bytes/connection')
+    print(f'ChatConsumer + harness:  {chat:,.0f} bytes/connection')
+    print(f'ChatConsumer state:      {chat - bare:,.0f} bytes/connection')
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    for timer in ChatConsumer.deletion_timers.values():
+        timer.cancel()
+    redis = await get_redis()
+    for room in rooms:
+        await ChatService(redis=redis, room_id=str(room.id), session_id='system').delete_redis_data()
+    ChatRoom.objects.filter(topic='memory').delete()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,52 @@
+"""
+Content filter throughput on one core with a large terms list.
+
+Usage (from the app directory):
+    python -m benchmarks.content_filter [terms] [messages]
+"""
+import random
+import sys
+import time
+
+from chat.content_filter import ContentFilter
+
+ALPHABETS = {
+    'en': 'abcdefghijklmnopqrstuvwxyz',
+    'bg': 'абвгдежзийклмнопрстуфхцчшщъьюя',
+    'ru': 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя',
+}
+
+
+def random_word(rng, alphabet, min_length=3, max_length=10):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(min_length, max_length)))
+
+
+def main(terms_count=30000, messages_count=20000):
+    rng = random.Random(42)
+    alphabets = list(ALPHABETS.values())
+    terms = [random_word(rng, rng.choice(alphabets), 4, 12) for _ in range(terms_count)]
+    terms += [f'{random_word(rng, ALPHABETS["en"])}.com' for _ in range(terms_count // 10)]
+
+    started = time.perf_counter()
+    content_filter = ContentFilter(terms)
+    build_time = time.perf_counter() - started
+
+    messages = []
+    for _ in range(messages_count):
+        words = [random_word(rng, rng.choice(alphabets)) for _ in range(rng.randint(3, 30))]
+        if rng.random() < 0.1:
+            words[rng.randrange(len(words))] = rng.choice(terms).upper()
+        messages.append(' '.join(words))
+    total_chars = sum(map(len, messages))
+
+    started = time.perf_counter()
+    censored = sum(content_filter.censor(message) != message for message in messages)
+    elapsed = time.perf_counter() - started
+
+    print(f'terms: {len(terms)}, automaton nodes: {len(content_filter)}, build: {build_time:.2f}s')
+    print(f'messages: {messages_count}, avg length: {total_chars / messages_count:.0f} chars, censored: {censored}')
+    print(f'{messages_count / elapsed:,.0f} messages/sec per core, {elapsed / messages_count * 1e6:.1f} us/message')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
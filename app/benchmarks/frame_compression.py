@@ -0,0 +1,126 @@
+"""
+Bandwidth and CPU of permessage-deflate for chat frames, as config.server negotiates it.
+
+Compresses typical outbound frames with autobahn's PerMessageDeflate (no context takeover, window bits and
+memLevel from settings), reports bytes saved and microseconds per frame, the traffic of a typical frame mix
+without compression / compressing everything / compressing above the threshold, and the zlib memory a
+connection keeps after its first compressed frame.
+
+Usage (from the app directory):
+    python -m benchmarks.frame_compression [frames]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from autobahn.websocket.compress import PerMessageDeflate  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from chat import frames  # noqa: E402
+
+WORDS = (
+    'hi hello how are you today what do you do I am from Sofia and you lol really nice to meet you '
+    'здравей как си какво правиш аз съм от Пловдив а ти хаха наистина приятно ми е мерси добре '
+    'привет как дела что делаешь я из Варны а ты ахах правда очень приятно спасибо хорошо'
+).split()
+
+ROOM_ID = '6ad6517dac9c4b94e9b28157'
+SESSION_ID = 'x3k9v2m8q1w7e5r4t6y0u2i8o3p9a1s7'
+
+
+def chat_frame(rng, length, seq):
+    words = []
+    while sum(map(len, words)) + len(words) < length:
+        words.append(rng.choice(WORDS))
+    message = ' '.join(words)[:length]
+    return frames.encode({'message': message, 'session_id': SESSION_ID, 'room_id': ROOM_ID, 'seq': seq}).encode()
+
+
+def make_deflate(window_bits, mem_level):
+    return PerMessageDeflate(True, True, True, window_bits, window_bits, mem_level)
+
+
+def compress(deflate, payload):
+    deflate.start_compress_message()
+    return deflate.compress_message_data(payload) + deflate.end_compress_message()
+
+
+def decompress(deflate, payload):
+    deflate.start_decompress_message()
+    data = deflate.decompress_message_data(payload)
+    deflate.end_decompress_message()
+    return data
+
+
+def per_frame(payloads, func):
+    started = time.perf_counter()
+    for frame in payloads:
+        func(frame)
+    return (time.perf_counter() - started) / len(payloads) * 1e6
+
+
+def retained_memory(window_bits, mem_level):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    deflate = make_deflate(window_bits, mem_level)
+    compressed = compress(deflate, b'x' * 1024)
+    decompress(deflate, compressed)
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return retained
+
+
+def main(frames_count=20000):
+    rng = random.Random(42)
+    window_bits = settings.CHAT_WS_COMPRESSION_WINDOW_BITS
+    mem_level = settings.CHAT_WS_COMPRESSION_MEM_LEVEL
+    threshold = settings.CHAT_WS_COMPRESSION_THRESHOLD
+    deflate = make_deflate(window_bits, mem_level)
+
+    kinds = {
+        'typing': [frames.encode({'type': 'typing', 'message': 'typing...'}).encode()] * frames_count,
+        'ack': [frames.encode({'type': 'ack', 'client_id': f'{i:032x}', 'seq': i}).encode() for i in range(frames_count)],
+        'message 40': [chat_frame(rng, 40, i) for i in range(frames_count)],
+        'message 300': [chat_frame(rng, 300, i) for i in range(frames_count)],
+        'message 1500': [chat_frame(rng, 1500, i) for i in range(frames_count)],
+    }
+
+    print(f'window bits {window_bits}, memLevel {mem_level}, threshold {threshold} bytes')
+    print(f'{"frame":<14}{"bytes":>8}{"deflated":>10}{"saved":>8}{"compress us":>13}{"inflate us":>12}')
+    for name, payloads in kinds.items():
+        compressed = [compress(deflate, frame) for frame in payloads]
+        raw_size = sum(map(len, payloads)) / len(payloads)
+        compressed_size = sum(map(len, compressed)) / len(payloads)
+        compress_us = per_frame(payloads, lambda frame: compress(deflate, frame))
+        inflate_us = per_frame(compressed, lambda frame: decompress(deflate, frame))
+        print(f'{name:<14}{raw_size:>8.0f}{compressed_size:>10.0f}{1 - compressed_size / raw_size:>8.0%}'
+              f'{compress_us:>13.1f}{inflate_us:>12.1f}')
+
+    # Typical room traffic: every message comes with two typing frames and an ack
+    mix = (kinds['typing'] * 2 + kinds['ack'] + kinds['message 40'][:frames_count * 6 // 10]
+           + kinds['message 300'][:frames_count * 3 // 10] + kinds['message 1500'][:frames_count // 10])
+    strategies = {
+        'uncompressed': lambda frame: frame,
+        'all frames': lambda frame: compress(deflate, frame),
+        f'>= {threshold} bytes': lambda frame: compress(deflate, frame) if len(frame) >= threshold else frame,
+    }
+    print(f'\nframe mix of {len(mix)} frames:')
+    for name, send in strategies.items():
+        started = time.perf_counter()
+        sent = sum(len(send(frame)) for frame in mix)
+        elapsed = time.perf_counter() - started
+        print(f'{name:<18}{sent / 1024:>10.0f} KB{elapsed / len(mix) * 1e6:>8.2f} us/frame')
+
+    print(f'\nzlib state kept per connection: {retained_memory(window_bits, mem_level) / 1024:.0f} KB '
+          f'(window bits 15, memLevel 8: {retained_memory(15, 8) / 1024:.0f} KB)')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""
+CPU per delivered chat message: payload encoded by every recipient vs frame encoded once by the sender.
+
+Runs the work a message goes through between receive() of the sender and the OutboundQueue of each
+recipient: building the channel layer event, the layer's msgpack + encryption and its reverse per
+recipient channel, and the recipient handler. Channel layer config comes from settings, no Redis needed.
+Measured with and without the layer's symmetric encryption, which costs far more than the JSON encoding.
+
+Usage (from the app directory):
+    python -m benchmarks.frame_serialization [messages] [recipients]
+"""
+import json
+import os
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from channels_redis.core import RedisChannelLayer  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from chat import frames  # noqa: E402
+
+ROOM_ID = '6ad6517dac9c4b94e9b28157'
+SESSION_ID = 'x3k9v2m8q1w7e5r4t6y0u2i8o3p9a1s7'
+MESSAGE = 'здравей, как си? аз съм от Пловдив, а ти? hello from Sofia too'
+
+
+def per_recipient(event):
+    """Previous handler: rebuilds the payload and encodes it for its own connection"""
+    return json.dumps({
+        'message': event['message'],
+        'session_id': event['session_id'],
+        'room_id': event['room_id'],
+        'seq': event.get('seq')
+    })
+
+
+def old_path(layer, recipients, seq):
+    event = {'type': 'chat_message', 'message': MESSAGE, 'session_id': SESSION_ID, 'room_id': ROOM_ID, 'seq': seq}
+    serialized = layer.serialize(event)
+    return [per_recipient(layer.deserialize(serialized)) for _ in range(recipients)]
+
+
+def new_path(layer, recipients, seq):
+    serialized = layer.serialize(frames.chat_message(MESSAGE, SESSION_ID, ROOM_ID, seq))
+    return [layer.deserialize(serialized)['frame'] for _ in range(recipients)]
+
+
+def main(messages=50000, recipients=2):
+    config = settings.CHANNEL_LAYERS['default']['CONFIG']
+    layers = {
+        'encrypted layer': RedisChannelLayer(**config),
+        'unencrypted layer': RedisChannelLayer(**{**config, 'symmetric_encryption_keys': None}),
+    }
+
+    for layer_name, layer in layers.items():
+        print(f'{layer_name}, {recipients} recipients:')
+        for name, path in (('encode per recipient', old_path), ('encode once', new_path)):
+            sent = path(layer, recipients, 1)
+            started = time.perf_counter()
+            for seq in range(messages):
+                path(layer, recipients, seq)
+            elapsed = time.perf_counter() - started
+            deliveries = messages * recipients
+            print(f'  {name:<22}{elapsed / deliveries * 1e6:>7.2f} us/delivery  '
+                  f'{deliveries / elapsed:>10,.0f} deliveries/sec  frame {len(sent[0].encode())} bytes')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,88 @@
+"""
+Index and room page throughput: full template render (the views before page shells) vs cached shell.
+
+"render" and "shell" time only the page body work of the view on a prepared request, "request" is the
+whole current view through the middleware stack with the test client. Needs the Redis and Mongo configured
+in settings.
+
+Usage (from the app directory):
+    python -m benchmarks.page_render [requests]
+"""
+import os
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import AnonymousUser  # noqa: E402
+from django.contrib.sessions.backends.cache import SessionStore  # noqa: E402
+from django.shortcuts import render  # noqa: E402
+from django.test import Client, RequestFactory  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils import translation  # noqa: E402
+
+from chat.models import ChatRoom, create_chat_room  # noqa: E402
+from chat.shells import index_shell, room_shell  # noqa: E402
+
+FILTER_DATA = {'topic': 'chat', 'my_gender': 'male', 'search_gender': 'female'}
+
+
+def rate(requests_count, func):
+    func()
+    started = time.perf_counter()
+    for _ in range(requests_count):
+        func()
+    return requests_count / (time.perf_counter() - started)
+
+
+def main(requests_count=2000):
+    translation.activate('en')
+    room = create_chat_room(**FILTER_DATA)
+    room_id = str(room.id)
+
+    request = RequestFactory().get('/chat/')
+    request.user = AnonymousUser()
+    request.session = SessionStore()
+    request.session['filter_data'] = FILTER_DATA
+    request.session.save()
+
+    pages = {
+        'index': (
+            lambda: render(request, 'index.html', {'users_in_chat': ChatRoom.active.count()}),
+            lambda: index_shell.response(request, path=request.path),
+            reverse('index'),
+        ),
+        'room': (
+            lambda: render(request, 'room.html', {
+                'room_id': room_id,
+                'session_key': request.session.session_key,
+                'filter_data': request.session.get('filter_data'),
+                'heartbeat_interval': settings.CHAT_HEARTBEAT_INTERVAL,
+            }),
+            lambda: room_shell.response(
+                request, room_id=room_id, session_key=request.session.session_key,
+                heartbeat_interval=settings.CHAT_HEARTBEAT_INTERVAL, **FILTER_DATA,
+            ),
+            reverse('room', args=[room_id]),
+        ),
+    }
+
+    client = Client()
+    try:
+        for name, (full_render, shell_render, url) in pages.items():
+            render_rate = rate(requests_count, full_render)
+            shell_rate = rate(requests_count, shell_render)
+            request_rate = rate(requests_count, lambda: client.get(url))
+            print(f'{name}: render {render_rate:,.0f} req/s, shell {shell_rate:,.0f} req/s '
+                  f'({shell_rate / render_rate:.1f}x), request {request_rate:,.0f} req/s')
+    finally:
+        room.delete()
+        request.session.delete()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
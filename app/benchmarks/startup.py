@@ -0,0 +1,66 @@
+"""
+Worker startup cost: imports of the ASGI application in a fresh interpreter, measured with python -X importtime.
+
+Reports the total import time, the slowest top-level imports and whether a Mongo client was opened while
+starting. The chat tests keep the total under IMPORT_BUDGET.
+
+Usage (from the app directory):
+    python -m benchmarks.startup [module] [top]
+"""
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+# Seconds config.asgi may take to import (with -X importtime overhead)
+IMPORT_BUDGET = 1.5
+
+Startup = namedtuple('Startup', 'import_time wall_time modules mongo_connected')
+
+SCRIPT = '''
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import {module}
+from config import mongo
+print(mongo.is_connected())
+'''
+
+
+def measure(module='config.asgi'):
+    """Imports module in a new interpreter, returns total import seconds and cumulative seconds per module"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT.format(module=module)],
+        capture_output=True, text=True, check=True, cwd=APP_DIR, env=os.environ.copy(),
+    )
+    wall_time = time.perf_counter() - started
+
+    modules = {}
+    import_time = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        seconds = int(cumulative) / 1e6
+        modules[name.strip()] = seconds
+        # Top-level imports aren't indented, nested ones are already counted in their cumulative time
+        if not name.startswith('  '):
+            import_time += seconds
+
+    return Startup(import_time, wall_time, modules, result.stdout.strip() == 'True')
+
+
+def main(module='config.asgi', top=15):
+    startup = measure(module)
+    print(f'{module}: imports {startup.import_time:.3f}s (budget {IMPORT_BUDGET}s), '
+          f'process {startup.wall_time:.3f}s, mongo connected: {startup.mongo_connected}')
+    for name, seconds in sorted(startup.modules.items(), key=lambda item: item[1], reverse=True)[:int(top)]:
+        print(f'{seconds:8.3f}s  {name}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,62 @@
+"""
+Overhead of chat.tracing on traced calls, with tracing disabled (the default) and enabled.
+
+Times an empty coroutine undecorated and traced, and a RedisService call (one GET against REDIS_URL)
+undecorated and traced, so the overhead can be compared to the cheapest real operation it wraps.
+
+Usage (from the app directory):
+    python -m benchmarks.tracing_overhead [calls]
+"""
+import asyncio
+import os
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from chat.services.redis_service import RedisService  # noqa: E402
+from chat.tracing import traced, tracer  # noqa: E402
+from config.redis_pool import get_redis  # noqa: E402
+
+
+async def noop():
+    pass
+
+
+async def per_call(func, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await func()
+    return (time.perf_counter() - started) / calls * 1e9
+
+
+async def run(calls):
+    service = RedisService(await get_redis(), 'benchmark', 'benchmark')
+    get_users_count = RedisService.get_users_count.__wrapped__
+    cases = {
+        'empty coroutine': (noop, traced('noop')(noop), calls),
+        'redis GET': (lambda: get_users_count(service), service.get_users_count, max(calls // 50, 100)),
+    }
+
+    for name, (plain, wrapped, count) in cases.items():
+        tracer.disable()
+        await per_call(plain, count // 10)  # warm up
+        baseline = await per_call(plain, count)
+        disabled = await per_call(wrapped, count)
+        tracer.enable(3600)
+        enabled = await per_call(wrapped, count)
+        tracer.disable()
+        tracer.reset()
+        print(f'{name:<17} plain {baseline:>9,.0f} ns   tracing off {disabled:>9,.0f} ns '
+              f'({disabled - baseline:+,.0f})   tracing on {enabled:>9,.0f} ns ({enabled - baseline:+,.0f})')
+
+
+def main(calls=200000):
+    asyncio.run(run(calls))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
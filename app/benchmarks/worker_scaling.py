@@ -0,0 +1,125 @@
+"""
+Websocket throughput of the runworkers command by number of worker processes.
+
+For every worker count starts `manage.py runworkers` on a free port, opens lobby websocket connections
+from load generator processes (one per CPU) and has each connection send ping frames back to back, every
+pong answering the previous ping, for the given seconds. Reports pongs per second and the speedup over one
+worker. Lobby pings touch neither Mongo nor Redis, this measures the websocket and consumer work the
+workers share out. Needs REDIS_URL (worker metrics) and a multi-core machine to show any scaling.
+
+Usage (from the app directory):
+    python -m benchmarks.worker_scaling [max workers] [connections] [seconds]
+"""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol, connectWS  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django_redis import get_redis_connection  # noqa: E402
+
+from config.supervisor import METRICS_KEY  # noqa: E402
+
+PING = json.dumps({'action': 'ping'}).encode()
+
+
+class PingClient(WebSocketClientProtocol):
+
+    def onOpen(self):
+        self.sendMessage(PING)
+
+    def onMessage(self, payload, isBinary):
+        if self.factory.counting and not self.factory.stopped:
+            self.factory.pongs += 1
+        if not self.factory.stopped:
+            self.sendMessage(PING)
+
+
+def load_process(port, connections, seconds, results):
+    from twisted.internet import reactor
+
+    factory = WebSocketClientFactory(f'ws://127.0.0.1:{port}/ws/lobby/')
+    factory.protocol = PingClient
+    factory.pongs = 0
+    factory.counting = False
+    factory.stopped = False
+    for _ in range(connections):
+        connectWS(factory)
+
+    def stop():
+        factory.stopped = True
+        results.put(factory.pongs)
+        reactor.stop()
+
+    reactor.callLater(1, setattr, factory, 'counting', True)  # after a warm up
+    reactor.callLater(1 + seconds, stop)
+    reactor.run()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_workers(workers, port):
+    redis = get_redis_connection('default')
+    redis.delete(METRICS_KEY)
+    supervisor = subprocess.Popen(
+        [sys.executable, 'manage.py', 'runworkers', '--workers', str(workers), '--port', str(port), '--', '-v', '0'],
+        cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        data = redis.get(METRICS_KEY)
+        if data and all(worker['alive'] for worker in json.loads(data)['workers'].values()):
+            time.sleep(settings.CHAT_WORKER_REPORT_INTERVAL)  # all reported once at least
+            return supervisor
+        time.sleep(0.2)
+    supervisor.kill()
+    raise RuntimeError('Workers did not start')
+
+
+def measure(workers, connections, seconds, generators):
+    port = free_port()
+    supervisor = start_workers(workers, port)
+    try:
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=load_process, args=(port, connections // generators, seconds, results))
+            for _ in range(generators)
+        ]
+        for process in processes:
+            process.start()
+        pongs = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return pongs / seconds
+    finally:
+        supervisor.send_signal(signal.SIGTERM)
+        supervisor.wait()
+
+
+def main(max_workers=os.cpu_count() or 1, connections=256, seconds=5):
+    generators = os.cpu_count() or 1
+    counts = sorted({1, *(2 ** i for i in range(1, max_workers.bit_length())), max_workers})
+    print(f'{os.cpu_count()} CPUs, {connections} connections, {generators} load generator processes')
+    baseline = None
+    for workers in counts:
+        rate = measure(workers, connections, seconds, generators)
+        baseline = baseline or rate
+        print(f'{workers:>3} workers {rate:>12,.0f} pongs/sec {rate / baseline:>6.2f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,26 @@
+import json
+from datetime import datetime, timezone
+
+from django_redis import get_redis_connection
+
+PENDING_KEY = 'stats:pending'
+
+ROOM_CREATED = 'room_created'
+ROOM_JOINED = 'room_joined'
+ROOM_DELETED = 'room_deleted'
+MESSAGE_SAVED = 'message_saved'
+
+
+def rollup_field(event: str, room, hour: datetime = None) -> str:
+    hour = (hour or datetime.now(timezone.utc)).strftime('%Y-%m-%dT%H')
+    # JSON, user entered topics may contain any separator
+    return json.dumps([hour, event, room.topic, f'{room.creator_gender}>{room.search_gender}'])
+
+
+def record(event: str, room, amount: int = 1):
+    """
+    Counts a room event per hour, topic and gender bucket.
+    Counters are flushed into the Mongo stats collection by the flush_stats command,
+    so analytics never aggregate over rooms and messages.
+    """
+    get_redis_connection('default').hincrby(PENDING_KEY, rollup_field(event, room), amount)
@@ -0,0 +1,113 @@
+"""
+Per-session ban list.
+
+Bans live in a Redis hash (session id -> expiry unix time, 0 for permanent) with a version counter bumped by
+every change. Each worker keeps the whole list in memory, so ChatConsumer.connect checks it without a round
+trip. The list is loaded on the first connection of the worker, then a background task checks the version
+every CHAT_BAN_LIST_REFRESH_INTERVAL seconds, reloads the list when it changed and closes the connections
+of this worker whose session got banned.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+from chat.heartbeat import registry
+from config.redis_pool import get_redis
+
+BANS_KEY = 'banned_sessions'
+VERSION_KEY = 'banned_sessions:version'
+
+BANNED_CLOSE_CODE = 4004
+
+
+def expired(entries: dict, now: float) -> list:
+    """Sessions of the hash entries whose ban ran out"""
+    return [session_id for session_id, expires in entries.items() if 0 < float(expires) <= now]
+
+
+def ban(redis, session_id: str, seconds: int = None):
+    """
+    Bans the session for seconds, permanently if None. Takes the sync client, used by the admin api.
+    Drops the bans that ran out on the way, the hash only holds bans in effect.
+    """
+    if seconds is not None and seconds <= 0:
+        raise ValueError('Ban seconds must be positive')
+    now = time.time()
+    expires = now + seconds if seconds is not None else 0
+    pipe = redis.pipeline()
+    stale = expired(redis.hgetall(BANS_KEY), now)
+    if stale:
+        pipe.hdel(BANS_KEY, *stale)
+    pipe.hset(BANS_KEY, session_id, repr(expires))
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+
+def unban(redis, session_id: str) -> bool:
+    pipe = redis.pipeline()
+    pipe.hdel(BANS_KEY, session_id)
+    pipe.incr(VERSION_KEY)
+    removed, _ = pipe.execute()
+    return bool(removed)
+
+
+def list_bans(redis) -> dict:
+    """Bans in effect, session id -> expiry unix time (0 for permanent)"""
+    now = time.time()
+    bans = {session_id.decode(): float(expires) for session_id, expires in redis.hgetall(BANS_KEY).items()}
+    return {session_id: expires for session_id, expires in bans.items() if not expires or expires > now}
+
+
+class BanList:
+    """In-process copy of the ban list, refreshed from Redis when its version changes."""
+
+    def __init__(self):
+        self.banned = {}
+        self.version = None
+        self.task = None
+
+    def is_banned(self, session_id: str) -> bool:
+        expires = self.banned.get(session_id)
+        return expires is not None and (not expires or expires > time.time())
+
+    async def ensure_loaded(self):
+        """Loads the list on the first call in this process and starts the refresh task."""
+        if self.task is None or self.task.done():
+            if self.version is None:
+                await self.refresh(await get_redis())
+            self.task = asyncio.get_running_loop().create_task(self.run_forever())
+
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_BAN_LIST_REFRESH_INTERVAL)
+            await self.refresh(await get_redis())
+
+    async def refresh(self, redis) -> bool:
+        """Reloads the list if it changed, returns whether it did. Keeps the current list if Redis fails."""
+        try:
+            version = await redis.get(VERSION_KEY) or b'0'
+            if version == self.version:
+                return False
+            async with redis.pipeline(transaction=True) as pipe:
+                version, entries = await pipe.get(VERSION_KEY).hgetall(BANS_KEY).execute()
+        except Exception as e:
+            print(f'BAN LIST NOT REFRESHED: {e}')
+            return False
+
+        self.version = version or b'0'
+        self.banned = {session_id.decode(): float(expires) for session_id, expires in entries.items()}
+        print(f'BAN LIST LOADED: {len(self.banned)} SESSIONS')
+        await self.close_banned()
+        return True
+
+    async def close_banned(self):
+        """Closes this worker's connections of banned sessions."""
+        for consumer in [consumer for consumer in registry.last_seen if self.is_banned(consumer.session_id)]:
+            try:
+                await consumer.close_banned()
+            except Exception as e:
+                print(f'BANNED CLOSE ERROR: {e}')
+
+
+bans = BanList()
@@ -1,16 +1,40 @@
 import asyncio
 import json
+import sys
+import time
+from urllib.parse import parse_qs
 
 from asgiref.sync import sync_to_async
 from bson import ObjectId
 from channels.generic.websocket import AsyncWebsocketConsumer
-from mongoengine import DoesNotExist
-
-from chat.models import ChatRoom
+from django.conf import settings
+from mongoengine import DoesNotExist, ValidationError
+
+from chat import frames, lifecycle, matchmaking, metrics
+from chat.bans import BANNED_CLOSE_CODE, bans
+from chat.drain import controller
+from chat.heartbeat import registry
+from chat.matchmaking import scheduler
+from chat.models import ChatRoom, create_chat_room
+from chat.outbound import BACKPRESSURE_EXTENSION, OutboundQueue, SlowConsumerError
+from chat.pipeline import process_message, valid_client_id, validate_content
 from chat.services.chat_service import ChatService
+from chat.services.mongo_service import AsyncMongoService
+from chat.services.redis_service import RedisService
+from chat.tracing import tracer
 from config.redis_pool import get_redis
 
 
+def exceeds_size_limit(text: str) -> bool:
+    """Whether the frame is over CHAT_WS_MAX_MESSAGE_SIZE, which counts UTF-8 bytes, not characters"""
+    limit = settings.CHAT_WS_MAX_MESSAGE_SIZE
+    if len(text) > limit:
+        return True
+    if len(text) * 4 <= limit:
+        return False  # within the limit whatever the characters, no need to encode
+    return len(text.encode()) > limit
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
     """
      WebSocket connections and messages handler for chat rooms.
@@ -22,15 +46,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_id = None
         self.session_id = None
         self.room_group_name = None
+        self.last_seq = None
+        self.reaped = False
+        self.outbound = None
 
     def initialize_connection_attributes(self):
         """Initializes connection attributes from the connecting request."""
-        self.room_id = self.scope['url_route']['kwargs']['room_id']  # Extract room name from the URL route
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.set_room(self.requested_room_id(query))
         self.session_id = self.scope['session'].session_key
-        self.room_group_name = f'chat_{self.room_id}'
+
+        # Last message sequence seen by the client, sent on reconnect
+        try:
+            self.last_seq = int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            self.last_seq = None
+        self.reaped = False
+        self.outbound = None
+
+    async def dispatch(self, message):
+        # Websocket and channel layer events alike, layer events continue the trace of their sender
+        with tracer.span(f'consumer.{message["type"]}', message.get('trace')):
+            await super().dispatch(message)
+
+    def requested_room_id(self, query: dict) -> str | None:
+        return self.scope['url_route']['kwargs']['room_id']  # Extract room name from the URL route
+
+    def set_room(self, room_id: str | None):
+        # Both peers of a room share the same interned strings
+        self.room_id = sys.intern(room_id) if room_id else None
+        self.room_group_name = sys.intern(f'chat_{room_id}') if room_id else None
 
     async def initialize_chat_service(self):
-        """Initializes the chat service if not already initialized."""
+        """Initializes the chat service if not already initialized, all connections share one Redis client."""
         if not hasattr(self, 'chat_service'):
             r = await get_redis()
             self.chat_service = ChatService(redis=r, room_id=self.room_id, session_id=self.session_id)
@@ -38,7 +86,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def reject_connection(self):
         """Rejects the WebSocket connection with an appropriate message."""
         await self.accept()
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=frames.encode({
             'type': 'redirect',
             'message': 'You cannot be connected to this room.'
         }))
@@ -50,16 +98,69 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.chat_service.mark_as_connected()
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
+        self.outbound = self.new_outbound_queue()
+        registry.register(self)
+        controller.install_signal_handler()
+        scheduler.ensure_started()
+
+    async def defer_connection(self):
+        """Turns away a connection while the worker is draining, the client retries after a delay."""
+        await self.accept()
+        await self.send(text_data=frames.encode({
+            'type': 'reconnect_after',
+            'delay': round(controller.reconnect_delay(), 3)
+        }))
+        await self.close(code=4003)
+
+    async def close_banned(self):
+        """Closes the connection of a banned session, the client doesn't reconnect."""
+        metrics.incr('banned_disconnects')
+        await self.send(text_data=frames.encode({
+            'type': 'banned',
+            'message': 'You are banned from the chat.'
+        }))
+        await self.close(code=BANNED_CLOSE_CODE)
+
+    def new_outbound_queue(self) -> OutboundQueue:
+        """Outbound queue of the accepted connection, paced by the server's back-pressure when it gives one"""
+        backpressure = (self.scope.get('extensions') or {}).get(BACKPRESSURE_EXTENSION)
+        return OutboundQueue(self.send, maxsize=settings.CHAT_OUTBOUND_QUEUE_SIZE, backpressure=backpressure)
+
+    async def enqueue(self, payload: dict, priority: int = OutboundQueue.HIGH, merge_key: str = None):
+        """Encodes and queues a frame for this connection only."""
+        await self.enqueue_frame(frames.encode(payload), priority, merge_key)
+
+    async def enqueue_frame(self, frame: str, priority: int = OutboundQueue.HIGH, merge_key: str = None):
+        """Queues an encoded frame for sending, disconnects the client if it can't keep up."""
+        try:
+            self.outbound.put(frame, priority, merge_key)
+        except SlowConsumerError as e:
+            print(f'SLOW CONSUMER {self.session_id}: {e}')
+            metrics.incr('slow_consumer_disconnects')
+            await self.close(code=4002)
 
     async def handle_reconnect(self, is_reconnect):
         """Handles logic specific to users re-connecting to the chat."""
         if not is_reconnect:
             await self.chat_service.session_ids_append()
         else:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=frames.encode({
                 'type': 'reconnect',
                 'message': ''
             }))
+            if self.last_seq is not None:
+                await self.replay_missed_messages()
+
+    async def replay_missed_messages(self):
+        """Sends only the messages the client missed while it was disconnected."""
+        messages = await self.chat_service.get_missed_messages(self.last_seq)
+        for message in messages:
+            await self.send(text_data=frames.encode({
+                'message': message['message'],
+                'session_id': message['session_id'],
+                'room_id': self.room_id,
+                'seq': message['seq']
+            }))
 
     async def manage_users_count_on_connection(self):
         """Manages user counts and related logic when a new connection is established."""
@@ -73,6 +174,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         self.initialize_connection_attributes()
 
+        if controller.draining:
+            await self.defer_connection()
+            return
+
+        await bans.ensure_loaded()
+        if bans.is_banned(self.session_id):
+            await self.accept()
+            await self.close_banned()
+            return
+
         await self.initialize_chat_service()
 
         room = await self.chat_service.get_room_by_id(self.room_id)
@@ -80,165 +191,197 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        is_already_connected = await self.chat_service.is_already_connected()
         is_reconnect = await self.chat_service.in_session_ids()
-        is_room_not_full = await self.chat_service.session_ids_count() < 2
-        should_accept = is_reconnect or (is_room_not_full and not is_reconnect)
-
-        if not should_accept or is_already_connected:
+        if not await self.may_enter_room(is_reconnect):
             await self.reject_connection()
+            return
 
         await self.accept_connection()
 
+        await self.enter_room(is_reconnect)
+
+    async def may_enter_room(self, is_reconnect) -> bool:
+        """Whether this session may join the room, the room's users reconnect to it even when it's full."""
+        # Ended rooms stay active in Mongo until the persisters catch up
+        if await self.chat_service.get_room_state() in lifecycle.ENDED_STATES:
+            return False
+        if await self.chat_service.is_already_connected():
+            return False
+        return is_reconnect or await self.chat_service.session_ids_count() < 2
+
+    async def enter_room(self, is_reconnect):
+        """Joins the accepted connection to the room, the second user to join activates it."""
         await self.handle_reconnect(is_reconnect)
 
         sessions_count = await self.chat_service.session_ids_count()
 
         if not is_reconnect and sessions_count == 2:
             print(f'JOIN SECOND USER: {self.session_id}')
-            await self.join_second_user(room)
+            await self.join_second_user()
 
-        self.cancel_user_removal(self.room_id)
+        await self.cancel_user_removal(self.room_id)
 
         await self.manage_users_count_on_connection()
 
-    async def join_second_user(self, room):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'second_user_joined_event',
-                'message': 'Second user joined'
-            }
-        )
-        await self.chat_service.join_second_user(room)
+    async def join_second_user(self):
+        if await self.chat_service.join_second_user():
+            await self.channel_layer.group_send(self.room_group_name, frames.second_user_joined())
+
+    # Handlers below forward the frame encoded by the sender. Events without one come from workers
+    # running the previous version during a rolling restart.
 
     async def second_user_joined_event(self, event):
-        message = event['message']
-        await self.send(text_data=json.dumps({
+        await self.enqueue_frame(event.get('frame') or frames.encode({
             'type': 'second_user_joined',
-            'message': message
+            'message': event['message']
+        }))
+
+    async def matched(self, event):
+        """Sends the waiting user to the room of the partner found by matchmaking."""
+        await self.enqueue_frame(event.get('frame') or frames.encode({
+            'type': 'matched',
+            'room_id': event['room_id']
         }))
 
     async def disconnect(self, close_code):
         """
         Disconnect from chat.
         """
-        await self.chat_service.unmark_as_connected()
+        if self.reaped:  # disconnect path already ran when the connection was reaped
+            return
+        if not hasattr(self, 'chat_service'):  # turned away before the chat service was initialized
+            return
+        registry.unregister(self)
+        if self.outbound is not None:
+            self.outbound.close()
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
         print('DISCONNECT')
-        if close_code != 4000:
+        if close_code == 4000:  # rejected, the connection marker belongs to another connection
+            return
+        if await self.chat_service.get_room_state() in lifecycle.ENDED_STATES:
+            return  # whoever ended the room already deleted its data and connection markers
 
-            users_count = await self.chat_service.get_users_count()
+        await self.chat_service.unmark_as_connected()
+        users_count = await self.chat_service.get_users_count()
 
-            if users_count <= 1:
-                await self.delete_chat_room()
-                await self.chat_service.close_redis()
-                del self.chat_service
-            else:
-                self.schedule_user_removal(self.room_id)
+        if users_count <= 1 and not controller.draining:
+            await self.delete_chat_room()
+            del self.chat_service
+        else:
+            await self.schedule_user_removal(self.room_id)
 
-    def schedule_user_removal(self, room_id):
-        """Starts timer if user didn't reconnect."""
-        timer = asyncio.get_event_loop().call_later(30, asyncio.create_task, self.remove_user(room_id))
+    async def reap(self):
+        """Closes an idle connection and runs the normal disconnect path without waiting for the client."""
+        print(f'REAPING IDLE CONNECTION: {self.session_id}')
+        await self.disconnect(close_code=4001)
+        self.reaped = True
+        await self.close(code=4001)
+
+    async def schedule_user_removal(self, room_id):
+        """
+        Starts timer if user didn't reconnect.
+        The deadline is kept in Redis too, so the removal survives this worker stopping.
+        """
+        delay = settings.CHAT_USER_REMOVAL_DELAY
+        await self.chat_service.schedule_removal(time.time() + delay)
+        if controller.draining:
+            return
+
+        timer = asyncio.get_event_loop().call_later(delay, lambda: asyncio.create_task(self.remove_user(room_id)))
         self.deletion_timers[room_id] = timer
 
-    def cancel_user_removal(self, room_id):
+    async def cancel_user_removal(self, room_id):
         """Cancels user remover if reconnected."""
         timer = self.deletion_timers.get(room_id)
         if timer:
             timer.cancel()
             del self.deletion_timers[room_id]
+        await self.chat_service.cancel_removal()
 
     async def remove_user(self, room_id):
-        """Removes user after a timer."""
-        if self.chat_service.users_exists():
-            await self.chat_service.decr_users_count()
-            users_count = await self.chat_service.get_users_count()
-            print(f'User left from room {room_id}\nUSERS COUNT: {users_count}')
-
-            if users_count == 1:
-                await self.end_chat_on_left(room_id)
-                await self.delete_chat_room()
+        """Removes user after a timer, unless the removal was cancelled or run by another worker."""
+        self.deletion_timers.pop(room_id, None)
+        if await self.chat_service.claim_removal():
+            await self.chat_service.remove_left_user()
 
-        await self.chat_service.close_redis()
         del self.chat_service
 
-    async def end_chat_on_left(self, room_id):
-        """
-        Sends end chat message event to all.
-        """
-
-        session_id = 'system'
-        print('ENDING CHAT')
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'end_chat',
-                'message': 'Chat ended',
-                'session_id': session_id,
-                'room_id': room_id
-            }
-        )
-
     async def delete_chat_room(self):
         """
-        Delete chat room.
+        Ends the chat and deletes the room, unless it was already ended by the other user or a removal.
         :return:
         """
-        if hasattr(self, 'chat_service'):
-            await self.chat_service.delete_chat_data()
+        ended = hasattr(self, 'chat_service') and await self.chat_service.end_room(self.session_id)
 
         self.deletion_timers.pop(self.room_id, None)
 
-        print(f'ROOM DATA {self.room_id} DELETED')
+        if ended:
+            print(f'ROOM DATA {self.room_id} DELETED')
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         On message receive.
         """
-        text_data_json = json.loads(text_data)
+        registry.touch(self)
+
+        # Size is checked before parsing, servers without a frame limit pass anything through
+        if text_data is None or exceeds_size_limit(text_data):
+            metrics.incr('rejected_frames')
+            await self.close(code=1009 if text_data else 1003)
+            return
+
+        try:
+            text_data_json = json.loads(text_data)
+        except ValueError:
+            text_data_json = None
+        if not isinstance(text_data_json, dict):
+            metrics.incr('rejected_frames')
+            await self.close(code=1007)
+            return
+
+        await self.handle_action(text_data_json)
+
+    async def handle_action(self, text_data_json: dict):
+        """Handles a parsed client frame."""
         message = text_data_json.get('message')
         room_id = text_data_json.get('room_id')
         action = text_data_json.get('action')
         ac_type = text_data_json.get('type')
+        client_id = valid_client_id(text_data_json.get('client_id'))
+
+        if action == 'ping':
+            await self.chat_service.refresh_connected()
+            await self.enqueue({'type': 'pong'})
 
-        if action == 'end_chat':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'end_chat',
-                    'message': 'Chat ended',
-                    'session_id': self.session_id,
-                    'room_id': room_id
-                }
-            )
+        elif action == 'end_chat':
             print('DELETING CHAT')
-            await self.chat_service.unmark_as_connected()
             await self.delete_chat_room()
 
         elif action == 'typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_message',
-                    'message': message,
-                    'sender_channel_name': self.channel_name
-                }
-            )
+            await self.channel_layer.group_send(self.room_group_name, frames.typing(message, self.channel_name))
 
         else:
-            await self.chat_service.save_message(message=message, room_id=room_id, session_id=self.session_id)
-
-            # Send message
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'session_id': self.session_id,
-                    'room_id': room_id
-                }
-            )
+            error = validate_content(message)
+            if error:
+                await self.enqueue({'type': 'error', 'client_id': client_id, 'message': error})
+                return
+
+            message = process_message(message)
+            async with controller.persisting():
+                seq, is_new = await self.chat_service.ingest_message(message=message, room_id=room_id,
+                                                                     session_id=self.session_id, client_id=client_id)
+
+            if is_new:
+                # Encoded once here, every recipient forwards the same frame
+                await self.channel_layer.group_send(
+                    self.room_group_name, frames.chat_message(message, self.session_id, room_id, seq)
+                )
+            else:
+                metrics.incr('duplicate_messages')
+
+            if client_id:
+                # Lets the client stop resending
+                await self.enqueue({'type': 'ack', 'client_id': client_id, 'seq': seq})
 
     async def typing_message(self, event):
         """
@@ -247,39 +390,162 @@ class ChatConsumer(AsyncWebsocketConsumer):
         :return:
         """
         if event['sender_channel_name'] != self.channel_name:  # Don't send to ourselves
-            await self.send(text_data=json.dumps({
+            await self.enqueue_frame(event.get('frame') or frames.encode({
                 'type': 'typing',
                 'message': event['message']
-            }))
+            }), priority=OutboundQueue.LOW, merge_key='typing')
 
     async def end_chat(self, event):
         """
-        Sends end chat message to the WebSocket.
+        Sends end chat message to the WebSocket. Connection markers were deleted by whoever ended the chat.
         """
-        await self.chat_service.unmark_as_connected()
-        message = event['message']
-        session_id = event['session_id']
-        room_id = event['room_id']
-
-        await self.send(text_data=json.dumps({
+        await self.enqueue_frame(event.get('frame') or frames.encode({
             'type': 'end_chat',
-            'message': message,
-            'session_id': session_id,
-            'room_id': room_id
-
+            'message': event['message'],
+            'session_id': event['session_id'],
+            'room_id': event['room_id']
         }))
 
     async def chat_message(self, event):
         """
         Sends message to the WebSocket.
         """
-        message = event['message']
-        session_id = event['session_id']
-        room_id = event['room_id']
+        await self.enqueue_frame(event.get('frame') or frames.encode({
+            'message': event['message'],
+            'session_id': event['session_id'],
+            'room_id': event['room_id'],
+            'seq': event.get('seq')
+        }))
 
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'session_id': session_id,
-            'room_id': room_id
 
-        }))
+class LobbyConsumer(ChatConsumer):
+    """
+    Search and chat over one websocket.
+    The connection starts in the lobby, 'search' takes the room of a waiting partner or creates one and
+    switches the connection into room mode, where it works as ChatConsumer. 'next' ends the chat and searches
+    again, so users going from partner to partner never reload the page or reconnect.
+    Clients reconnecting to their room pass room_id and last_seq in the query string.
+    """
+    FILTERS = ('topic', 'my_gender', 'search_gender')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filters = None
+
+    def requested_room_id(self, query: dict) -> str | None:
+        room_id = query.get('room_id', [None])[0]
+        return room_id if room_id and ObjectId.is_valid(room_id) else None
+
+    async def connect(self):
+        self.initialize_connection_attributes()
+
+        if controller.draining:
+            await self.defer_connection()
+            return
+
+        await bans.ensure_loaded()
+        await self.accept()
+        if bans.is_banned(self.session_id):
+            await self.close_banned()
+            return
+
+        self.outbound = self.new_outbound_queue()
+        registry.register(self)
+        controller.install_signal_handler()
+        scheduler.ensure_started()
+
+        if self.room_id is not None:
+            room_id, last_seq = self.room_id, self.last_seq
+            self.leave_room_mode()
+            room = await AsyncMongoService.get_room_by_id(room_id)
+            if room is None or not await self.join_room(room_id, last_seq):
+                await self.send(text_data=frames.encode({'type': 'lobby', 'room_id': room_id}))
+
+    async def join_room(self, room_id: str, last_seq: int = None) -> bool:
+        """Switches the connection into room mode. Returns False if this session may not join the room."""
+        self.set_room(room_id)
+        self.last_seq = last_seq
+        self.chat_service = ChatService(redis=await get_redis(), room_id=self.room_id, session_id=self.session_id)
+
+        is_reconnect = await self.chat_service.in_session_ids()
+        if not await self.may_enter_room(is_reconnect):
+            self.leave_room_mode()
+            return False
+
+        await self.chat_service.mark_as_connected()
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.send(text_data=frames.encode({'type': 'room', 'room_id': self.room_id}))
+        await self.enter_room(is_reconnect)
+        return True
+
+    def leave_room_mode(self):
+        if hasattr(self, 'chat_service'):
+            del self.chat_service
+        self.set_room(None)
+        self.last_seq = None
+
+    async def leave_room(self):
+        """Ends the current chat, the partner gets end_chat, and gets the connection back to the lobby."""
+        if self.room_id is None:
+            return
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.chat_service.end_room(self.session_id)
+        self.leave_room_mode()
+
+    async def search(self, filters: dict = None):
+        """Leaves the current room and joins a waiting partner's room, or creates a room and waits in it."""
+        if filters is not None:
+            self.filters = {name: filters.get(name) for name in self.FILTERS}
+        if not self.filters or not isinstance(self.filters['topic'], str):
+            await self.enqueue({'type': 'error', 'message': 'Search filters are missing'})
+            return
+
+        await self.leave_room()
+        if await RedisService(await get_redis(), None, self.session_id).is_already_connected():
+            await self.enqueue({'type': 'redirect', 'message': 'You cannot be connected to this room.'})
+            return
+
+        room_id = await sync_to_async(matchmaking.match_now)(**self.filters)
+        if room_id is not None and await self.join_room(room_id):
+            metrics.incr('lobby_matches')
+            return
+
+        try:
+            room = await sync_to_async(create_chat_room)(**self.filters, session_id=self.session_id)
+        except ValidationError as e:
+            await self.enqueue({'type': 'error', 'message': str(e)})
+            return
+        await self.join_room(str(room.id))
+
+    async def handle_action(self, text_data_json: dict):
+        action = text_data_json.get('action')
+        if action == 'search':
+            await self.search(text_data_json)
+        elif action == 'next':
+            # Same filters as the last search unless new ones are sent
+            await self.search(text_data_json if 'topic' in text_data_json else None)
+        elif self.room_id is not None:
+            text_data_json['room_id'] = self.room_id  # the room is the connection's, not the client's
+            await super().handle_action(text_data_json)
+        elif action == 'ping':
+            await self.enqueue({'type': 'pong'})
+        else:
+            await self.enqueue({'type': 'error', 'client_id': text_data_json.get('client_id'),
+                                'message': 'Not in a room'})
+
+    async def matched(self, event):
+        """The matchmaking pass paired the room this connection waits in, moves the connection to the partner's."""
+        room_id = event.get('room_id') or json.loads(event['frame'])['room_id']
+        await self.leave_room()
+        if not await self.join_room(room_id):
+            await self.search()
+
+    async def disconnect(self, close_code):
+        if self.room_id is not None:
+            await super().disconnect(close_code)
+            return
+        if self.reaped:
+            return
+        registry.unregister(self)
+        if self.outbound is not None:
+            self.outbound.close()
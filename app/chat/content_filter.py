@@ -0,0 +1,185 @@
+import os
+import re
+import time
+import unicodedata
+from collections import deque
+
+from django.conf import settings
+
+# Characters commonly used to disguise banned terms, folded to one canonical form.
+# Cyrillic letters that look like Latin ones in lowercase are folded to Latin, so both alphabets match the same
+# terms. Folding runs after case folding, so letters alike only in uppercase (н, т, м, в, к) are left alone,
+# folding them would mask ordinary Cyrillic words (нот, мах) spelling a Latin term.
+HOMOGLYPHS = {
+    'а': 'a', 'е': 'e', 'о': 'o', 'р': 'p', 'с': 'c', 'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's',
+    'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w',
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '$': 's',
+}
+IGNORED = {'\u200b', '\u200c', '\u200d', '\u2060', '\ufeff', '\u00ad'}  # zero-width and soft hyphen
+
+MASK = '*'
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+
+class FoldTable(dict):
+    """
+    str.translate table folding every character for matching: NFKC, case folding, homoglyphs,
+    dropped combining marks and invisible characters. Filled lazily, one entry per distinct character seen.
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if char in IGNORED:
+            folded = ''
+        else:
+            folded = ''.join(HOMOGLYPHS.get(c, c) for c in unicodedata.normalize('NFKC', char).casefold()
+                             if not unicodedata.combining(c))
+        self[codepoint] = folded
+        return folded
+
+
+FOLD_TABLE = FoldTable()
+
+
+def fold(text: str) -> str:
+    """Normalizes text for matching."""
+    return text.translate(FOLD_TABLE)
+
+
+def tokenize(folded: str) -> list[str]:
+    """Splits folded text into words and single punctuation characters, whitespace only separates tokens."""
+    return TOKEN_RE.findall(folded)
+
+
+def fold_positions(text: str) -> list[int]:
+    """Returns the index in the original text of every character of the folded text."""
+    positions = []
+    for index, char in enumerate(text):
+        positions.extend([index] * len(FOLD_TABLE[ord(char)]))
+    return positions
+
+
+class ContentFilter:
+    """
+    Multi-pattern matcher over folded text: an Aho-Corasick automaton whose alphabet is word tokens,
+    so terms only ever match whole words. Builds once from a terms list, then scans every message in a single
+    pass regardless of the number of terms; messages without any term's first token are skipped by a set check.
+    """
+
+    def __init__(self, terms):
+        self.goto = [{}]
+        self.fail = [0]
+        self.lengths = [()]
+        for term in terms:
+            self.add(tokenize(fold(term).strip()))
+        self.build()
+        self.first_tokens = frozenset(self.goto[0])
+
+    def add(self, tokens: list[str]):
+        if not tokens:
+            return
+        node = 0
+        for token in tokens:
+            next_node = self.goto[node].get(token)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][token] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.lengths.append(())
+            node = next_node
+        self.lengths[node] = (len(tokens),)
+
+    def build(self):
+        """Computes failure links breadth-first, merging outputs of suffix nodes."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(token, 0)
+                self.lengths[child] = self.lengths[child] + self.lengths[self.fail[child]]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def find(self, tokens: list[str]):
+        """Yields (start, end) token index spans of matches."""
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        node = 0
+        for end, token in enumerate(tokens, 1):
+            next_node = goto[node].get(token)
+            while next_node is None and node:
+                node = fail[node]
+                next_node = goto[node].get(token)
+            node = next_node or 0
+            for length in lengths[node]:
+                yield end - length, end
+
+    def censor(self, text: str) -> str:
+        """Masks banned terms in the original text."""
+        folded = fold(text)
+        tokens = tokenize(folded)
+        if self.first_tokens.isdisjoint(tokens):
+            return text
+
+        masked = None
+        for start, end in self.find(tokens):
+            if masked is None:
+                masked = list(text)
+                positions = fold_positions(text)
+                spans = [match.span() for match in TOKEN_RE.finditer(folded)]
+            for index in range(positions[spans[start][0]], positions[spans[end - 1][1] - 1] + 1):
+                if not text[index].isspace():
+                    masked[index] = MASK
+        return text if masked is None else ''.join(masked)
+
+
+def read_terms(paths) -> list[str]:
+    terms = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            terms.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    return terms
+
+
+class ReloadingContentFilter:
+    """
+    Process-wide filter loaded from the CHAT_BANNED_TERMS_FILES lists.
+    Rebuilds when any of the files changes, checking at most every CHAT_BANNED_TERMS_RELOAD_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.content_filter = None
+        self.mtimes = None
+        self.checked_at = 0
+
+    def file_mtimes(self) -> tuple:
+        return tuple(os.stat(path).st_mtime_ns for path in settings.CHAT_BANNED_TERMS_FILES)
+
+    def reload(self):
+        self.mtimes = self.file_mtimes()
+        self.content_filter = ContentFilter(read_terms(settings.CHAT_BANNED_TERMS_FILES))
+        print(f'CONTENT FILTER LOADED: {len(self.content_filter)} NODES')
+
+    def get(self) -> ContentFilter:
+        now = time.monotonic()
+        if self.content_filter is None:
+            self.checked_at = now
+            self.reload()
+        elif now - self.checked_at > settings.CHAT_BANNED_TERMS_RELOAD_INTERVAL:
+            self.checked_at = now
+            if self.file_mtimes() != self.mtimes:
+                self.reload()
+        return self.content_filter
+
+
+banned_terms = ReloadingContentFilter()
+
+
+def filter_stage(content: str) -> str:
+    """Message pipeline stage masking banned terms and links."""
+    return banned_terms.get().censor(content)
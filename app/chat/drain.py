@@ -0,0 +1,109 @@
+import asyncio
+import random
+import signal
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+from chat import metrics
+from chat.heartbeat import registry
+
+
+class DrainController:
+    """
+    Graceful shutdown of a worker.
+    On SIGTERM stops accepting connections, tells clients when to reconnect, waits for pending
+    writes and outbound frames, closes connections and then lets the server exit.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.pending_writes = 0
+        self.previous_handler = None
+        self.installed = False
+
+    def install_signal_handler(self):
+        """Takes over SIGTERM on the running loop, the server's own handler runs after drain."""
+        if self.installed:
+            return
+        self.installed = True
+        loop = asyncio.get_running_loop()
+        self.previous_handler = signal.getsignal(signal.SIGTERM)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(self.drain_and_exit()))
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # not the main thread or not supported by the loop
+
+    @asynccontextmanager
+    async def persisting(self):
+        """Marks a storage write as in-flight, drain waits for it to finish."""
+        self.pending_writes += 1
+        try:
+            yield
+        finally:
+            self.pending_writes -= 1
+
+    def reconnect_delay(self) -> float:
+        """Jittered reconnect delay, spreads clients over time instead of all reconnecting at once."""
+        return random.uniform(*settings.CHAT_DRAIN_RECONNECT_DELAY)
+
+    async def wait_writes_done(self):
+        while self.pending_writes:
+            await asyncio.sleep(0.05)
+
+    async def wait_outbound_flushed(self, consumers):
+        while any(consumer.outbound and len(consumer.outbound) for consumer in consumers):
+            await asyncio.sleep(0.05)
+
+    async def wait_disconnected(self):
+        while registry.last_seen:
+            await asyncio.sleep(0.05)
+
+    async def drain(self):
+        """Drains all connections of this worker."""
+        self.draining = True
+        consumers = list(registry.last_seen)
+        print(f'DRAINING {len(consumers)} CONNECTIONS')
+
+        for consumer in consumers:
+            await consumer.enqueue({
+                'type': 'reconnect_after',
+                'delay': round(self.reconnect_delay(), 3)
+            })
+
+        try:
+            await asyncio.wait_for(self.wait_writes_done(), settings.CHAT_DRAIN_TIMEOUT)
+            await asyncio.wait_for(self.wait_outbound_flushed(consumers), settings.CHAT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print('DRAIN TIMEOUT, CLOSING REMAINING CONNECTIONS')
+
+        for consumer in consumers:
+            await consumer.close(code=4003)
+        try:
+            await asyncio.wait_for(self.wait_disconnected(), settings.CHAT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+        metrics.incr('connections_drained', len(consumers))
+        self.hand_off_timers()
+
+    def hand_off_timers(self):
+        """
+        Cancels local removal timers. Their deadlines are already in shared storage,
+        where another worker picks them up.
+        """
+        from chat.consumers import ChatConsumer
+
+        for timer in ChatConsumer.deletion_timers.values():
+            timer.cancel()
+        ChatConsumer.deletion_timers.clear()
+
+    async def drain_and_exit(self):
+        await self.drain()
+        loop = asyncio.get_running_loop()
+        loop.remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, self.previous_handler or signal.SIG_DFL)
+        signal.raise_signal(signal.SIGTERM)
+
+
+controller = DrainController()
@@ -0,0 +1,31 @@
+"""
+Room events log.
+
+Every room event is appended to one Redis stream. Websocket workers only append, Mongo is written by the
+persist_events workers reading the stream through a consumer group (see PersistenceService).
+"""
+import time
+
+STREAM_KEY = 'room_events'
+GROUP = 'persisters'
+DEAD_LETTER_KEY = 'room_events:dead'
+
+MESSAGE = 'message'
+JOIN = 'join'
+LEAVE = 'leave'
+END_CHAT = 'end_chat'
+
+
+def event_fields(event_type: str, room_id: str, session_id: str = 'system', **fields) -> dict:
+    """Stream entry fields of an event, values are strings as Redis returns them"""
+    return {
+        'type': event_type,
+        'room': room_id,
+        'session': session_id or '',
+        'ts': repr(time.time()),
+        **{name: str(value) for name, value in fields.items() if value is not None},
+    }
+
+
+def decode(fields: dict) -> dict:
+    return {name.decode(): value.decode() for name, value in fields.items()}
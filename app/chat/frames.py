@@ -0,0 +1,59 @@
+"""
+Client frames encoded once by the sender.
+
+Channel layer events carry the ready-to-send frame text in 'frame', consumer handlers forward it verbatim
+instead of building and encoding the same payload again for every recipient.
+"""
+import json
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def encode(payload: dict) -> str:
+    # Non-ASCII text as is, Cyrillic messages would be three times bigger \\u-escaped
+    return _encoder.encode(payload)
+
+
+def event(event_type: str, payload: dict, **fields) -> dict:
+    """Channel layer event of handler event_type carrying the encoded client payload"""
+    return {'type': event_type, 'frame': encode(payload), **fields}
+
+
+def chat_message(message: str, session_id: str, room_id: str, seq: int) -> dict:
+    return event('chat_message', {
+        'message': message,
+        'session_id': session_id,
+        'room_id': room_id,
+        'seq': seq
+    })
+
+
+def end_chat(session_id: str, room_id: str) -> dict:
+    return event('end_chat', {
+        'type': 'end_chat',
+        'message': 'Chat ended',
+        'session_id': session_id,
+        'room_id': room_id
+    })
+
+
+def typing(message: str, sender_channel_name: str) -> dict:
+    return event('typing_message', {
+        'type': 'typing',
+        'message': message
+    }, sender_channel_name=sender_channel_name)
+
+
+def second_user_joined() -> dict:
+    return event('second_user_joined_event', {
+        'type': 'second_user_joined',
+        'message': 'Second user joined'
+    })
+
+
+def matched(room_id: str) -> dict:
+    # room_id also as a field, lobby connections move to the room themselves
+    return event('matched', {
+        'type': 'matched',
+        'room_id': room_id
+    }, room_id=room_id)
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from chat import metrics
+from chat.services.chat_service import ChatService
+from config.redis_pool import get_redis
+
+
+class ConnectionRegistry:
+    """
+    Per-process registry of open websocket connections.
+    Tracks when each connection was last heard from and reaps idle ones. Also runs the due user removals of
+    all workers, for as long as the process lives: removals this worker scheduled outlive its connections.
+    """
+
+    def __init__(self):
+        self.last_seen = {}
+        self.sweeper = None
+        self.removals = None
+
+    def register(self, consumer):
+        self.last_seen[consumer] = time.monotonic()
+        metrics.incr('connections_open')
+        self.ensure_sweeper()
+
+    def unregister(self, consumer) -> bool:
+        if self.last_seen.pop(consumer, None) is None:
+            return False
+        metrics.decr('connections_open')
+        return True
+
+    def touch(self, consumer):
+        if consumer in self.last_seen:
+            self.last_seen[consumer] = time.monotonic()
+
+    def ensure_sweeper(self):
+        """Starts the sweeper and removals tasks on the running loop if they are not running yet."""
+        loop = asyncio.get_running_loop()
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = loop.create_task(self.sweep_forever())
+        if self.removals is None or self.removals.done():
+            self.removals = loop.create_task(self.run_removals_forever())
+
+    async def sweep_forever(self):
+        while self.last_seen:
+            await asyncio.sleep(settings.CHAT_HEARTBEAT_INTERVAL)
+            await self.sweep()
+
+    async def run_removals_forever(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_HEARTBEAT_INTERVAL)
+            await self.run_due_removals()
+
+    async def run_due_removals(self):
+        """Picks up user removals scheduled by any worker, including stopped ones."""
+        try:
+            await ChatService.run_due_removals(await get_redis(), time.time())
+        except Exception as e:
+            print(f'REMOVALS ERROR: {e}')
+
+    async def sweep(self, now: float = None) -> list:
+        """Reaps connections idle for longer than CHAT_IDLE_TIMEOUT and returns them."""
+        now = time.monotonic() if now is None else now
+        idle = [consumer for consumer, last_seen in self.last_seen.items()
+                if now - last_seen > settings.CHAT_IDLE_TIMEOUT]
+
+        for consumer in idle:
+            self.unregister(consumer)
+            metrics.incr('connections_reaped')
+            try:
+                await consumer.reap()
+            except Exception as e:
+                print(f'REAP ERROR: {e}')
+        return idle
+
+
+registry = ConnectionRegistry()
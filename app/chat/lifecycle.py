@@ -0,0 +1,38 @@
+"""
+Room lifecycle.
+
+    waiting -> active -> ending -> closed
+       \_________________/
+
+The state of a room is one Redis key changed only by compare-and-set transitions, so when several actors
+race (the user ending the chat, both peers disconnecting, the removal timer of a worker) exactly one of them
+wins each transition and performs its side effects, the others do nothing. Rooms are waiting from their
+creation (matchmaking.enqueue). The closed state expires after CHAT_CLOSED_ROOM_TTL, a room without a state
+key is closed, by then the persisters marked it inactive.
+"""
+from redis.commands.core import AsyncScript
+
+WAITING = 'waiting'
+ACTIVE = 'active'
+ENDING = 'ending'
+CLOSED = 'closed'
+
+OPEN_STATES = (WAITING, ACTIVE)
+ENDED_STATES = (ENDING, CLOSED)
+
+# KEYS[1] state key, ARGV[1] new state, ARGV[2:] states allowed to move from
+TRANSITION_SCRIPT = b"""
+local current = redis.call('GET', KEYS[1]) or 'closed'
+for i = 2, #ARGV do
+    if ARGV[i] == current then
+        redis.call('SET', KEYS[1], ARGV[1])
+        return 1
+    end
+end
+return 0
+"""
+TRANSITION = AsyncScript(None, TRANSITION_SCRIPT)
+
+
+def state_key(room_id: str) -> str:
+    return f'room_state:{room_id}'
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.services.stats_service import StatsService
+
+
+class Command(BaseCommand):
+    help = 'Flushes room and message counters from Redis into the Mongo stats collection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running and flush every N seconds (default: flush once and exit).')
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = StatsService.flush()
+            self.stdout.write(f'Flushed {flushed} rollups')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,43 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.services.persistence_service import PersistenceService
+
+
+class Command(BaseCommand):
+    help = 'Persists the room events log (messages, joins, leaves, ended chats) from Redis into Mongo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default=f'{socket.gethostname()}-{os.getpid()}',
+                            help='Consumer name in the persisters group, unique per worker (default: host-pid).')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_EVENTS_BATCH_SIZE,
+                            help='Max events per bulk write.')
+        parser.add_argument('--block', type=int, default=1000,
+                            help='Milliseconds to wait for new events before checking for stale ones again.')
+        parser.add_argument('--once', action='store_true',
+                            help='Persist the events available now and exit.')
+
+    def handle(self, *args, **options):
+        consumer = options['consumer']
+        self.stdout.write(f'Persisting room events as {consumer}')
+        while True:
+            try:
+                processed = PersistenceService.process(
+                    consumer, options['batch_size'], None if options['once'] else options['block']
+                )
+            except Exception as e:
+                # Batch stays pending and is retried, by this or another worker
+                self.stderr.write(f'Persisting failed: {e}')
+                if options['once']:
+                    raise
+                time.sleep(1)
+                continue
+
+            if processed:
+                self.stdout.write(f'Persisted {processed} events')
+            elif options['once']:
+                break
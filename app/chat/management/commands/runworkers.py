@@ -0,0 +1,26 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from config.supervisor import Supervisor
+
+
+class Command(BaseCommand):
+    help = 'Runs N ASGI worker processes (config.server) on one port, restarting crashed and hung workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes (default: number of CPUs).')
+        parser.add_argument('-b', '--bind', default='127.0.0.1', help='Address to listen on.')
+        parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on.')
+        parser.add_argument('--reuse-port', action='store_true',
+                            help='Give every worker its own SO_REUSEPORT socket instead of sharing one.')
+        parser.add_argument('--application', default='config.asgi:application', help='ASGI application path.')
+        parser.add_argument('server_args', nargs='*',
+                            help='Extra daphne options passed to every worker, after --, e.g. -- --proxy-headers')
+
+    def handle(self, *args, **options):
+        Supervisor(
+            options['workers'], options['bind'], options['port'], options['application'],
+            reuse_port=options['reuse_port'], server_args=options['server_args'],
+        ).run()
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.commands.core import AsyncScript, Script
+
+from chat import frames, lifecycle, metrics
+from config.redis_pool import get_redis
+
+# Waiting searchers: room id -> entry, and per filters bucket a sorted set of room ids by enqueue time,
+# so a new searcher only reads the oldest rooms of the few buckets it can match
+WAITING_KEY = 'waiting_searchers'
+MATCH_TIMES_KEY = 'match_times'
+PASS_LOCK_KEY = 'matchmaking_lock'
+
+NOT_SPECIFIED = 'not-specified'
+GENDERS = ('male', 'female')
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 120)
+BUCKET_HEADS = 5  # oldest rooms of each bucket considered by match_now
+
+# Removes a room from the waiting searchers and its bucket. Returns 1 only for the caller that removed it,
+# so of concurrent matchers exactly one claims a room. KEYS[1] waiting searchers, ARGV[1] room id
+DEQUEUE_SCRIPT = b"""
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if not entry then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', cjson.decode(entry)['bucket'], ARGV[1])
+return 1
+"""
+DEQUEUE = Script(None, DEQUEUE_SCRIPT)
+ASYNC_DEQUEUE = AsyncScript(None, DEQUEUE_SCRIPT)
+
+
+def bucket_key(topic, my_gender, search_gender) -> str:
+    # JSON, user entered topics may contain any separator
+    return f'waiting:{json.dumps([topic, my_gender, search_gender])}'
+
+
+def searcher_entry(room, enqueued_at: float = None) -> dict:
+    return {
+        'topic': room.topic,
+        'my_gender': room.creator_gender,
+        'search_gender': room.search_gender,
+        'session_id': room.session_ids[0] if room.session_ids else None,
+        'bucket': bucket_key(room.topic, room.creator_gender, room.search_gender),
+        'enqueued_at': time.time() if enqueued_at is None else enqueued_at,
+    }
+
+
+def candidate_buckets(topic: str, my_gender: str, search_gender: str) -> list[str]:
+    """Buckets that can hold strict matches for the searcher, entries are still checked with accepts()."""
+    if my_gender == NOT_SPECIFIED:
+        genders = (NOT_SPECIFIED,)
+    elif search_gender in (NOT_SPECIFIED, None):
+        genders = GENDERS
+    else:
+        genders = (search_gender,)
+    return list(dict.fromkeys(bucket_key(topic, gender, theirs)
+                              for gender in genders for theirs in (NOT_SPECIFIED, None, my_gender)))
+
+
+def is_live(entry: dict, connected: bool, now: float) -> bool:
+    """
+    Whether the waiting room's creator is still there: connected to the room, or the room is new enough
+    that the creator may still be opening the websocket (CHAT_MATCH_CONNECT_TIMEOUT).
+    """
+    return connected or now - entry['enqueued_at'] < settings.CHAT_MATCH_CONNECT_TIMEOUT
+
+
+def connection_key(entry: dict) -> str:
+    return f"session:{entry.get('session_id')}:connections"
+
+
+def relaxed(searcher: dict, now: float) -> set:
+    """Constraints the searcher has waited long enough to drop, see CHAT_MATCH_RELAXATION."""
+    waited = now - searcher['enqueued_at']
+    return {constraint for after, constraint in settings.CHAT_MATCH_RELAXATION if waited >= after}
+
+
+def accepts(searcher: dict, other: dict, relaxed_constraints: set) -> bool:
+    """Whether searcher accepts other as a partner, same rules as search_chat_room."""
+    if 'topic' not in relaxed_constraints and searcher['topic'] != other['topic']:
+        return False
+    if 'search_gender' in relaxed_constraints:
+        return True
+    # Users not telling their gender only meet each other
+    if (searcher['my_gender'] == NOT_SPECIFIED) != (other['my_gender'] == NOT_SPECIFIED):
+        return False
+    return searcher['search_gender'] in (NOT_SPECIFIED, None, other['my_gender'])
+
+
+def is_compatible(a: dict, b: dict, now: float) -> bool:
+    return accepts(a, b, relaxed(a, now)) and accepts(b, a, relaxed(b, now))
+
+
+def pair_waiting(searchers: dict, now: float) -> list[tuple[str, str]]:
+    """
+    One batch pass over all waiting searchers. Longest waiting ones are matched first.
+    Returns (waiting room id, moving room id) pairs, the newer searcher moves to the older one's room.
+    """
+    order = sorted(searchers, key=lambda room_id: searchers[room_id]['enqueued_at'])
+    by_topic = {}
+    for room_id in order:
+        by_topic.setdefault(searchers[room_id]['topic'], []).append(room_id)
+
+    matched = set()
+    pairs = []
+    for room_id in order:
+        if room_id in matched:
+            continue
+        searcher = searchers[room_id]
+        candidates = order if 'topic' in relaxed(searcher, now) else by_topic[searcher['topic']]
+        for other_id in candidates:
+            if other_id == room_id or other_id in matched:
+                continue
+            if is_compatible(searcher, searchers[other_id], now):
+                matched.update((room_id, other_id))
+                pairs.append((room_id, other_id))
+                break
+    return pairs
+
+
+def wait_bucket(seconds: float) -> str:
+    for bucket in WAIT_BUCKETS:
+        if seconds < bucket:
+            return f'<{bucket}s'
+    return f'>={WAIT_BUCKETS[-1]}s'
+
+
+def match_time_field(searcher: dict, waited: float) -> str:
+    return json.dumps([searcher['topic'], searcher['my_gender'], searcher['search_gender'], wait_bucket(waited)])
+
+
+def enqueue(room, enqueued_at: float = None):
+    """Starts the new room's lifecycle in the waiting state and adds its creator to the waiting searchers."""
+    entry = searcher_entry(room, enqueued_at)
+    pipe = get_redis_connection('default').pipeline()
+    pipe.set(lifecycle.state_key(str(room.id)), lifecycle.WAITING)
+    pipe.hset(WAITING_KEY, str(room.id), json.dumps(entry))
+    pipe.zadd(entry['bucket'], {str(room.id): entry['enqueued_at']})
+    pipe.execute()
+
+
+def is_waiting(room_id: str) -> bool:
+    return bool(get_redis_connection('default').hexists(WAITING_KEY, room_id))
+
+
+def match_now(topic: str, my_gender: str, search_gender: str) -> str | None:
+    """
+    Finds a waiting room for a new searcher without querying Mongo, reading only the oldest rooms of the
+    buckets it can match. Only strict matches are made here, relaxed ones are left to the periodic batch pass.
+    Rooms whose creator is gone are dropped from the waiting searchers.
+    """
+    redis = get_redis_connection('default')
+    now = time.time()
+    searcher = {'topic': topic, 'my_gender': my_gender, 'search_gender': search_gender, 'enqueued_at': now}
+
+    keys = candidate_buckets(topic, my_gender, search_gender)
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.zrange(key, 0, BUCKET_HEADS - 1)
+    buckets = {room_id.decode(): key for key, heads in zip(keys, pipe.execute()) for room_id in heads}
+    if not buckets:
+        return None
+
+    entries = {}
+    for room_id, entry in zip(buckets, redis.hmget(WAITING_KEY, list(buckets))):
+        if entry is None:
+            redis.zrem(buckets[room_id], room_id)  # left by a room deleted while being matched
+        else:
+            entries[room_id] = json.loads(entry)
+    pipe = redis.pipeline(transaction=False)
+    for entry in entries.values():
+        pipe.exists(connection_key(entry))
+    connected = dict(zip(entries, pipe.execute()))
+
+    for room_id in sorted(entries, key=lambda room_id: entries[room_id]['enqueued_at']):
+        other = entries[room_id]
+        if not is_live(other, connected[room_id], now):
+            DEQUEUE(keys=[WAITING_KEY], args=[room_id], client=redis)
+            metrics.incr('stale_searchers_dropped')
+        elif accepts(searcher, other, set()) and accepts(other, searcher, relaxed(other, now)):
+            if DEQUEUE(keys=[WAITING_KEY], args=[room_id], client=redis):  # claimed, nobody else matched it meanwhile
+                redis.hincrby(MATCH_TIMES_KEY, match_time_field(other, now - other['enqueued_at']))
+                metrics.incr('matches_immediate')
+                return room_id
+    return None
+
+
+def get_stats() -> dict:
+    """Time-to-match distribution per topic and gender bucket, and waiting searchers per topic."""
+    redis = get_redis_connection('default')
+    distribution = {}
+    for field, count in redis.hgetall(MATCH_TIMES_KEY).items():
+        topic, my_gender, search_gender, bucket = json.loads(field)
+        distribution.setdefault((topic, my_gender, search_gender), {})[bucket] = int(count)
+
+    waiting = {}
+    for entry in redis.hvals(WAITING_KEY):
+        topic = json.loads(entry)['topic']
+        waiting[topic] = waiting.get(topic, 0) + 1
+    return {
+        'time_to_match': [{'topic': topic, 'my_gender': my_gender, 'search_gender': search_gender, 'waited': buckets}
+                          for (topic, my_gender, search_gender), buckets in distribution.items()],
+        'waiting': waiting,
+    }
+
+
+class MatchmakingScheduler:
+    """
+    Runs periodic batch matching passes on this worker. A Redis lock makes sure
+    only one worker runs a pass at a time.
+    """
+
+    def __init__(self):
+        self.task = None
+
+    def ensure_started(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run_forever())
+
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_MATCH_INTERVAL)
+            try:
+                await self.run_pass(await get_redis())
+            except Exception as e:
+                print(f'MATCHMAKING ERROR: {e}')
+
+    @staticmethod
+    async def live_searchers(redis, now: float) -> dict:
+        """All waiting searchers, dropping the ones whose creator is gone."""
+        waiting = {room_id.decode(): json.loads(entry) for room_id, entry in (await redis.hgetall(WAITING_KEY)).items()}
+        async with redis.pipeline(transaction=False) as pipe:
+            for entry in waiting.values():
+                pipe.exists(connection_key(entry))
+            connected = dict(zip(waiting, await pipe.execute()))
+
+        for room_id in [room_id for room_id, entry in waiting.items() if not is_live(entry, connected[room_id], now)]:
+            await ASYNC_DEQUEUE(keys=[WAITING_KEY], args=[room_id], client=redis)
+            metrics.incr('stale_searchers_dropped')
+            del waiting[room_id]
+        return waiting
+
+    async def run_pass(self, redis, now: float = None) -> list[tuple[str, str]]:
+        """Matches waiting searchers and tells the moving one of each pair which room to go to."""
+        lock_ms = int(settings.CHAT_MATCH_INTERVAL * 1000)
+        if not await redis.set(PASS_LOCK_KEY, 1, nx=True, px=lock_ms):
+            return []
+
+        now = time.time() if now is None else now
+        waiting = await self.live_searchers(redis, now)
+
+        made = []
+        for room_id, moving_id in pair_waiting(waiting, now):
+            if not await ASYNC_DEQUEUE(keys=[WAITING_KEY], args=[moving_id], client=redis):
+                continue
+            if not await ASYNC_DEQUEUE(keys=[WAITING_KEY], args=[room_id], client=redis):
+                entry = waiting[moving_id]
+                async with redis.pipeline() as pipe:
+                    await pipe.hset(WAITING_KEY, moving_id, json.dumps(entry)).zadd(
+                        entry['bucket'], {moving_id: entry['enqueued_at']}).execute()
+                continue
+
+            for searcher in (waiting[room_id], waiting[moving_id]):
+                await redis.hincrby(MATCH_TIMES_KEY, match_time_field(searcher, now - searcher['enqueued_at']))
+            await get_channel_layer().group_send(f'chat_{moving_id}', frames.matched(room_id))
+            made.append((room_id, moving_id))
+
+        metrics.incr('matches_batched', len(made))
+        return made
+
+
+scheduler = MatchmakingScheduler()
@@ -0,0 +1,20 @@
+from collections import Counter
+
+_counters = Counter()
+
+
+def incr(name: str, amount: int = 1):
+    _counters[name] += amount
+
+
+def decr(name: str, amount: int = 1):
+    _counters[name] -= amount
+
+
+def get(name: str) -> int:
+    return _counters[name]
+
+
+def snapshot() -> dict:
+    """Returns a copy of all process-local counters."""
+    return dict(_counters)
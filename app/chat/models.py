@@ -1,9 +1,11 @@
 import uuid
 
 from mongoengine import Document, StringField, ListField, DateTimeField, ReferenceField, CASCADE, UUIDField, \
-    BooleanField
+    BooleanField, IntField, queryset_manager
 from datetime import datetime
 
+from chat import analytics, matchmaking
+
 
 class ChatRoom(Document):
     room_id = UUIDField(binary=False, default=uuid.uuid4, unique=True)
@@ -14,25 +16,40 @@ class ChatRoom(Document):
     creator_gender = StringField(max_length=15)
     search_gender = StringField(max_length=15)
 
+    # Ended rooms are kept, inactive, for CHAT_MODERATION_RETENTION_DAYS after ended_at
     is_active = BooleanField(default=True)
     created_at = DateTimeField(default=datetime.now)
+    ended_at = DateTimeField()
+
+    # Sessions that created, joined or wrote in the room, for moderation lookups
+    session_ids = ListField(StringField(max_length=255))
 
     meta = {
         'indexes': [
             {'fields': ['room_id'], 'name': 'room_id_index'},
+            ('session_ids', '-created_at', '-id'),
             'topic',
             # 'age_range',
             # 'creator_age',
             'search_gender',
             'creator_gender',
-            'second_user_joined'
+            'second_user_joined',
+            {'fields': ['ended_at'], 'sparse': True},
+            # Live rooms only, the retained ended rooms stay out of ChatRoom.active queries and counts
+            {'fields': ['is_active'], 'partialFilterExpression': {'is_active': True}},
         ]
     }
 
+    @queryset_manager
+    def active(doc_cls, queryset):
+        """Rooms not ended yet, the ones the chat itself works with"""
+        return queryset.filter(is_active=True)
+
     def join_second_user(self):
         if not self.second_user_joined:
             self.second_user_joined = True
             self.save()
+            analytics.record(analytics.ROOM_JOINED, self)
 
     def is_full(self):
         return self.second_user_joined
@@ -42,6 +59,7 @@ class Message(Document):
     room = ReferenceField(ChatRoom, required=True, reverse_delete_rule=CASCADE)
     session_id = StringField(max_length=255, required=True)
     content = StringField(required=True, max_length=1500)
+    seq = IntField(min_value=1)  # per-room sequence number, assigned at save time
     timestamp = DateTimeField(default=datetime.now)
 
     meta = {
@@ -50,23 +68,43 @@ class Message(Document):
             'room',
 
             ('room', 'timestamp'),
+            # Unique so concurrent persisters upserting the same message can't both insert it,
+            # partial so the messages saved before sequences existed don't collide
+            {'fields': ['room', 'seq'], 'unique': True, 'partialFilterExpression': {'seq': {'$exists': True}}},
+            ('session_id', '-timestamp', '-id'),
         ],
         'ordering': ['-timestamp']
     }
 
 
+class StatsRollup(Document):
+    """Hourly event counters per topic and gender bucket, flushed from Redis by the flush_stats command."""
+    hour = DateTimeField(required=True)
+    event = StringField(max_length=30, required=True)
+    topic = StringField(max_length=50)
+    gender_bucket = StringField(max_length=31)
+    count = IntField(default=0)
+
+    meta = {
+        'collection': 'stats',
+        'indexes': [
+            {'fields': ['hour', 'event', 'topic', 'gender_bucket'], 'unique': True},
+        ]
+    }
+
+
 def search_chat_room(topic, my_gender, search_gender=None):
     print(topic, my_gender, search_gender)
     if my_gender == 'not-specified':
-        chat_room = ChatRoom.objects.filter(topic=topic, creator_gender=my_gender,
+        chat_room = ChatRoom.active.filter(topic=topic, creator_gender=my_gender,
                                             second_user_joined=False).first()
     elif search_gender == 'not-specified':
-        chat_room = ChatRoom.objects.filter(topic=topic, creator_gender__in=['male', 'female'],
+        chat_room = ChatRoom.active.filter(topic=topic, creator_gender__in=['male', 'female'],
                                             search_gender__in=['not-specified', my_gender],
                                             second_user_joined=False).first()
     else:
         # all filters
-        chat_room = ChatRoom.objects.filter(
+        chat_room = ChatRoom.active.filter(
             topic=topic,
             creator_gender=search_gender,
             search_gender__in=['not-specified', my_gender],
@@ -76,11 +114,14 @@ def search_chat_room(topic, my_gender, search_gender=None):
     return chat_room
 
 
-def create_chat_room(topic, my_gender, search_gender=None, ):
+def create_chat_room(topic, my_gender, search_gender=None, session_id=None):
     new_room = ChatRoom(
         topic=topic,
         creator_gender=my_gender,
-        search_gender=search_gender
+        search_gender=search_gender,
+        session_ids=[session_id] if session_id else [],
     )
     new_room.save()
+    analytics.record(analytics.ROOM_CREATED, new_room)
+    matchmaking.enqueue(new_room)
     return new_room
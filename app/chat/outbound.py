@@ -0,0 +1,91 @@
+import asyncio
+from collections import deque
+
+from chat import metrics
+
+# Scope extension under which the server hands the consumer its transport's send back-pressure
+# (config.server.SendBackpressure): paused while the transport's write buffer is full
+BACKPRESSURE_EXTENSION = 'chat.send_backpressure'
+
+
+class SlowConsumerError(Exception):
+    """Raised when a connection can't keep up with its outbound frames."""
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection queue of outgoing websocket frames.
+    High priority frames (chat messages, end_chat) are always sent before low priority ones (typing).
+    Low priority frames with the same merge key replace each other and are dropped when the queue is half full
+    or the transport is paused.
+    Sending a frame only writes it to the transport's buffer, so the queue fills up only because the writer
+    waits while the server's back-pressure says the client isn't reading.
+    """
+    __slots__ = ('send', 'maxsize', 'backpressure', 'high', 'low', 'writer', 'closed')
+
+    HIGH = 0
+    LOW = 1
+
+    def __init__(self, send, maxsize: int, backpressure=None):
+        self.send = send
+        self.maxsize = maxsize
+        self.backpressure = backpressure
+        self.high = deque()
+        self.low = {}
+        self.writer = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self.high) + len(self.low)
+
+    def put(self, text_data: str, priority: int = HIGH, merge_key: str = None):
+        if self.closed:
+            return
+
+        if priority == self.LOW:
+            if merge_key in self.low:
+                metrics.incr('outbound_merged')
+            elif len(self) >= self.maxsize // 2 or self.paused:
+                metrics.incr('outbound_dropped')
+                return
+            self.low[merge_key] = text_data
+        else:
+            if len(self.high) >= self.maxsize:
+                self.close()
+                raise SlowConsumerError(f'Outbound queue is full ({self.maxsize} frames)')
+            self.high.append(text_data)
+
+        metrics.incr('outbound_queued')
+        if self.writer is None:
+            self.writer = asyncio.get_running_loop().create_task(self.write())
+
+    @property
+    def paused(self) -> bool:
+        return self.backpressure is not None and self.backpressure.paused
+
+    def pop(self) -> str:
+        if self.high:
+            return self.high.popleft()
+        merge_key = next(iter(self.low))
+        return self.low.pop(merge_key)
+
+    async def write(self):
+        """Sends queued frames, the writer task only exists while there is something to send."""
+        try:
+            while len(self):
+                if self.paused:
+                    metrics.incr('outbound_paused')
+                    await self.backpressure.wait()
+                    continue
+                await self.send(text_data=self.pop())
+                metrics.incr('outbound_sent')
+        finally:
+            self.writer = None
+
+    def close(self):
+        """Stops the writer and discards pending frames."""
+        self.closed = True
+        self.high.clear()
+        self.low.clear()
+        if self.writer is not None:
+            self.writer.cancel()
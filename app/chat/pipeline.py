@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chat.models import Message
+
+_stages = None
+
+MAX_CLIENT_ID_LENGTH = 64
+
+
+def get_stages() -> list:
+    global _stages
+    if _stages is None:
+        _stages = [import_string(path) for path in settings.CHAT_MESSAGE_PIPELINE]
+    return _stages
+
+
+def validate_content(content) -> str | None:
+    """Returns why message content can't be saved, checked before any processing or storage work."""
+    if not isinstance(content, str) or not content.strip():
+        return 'Message is empty'
+    if len(content) > Message.content.max_length:
+        return f'Message is longer than {Message.content.max_length} characters'
+    return None
+
+
+def valid_client_id(client_id) -> str | None:
+    """Client message id used to deduplicate retries, None when the client sent no usable one."""
+    if not isinstance(client_id, str) or not client_id or len(client_id) > MAX_CLIENT_ID_LENGTH:
+        return None
+    return client_id
+
+
+def process_message(content: str) -> str:
+    """Runs message content through the CHAT_MESSAGE_PIPELINE stages before it is saved and broadcast."""
+    if not content:
+        return content
+    for stage in get_stages():
+        content = stage(content)
+    return content
@@ -1,14 +1,96 @@
+from channels.layers import get_channel_layer
+from django.conf import settings
 from redis.asyncio import Redis
 
+from chat import events, frames, lifecycle
 from chat.services.mongo_service import AsyncMongoService
 from chat.services.redis_service import RedisService
+from chat.tracing import trace_methods
 
 
+@trace_methods('chat')
 class ChatService(RedisService, AsyncMongoService):
+    __slots__ = ()
+
     def __init__(self, redis: Redis, room_id: str, session_id: str):
         super(ChatService, self).__init__(redis=redis, room_id=room_id, session_id=session_id)
 
     async def delete_chat_data(self):
-        await self.delete_room_by_id(self.room_id)
-        await self.delete_redis_data()
+        """
+        Deletes room state from Redis, logs the end of the chat and closes the room in one round trip.
+        The room and its messages are deleted from Mongo by the persisters.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self.queue_redis_data_deletion(pipe, await self.get_session_ids())
+        pipe.xadd(events.STREAM_KEY, events.event_fields(events.END_CHAT, self.room_id, self.session_id))
+        pipe.set(lifecycle.state_key(self.room_id), lifecycle.CLOSED, ex=settings.CHAT_CLOSED_ROOM_TTL)
+        await pipe.execute()
+
+    async def end_room(self, ended_by: str) -> bool:
+        """
+        Ends the chat. Any actor may call it, only the one moving the room to ending tells the users
+        and deletes the room data, for the rest it's a no-op. Returns whether this call ended the chat.
+        """
+        if not await self.transition(lifecycle.ENDING, *lifecycle.OPEN_STATES):
+            return False
+        await get_channel_layer().group_send(f'chat_{self.room_id}', frames.end_chat(ended_by, self.room_id))
+        await self.delete_chat_data()
+        return True
+
+    async def store_message(self, message: str, room_id: str, session_id: str) -> int:
+        """
+        Gives message the next room sequence number, adds it to recent history and to the events log
+        (saved to Mongo by the persisters), all in one step. Returns the sequence.
+        """
+        return await self.append_message(message, session_id)
+
+    async def join_second_user(self) -> bool:
+        """Activates the waiting room, returns False if it was already activated or ended."""
+        if not await self.transition(lifecycle.ACTIVE, lifecycle.WAITING):
+            return False
+        await self.publish_event(events.JOIN)
+        return True
+
+    async def ingest_message(self, message: str, room_id: str, session_id: str,
+                             client_id: str = None) -> tuple[int | None, bool]:
+        """
+        Saves message unless a message with the same client id was already received.
+        Returns message sequence and whether the message is new.
+        """
+        if not client_id:
+            return await self.store_message(message, room_id, session_id), True
+
+        if not await self.claim_client_message(client_id):
+            return await self.get_client_message_seq(client_id), False
+
+        try:
+            seq = await self.store_message(message, room_id, session_id)
+        except Exception:
+            await self.release_client_message(client_id)  # let the client retry
+            raise
+        await self.set_client_message_seq(client_id, seq)
+        return seq, True
+
+    async def get_missed_messages(self, last_seq: int) -> list[dict]:
+        """Returns messages after last_seq, from the recent history stream or from Mongo if stream is incomplete."""
+        messages = await self.history_since(last_seq)
+        if messages is None:
+            messages = await self.get_messages_since(self.room_id, last_seq)
+        return messages
+
+    async def remove_left_user(self):
+        """Removes user that didn't reconnect in time and ends chat for the remaining one."""
+        if await self.users_exists():
+            await self.decr_users_count()
+            await self.publish_event(events.LEAVE)
+            users_count = await self.get_users_count()
+            print(f'User left from room {self.room_id}\nUSERS COUNT: {users_count}')
+
+            if users_count <= 1 and await self.end_room('system'):
+                print('ENDING CHAT')
 
+    @staticmethod
+    async def run_due_removals(redis: Redis, now: float):
+        """Runs removals whose deadline passed, including ones handed off by stopped workers."""
+        for room_id in await RedisService.claim_due_removals(redis, now):
+            await ChatService(redis=redis, room_id=room_id, session_id='system').remove_left_user()
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongoengine import Q
+from pymongo import ReadPreference
+
+from chat.models import ChatRoom, Message
+from chat.tracing import trace_methods
+
+
+def encode_cursor(document, time_field: str) -> str:
+    return f'{getattr(document, time_field).isoformat()}_{document.id}'
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    """Raises ValueError for cursors not made by encode_cursor"""
+    timestamp, _, object_id = cursor.rpartition('_')
+    try:
+        return datetime.fromisoformat(timestamp), ObjectId(object_id)
+    except InvalidId as e:
+        raise ValueError(str(e))
+
+
+def page(queryset, time_field: str, since: datetime, until: datetime, cursor: str, limit: int) -> tuple[list, str]:
+    """
+    One page of the queryset, newest first, within [since, until), continuing after the cursor.
+    Keyset pagination: (time, _id) of the last document of the page, deep pages cost the same as the first.
+    Reads from a secondary when there is one, keeping moderation queries off the primary.
+    """
+    if since:
+        queryset = queryset.filter(**{f'{time_field}__gte': since})
+    if until:
+        queryset = queryset.filter(**{f'{time_field}__lt': until})
+    if cursor:
+        last_time, last_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f'{time_field}__lt': last_time}) | Q(**{time_field: last_time, 'id__lt': last_id}))
+
+    documents = list(
+        queryset.read_preference(ReadPreference.SECONDARY_PREFERRED).order_by(f'-{time_field}', '-id').limit(limit + 1)
+    )
+    next_cursor = encode_cursor(documents[limit - 1], time_field) if len(documents) > limit else None
+    return documents[:limit], next_cursor
+
+
+@trace_methods('mongo')
+class ModerationService:
+    """
+    Moderation lookups by session: the rooms a session was in and the messages it sent.
+    Both queries are served by (session, time, _id) indexes, never a collection scan.
+    """
+
+    @staticmethod
+    def get_session_rooms(session_id: str, since: datetime = None, until: datetime = None, cursor: str = None,
+                          limit: int = 50) -> tuple[list[dict], str]:
+        rooms, next_cursor = page(ChatRoom.objects(session_ids=session_id), 'created_at', since, until, cursor, limit)
+        return [{
+            'room_id': str(room.id),
+            'topic': room.topic,
+            'session_ids': room.session_ids,
+            'second_user_joined': room.second_user_joined,
+            'created_at': room.created_at.isoformat(),
+        } for room in rooms], next_cursor
+
+    @staticmethod
+    def get_session_messages(session_id: str, room_id: str = None, since: datetime = None, until: datetime = None,
+                             cursor: str = None, limit: int = 50) -> tuple[list[dict], str]:
+        queryset = Message.objects(session_id=session_id).no_dereference()  # only the room id is needed
+        if room_id:
+            queryset = queryset.filter(room=ObjectId(room_id))
+        messages, next_cursor = page(queryset, 'timestamp', since, until, cursor, limit)
+        return [{
+            'room_id': str(message.room.id),
+            'seq': message.seq,
+            'message': message.content,
+            'timestamp': message.timestamp.isoformat(),
+        } for message in messages], next_cursor
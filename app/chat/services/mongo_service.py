@@ -3,48 +3,37 @@ from bson import ObjectId
 from mongoengine import DoesNotExist
 
 from chat.models import ChatRoom, Message
+from chat.tracing import trace_methods
 
 
+@trace_methods('mongo')
 class MongoService:
 
     @staticmethod
-    def delete_room_by_id(room_id: str):
-        try:
-            room = ChatRoom.objects.get(id=room_id)
-            room.delete()
-            print(f'ROOM {room_id} DELETED FROM DB')
-        except DoesNotExist:
-            pass
-
-    @staticmethod
-    def save_message(message: str, room_id: str, session_id: str):
-        if room_id:
-            room = ChatRoom.objects.get(id=room_id)
-            Message(room=room, content=message, session_id=session_id).save()
+    def get_messages_since(room_id: str, last_seq: int):
+        messages = Message.objects.filter(room=ObjectId(room_id), seq__gt=last_seq).order_by('seq')
+        return [{
+            'seq': message.seq,
+            'message': message.content,
+            'session_id': message.session_id,
+        } for message in messages]
 
     @staticmethod
     def get_room_by_id(room_id: str):
         room_id_obj = ObjectId(room_id)
         try:
-            return ChatRoom.objects.get(id=room_id_obj)
+            return ChatRoom.active.get(id=room_id_obj)
         except DoesNotExist:
             return None
 
 
 class AsyncMongoService:
+    __slots__ = ()
 
     @staticmethod
-    async def delete_room_by_id(room_id):
-        await sync_to_async(MongoService.delete_room_by_id)(room_id)
-
-    @staticmethod
-    async def save_message(message, room_id, session_id):
-        await sync_to_async(MongoService.save_message)(message, room_id, session_id)
+    async def get_messages_since(room_id, last_seq):
+        return await sync_to_async(MongoService.get_messages_since)(room_id, last_seq)
 
     @staticmethod
     async def get_room_by_id(room_id):
         return await sync_to_async(MongoService.get_room_by_id)(room_id)
-
-    @staticmethod
-    async def join_second_user(room: ChatRoom):
-        await sync_to_async(room.join_second_user)()
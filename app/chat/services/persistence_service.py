@@ -0,0 +1,197 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django_redis import get_redis_connection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from redis.exceptions import ResponseError
+
+from chat import analytics, events
+from chat.models import ChatRoom, Message
+
+DUPLICATE_KEY = 11000
+
+
+class PersistenceService:
+    """
+    Persists the room events log into Mongo, run by the persist_events workers.
+    Events are read through a consumer group and acknowledged only after their batch is written, so a batch
+    that fails (or whose worker dies) stays pending and is claimed again by any worker after
+    CHAT_EVENTS_RETRY_AFTER seconds. Events delivered CHAT_EVENTS_MAX_DELIVERIES times are moved to the
+    dead letter stream. All writes are idempotent, a retried batch doesn't duplicate anything.
+    """
+
+    @staticmethod
+    def ensure_group(redis):
+        try:
+            redis.xgroup_create(events.STREAM_KEY, events.GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    @staticmethod
+    def claim_stale(redis, consumer: str, count: int) -> list:
+        """Claims events left pending by failed batches or stopped workers, dead-letters the ones failing repeatedly."""
+        retry_after = settings.CHAT_EVENTS_RETRY_AFTER * 1000
+        pending = redis.xpending_range(events.STREAM_KEY, events.GROUP, '-', '+', count, idle=retry_after)
+        if not pending:
+            return []
+
+        dead = [p['message_id'] for p in pending if p['times_delivered'] >= settings.CHAT_EVENTS_MAX_DELIVERIES]
+        retry = [p['message_id'] for p in pending if p['times_delivered'] < settings.CHAT_EVENTS_MAX_DELIVERIES]
+
+        if dead:
+            entries = redis.xclaim(events.STREAM_KEY, events.GROUP, consumer, retry_after, dead)
+            pipe = redis.pipeline()
+            for entry_id, fields in entries:
+                print(f'DEAD EVENT {entry_id.decode()}: {events.decode(fields)}')
+                pipe.xadd(events.DEAD_LETTER_KEY, fields)
+            pipe.xack(events.STREAM_KEY, events.GROUP, *dead)
+            pipe.xdel(events.STREAM_KEY, *dead)
+            pipe.execute()
+
+        if not retry:
+            return []
+        return redis.xclaim(events.STREAM_KEY, events.GROUP, consumer, retry_after, retry)
+
+    @staticmethod
+    def read(redis, consumer: str, count: int, block: int = None) -> list:
+        """Returns a batch of events for this consumer, retries of stale pending events first."""
+        entries = PersistenceService.claim_stale(redis, consumer, count)
+        if entries:
+            return entries
+        response = redis.xreadgroup(events.GROUP, consumer, {events.STREAM_KEY: '>'}, count=count, block=block)
+        return response[0][1] if response else []
+
+    @staticmethod
+    def ack(redis, entry_ids: list):
+        """Acknowledges and removes persisted events, the stream only holds events not persisted yet."""
+        pipe = redis.pipeline()
+        pipe.xack(events.STREAM_KEY, events.GROUP, *entry_ids)
+        pipe.xdel(events.STREAM_KEY, *entry_ids)
+        pipe.execute()
+
+    @staticmethod
+    def persist(batch: list[dict]):
+        """
+        Writes a batch of events with one bulk write per collection.
+        Messages are upserted by (room, seq), messages of rooms that no longer exist are dropped,
+        sessions joining or writing in a room are added to its session_ids (moderation lookups),
+        ended rooms are marked inactive after the rest of the batch and kept, with their messages, for
+        CHAT_MODERATION_RETENTION_DAYS. Rooms ended longer ago are purged then.
+        """
+        room_ids = set()
+        for event in batch:
+            try:
+                event['room_oid'] = ObjectId(event['room'])
+            except (InvalidId, TypeError):
+                print(f'EVENT WITH INVALID ROOM: {event}')
+                continue
+            room_ids.add(event['room_oid'])
+
+        rooms = {
+            room.id: room for room in
+            ChatRoom.objects(id__in=list(room_ids))
+            .only('topic', 'creator_gender', 'search_gender', 'second_user_joined', 'session_ids', 'is_active')
+        }
+
+        message_operations = []
+        message_rooms = []
+        joined = set()
+        ended = set()
+        sessions = {}
+        for event in batch:
+            room = rooms.get(event.get('room_oid'))
+            if room is None:
+                continue
+
+            if event['type'] in (events.MESSAGE, events.JOIN) and event['session'] not in room.session_ids:
+                sessions.setdefault(room.id, set()).add(event['session'])
+
+            if event['type'] == events.MESSAGE:
+                seq = int(event['seq'])
+                message_operations.append(UpdateOne(
+                    {'room': room.id, 'seq': seq},
+                    {'$setOnInsert': {
+                        'room': room.id,
+                        'seq': seq,
+                        'session_id': event['session'],
+                        'content': event['content'],
+                        'timestamp': datetime.fromtimestamp(float(event['ts'])),
+                    }},
+                    upsert=True
+                ))
+                message_rooms.append(room)
+            elif event['type'] == events.JOIN and not room.second_user_joined:
+                joined.add(room.id)
+            elif event['type'] == events.END_CHAT and room.is_active:
+                ended.add(room.id)
+
+        if message_operations:
+            try:
+                upserted = Message._get_collection().bulk_write(message_operations, ordered=False).upserted_ids
+            except BulkWriteError as e:
+                # Another persister claimed the same events and inserted them first, (room, seq) is unique
+                if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                    raise
+                upserted = [upsert['index'] for upsert in e.details['upserted']]
+            saved = Counter(message_rooms[index].id for index in upserted)
+            for room_id, count in saved.items():
+                analytics.record(analytics.MESSAGE_SAVED, rooms[room_id], amount=count)
+
+        if sessions:
+            ChatRoom._get_collection().bulk_write([
+                UpdateOne({'_id': room_id}, {'$addToSet': {'session_ids': {'$each': sorted(session_ids)}}})
+                for room_id, session_ids in sessions.items()
+            ], ordered=False)
+
+        if joined:
+            ChatRoom._get_collection().update_many(
+                {'_id': {'$in': list(joined)}, 'second_user_joined': False},
+                {'$set': {'second_user_joined': True}}
+            )
+            for room_id in joined:
+                analytics.record(analytics.ROOM_JOINED, rooms[room_id])
+
+        if ended:
+            ChatRoom._get_collection().update_many(
+                {'_id': {'$in': list(ended)}, 'is_active': True},
+                {'$set': {'is_active': False, 'ended_at': datetime.now()}}
+            )
+            for room_id in ended:
+                analytics.record(analytics.ROOM_DELETED, rooms[room_id])
+                print(f'ROOM {room_id} ENDED')
+            PersistenceService.purge_expired()
+
+    @staticmethod
+    def purge_expired(now: datetime = None) -> int:
+        """
+        Deletes the rooms ended more than CHAT_MODERATION_RETENTION_DAYS ago with their messages.
+        Messages go first, a purge stopped halfway leaves rooms to be found by the next one.
+        """
+        cutoff = (now or datetime.now()) - timedelta(days=settings.CHAT_MODERATION_RETENTION_DAYS)
+        expired = ChatRoom._get_collection().distinct('_id', {'ended_at': {'$lt': cutoff}})
+        if expired:
+            Message._get_collection().delete_many({'room': {'$in': expired}})
+            ChatRoom._get_collection().delete_many({'_id': {'$in': expired}})
+            print(f'PURGED {len(expired)} ENDED ROOMS')
+        return len(expired)
+
+    @staticmethod
+    def process(consumer: str, count: int = None, block: int = None) -> int:
+        """
+        Reads, persists and acknowledges one batch. Returns number of processed events.
+        If persisting fails the batch is left pending and retried later.
+        """
+        redis = get_redis_connection('default')
+        PersistenceService.ensure_group(redis)
+        entries = PersistenceService.read(redis, consumer, count or settings.CHAT_EVENTS_BATCH_SIZE, block)
+        if not entries:
+            return 0
+
+        PersistenceService.persist([events.decode(fields) for _, fields in entries])
+        PersistenceService.ack(redis, [entry_id for entry_id, _ in entries])
+        return len(entries)
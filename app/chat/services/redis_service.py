@@ -1,7 +1,34 @@
+from itertools import chain
+
+from django.conf import settings
 from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from chat import events, lifecycle, matchmaking
+from chat.tracing import trace_methods
+
+# Gives the message the next room sequence and appends it to the recent history (entry id is the sequence)
+# and to the events log in one step, so concurrent senders never write history entries out of order.
+# KEYS[1] sequence, KEYS[2] history stream, KEYS[3] events stream,
+# ARGV[1] history max length, ARGV[2] message, ARGV[3] session id, ARGV[4:] event fields except the sequence
+APPEND_MESSAGE = AsyncScript(None, b"""
+local seq = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], seq .. '-0', 'message', ARGV[2], 'session_id', ARGV[3])
+local fields = {}
+for i = 4, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+fields[#fields + 1] = 'seq'
+fields[#fields + 1] = seq
+redis.call('XADD', KEYS[3], '*', unpack(fields))
+return seq
+""")
 
 
+@trace_methods('redis')
 class RedisService:
+    __slots__ = ('redis', 'room_id', 'session_id')
+
     def __init__(self, redis, room_id, session_id):
         self.redis: Redis = redis
         self.room_id = room_id
@@ -29,12 +56,103 @@ class RedisService:
     async def session_ids_count(self) -> int:
         return await self.redis.scard(f'sessions:{self.room_id}')
 
-    async def close_redis(self):
-        await self.redis.close()
-        print(f'REDIS CLOSED FOR SESSION ID {self.session_id}')
+    async def get_session_ids(self) -> list[str]:
+        return [session_id.decode() for session_id in await self.redis.smembers(f'sessions:{self.room_id}')]
+
+    def queue_redis_data_deletion(self, pipe, session_ids: list[str]):
+        """Queues deletion of the room keys and of the connection markers of its sessions."""
+        pipe.delete(f'sessions:{self.room_id}', f'users_count:{self.room_id}', f'seq:{self.room_id}',
+                    f'history:{self.room_id}', lifecycle.state_key(self.room_id),
+                    *(f'session:{session_id}:connections' for session_id in session_ids))
+        pipe.eval(matchmaking.DEQUEUE_SCRIPT, 1, matchmaking.WAITING_KEY, self.room_id)
+        pipe.zrem('room_removals', self.room_id)
 
     async def delete_redis_data(self):
-        await self.redis.delete(f'sessions:{self.room_id}', f'users_count:{self.room_id}')
+        pipe = self.redis.pipeline(transaction=False)
+        self.queue_redis_data_deletion(pipe, await self.get_session_ids())
+        await pipe.execute()
+
+    async def get_room_state(self) -> str:
+        state = await self.redis.get(lifecycle.state_key(self.room_id))
+        return state.decode() if state else lifecycle.CLOSED
+
+    async def transition(self, to_state: str, *from_states: str) -> bool:
+        """Moves the room to to_state if it is in one of from_states. Returns True only for the caller that moved it."""
+        return bool(await lifecycle.TRANSITION(
+            keys=[lifecycle.state_key(self.room_id)], args=[to_state, *from_states], client=self.redis
+        ))
+
+    async def claim_client_message(self, client_id: str) -> bool:
+        """Returns False if a message with this client id was already received within the dedup window."""
+        return bool(await self.redis.set(f'client_message:{self.room_id}:{client_id}', 0, nx=True,
+                                         ex=settings.CHAT_MESSAGE_DEDUP_WINDOW))
+
+    async def release_client_message(self, client_id: str):
+        await self.redis.delete(f'client_message:{self.room_id}:{client_id}')
+
+    async def set_client_message_seq(self, client_id: str, seq: int):
+        await self.redis.set(f'client_message:{self.room_id}:{client_id}', seq, xx=True, keepttl=True)
+
+    async def get_client_message_seq(self, client_id: str) -> int | None:
+        """Returns sequence of an already received message, None while it is still being saved."""
+        seq = int(await self.redis.get(f'client_message:{self.room_id}:{client_id}') or 0)
+        return seq or None
+
+    async def schedule_removal(self, deadline: float):
+        """Stores user removal deadline in shared storage, so any worker can run it."""
+        await self.redis.zadd('room_removals', {self.room_id: deadline})
+
+    async def cancel_removal(self):
+        await self.redis.zrem('room_removals', self.room_id)
+
+    async def claim_removal(self) -> bool:
+        """Returns True only for the single caller that removed the pending deadline."""
+        return bool(await self.redis.zrem('room_removals', self.room_id))
+
+    @staticmethod
+    async def claim_due_removals(redis: Redis, now: float) -> list[str]:
+        """Claims room removals with deadline before now, returns claimed room ids."""
+        claimed = []
+        for room_id in await redis.zrangebyscore('room_removals', 0, now):
+            if await redis.zrem('room_removals', room_id):
+                claimed.append(room_id.decode())
+        return claimed
+
+    async def get_last_message_seq(self) -> int:
+        seq = await self.redis.get(f'seq:{self.room_id}')
+        return int(seq) if seq else 0
+
+    async def append_message(self, message: str, session_id: str) -> int:
+        """Adds message to the recent history and the events log under the next room sequence, returns it."""
+        fields = events.event_fields(events.MESSAGE, self.room_id, session_id, content=message)
+        return await APPEND_MESSAGE(
+            keys=[f'seq:{self.room_id}', f'history:{self.room_id}', events.STREAM_KEY],
+            args=[settings.CHAT_HISTORY_STREAM_MAXLEN, message, session_id, *chain.from_iterable(fields.items())],
+            client=self.redis,
+        )
+
+    async def history_since(self, last_seq: int) -> list[dict] | None:
+        """
+        Returns messages with sequence greater than last_seq from the recent history stream.
+        Returns None if the stream does not cover the whole range (trimmed or written elsewhere).
+        """
+        current_seq = await self.get_last_message_seq()
+        if current_seq <= last_seq:
+            return []
+
+        entries = await self.redis.xrange(f'history:{self.room_id}', min=f'{last_seq + 1}-0')
+        if len(entries) != current_seq - last_seq:
+            return None
+
+        return [{
+            'seq': int(entry_id.split(b'-')[0]),
+            'message': fields[b'message'].decode(),
+            'session_id': fields[b'session_id'].decode(),
+        } for entry_id, fields in entries]
+
+    async def publish_event(self, event_type: str, **fields):
+        """Appends a room event to the events log, persisted to Mongo by the persist_events workers."""
+        await self.redis.xadd(events.STREAM_KEY, events.event_fields(event_type, self.room_id, self.session_id, **fields))
 
     async def users_exists(self) -> bool:
         return await self.redis.exists(f'users_count:{self.room_id}')
@@ -43,7 +161,12 @@ class RedisService:
         return await self.redis.exists(f'session:{self.session_id}:connections')
 
     async def mark_as_connected(self):
+        # Expires unless refreshed by heartbeats, so a dead connection can't block reconnects
         await self.redis.incr(f'session:{self.session_id}:connections')
+        await self.refresh_connected()
+
+    async def refresh_connected(self):
+        await self.redis.expire(f'session:{self.session_id}:connections', settings.CHAT_IDLE_TIMEOUT)
 
     async def unmark_as_connected(self):
         await self.redis.delete(f'session:{self.session_id}:connections')
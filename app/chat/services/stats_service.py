@@ -0,0 +1,111 @@
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django_redis import get_redis_connection
+from pymongo import UpdateOne
+from redis.exceptions import ResponseError
+
+from chat.analytics import PENDING_KEY
+from chat.models import StatsRollup
+
+FLUSHING_PREFIX = 'stats:flushing:'
+FLUSH_LOCK_KEY = 'stats:flush_lock'
+FLUSH_LOCK_TTL = 300
+
+# Adds the counters of a flushing hash back to the pending ones and deletes it. KEYS[1] flushing, KEYS[2] pending
+MERGE_BACK_SCRIPT = """
+local counters = redis.call('HGETALL', KEYS[1])
+for i = 1, #counters, 2 do
+    redis.call('HINCRBY', KEYS[2], counters[i], counters[i + 1])
+end
+redis.call('DEL', KEYS[1])
+return #counters / 2
+"""
+
+
+def parse_field(field: bytes) -> tuple[datetime, str, str, str] | None:
+    """(hour, event, topic, gender bucket) of a counter field, None for fields that can't be parsed"""
+    try:
+        hour, event, topic, gender_bucket = json.loads(field)
+        return datetime.strptime(hour, '%Y-%m-%dT%H'), event, topic, gender_bucket
+    except (ValueError, TypeError):
+        return None
+
+
+class StatsService:
+
+    @staticmethod
+    def flush() -> int:
+        """
+        Moves pending Redis counters into the Mongo stats collection.
+        The pending hash is renamed first, so counters recorded meanwhile go to a new hash and nothing is lost.
+        If the write fails the counters are merged back into the pending ones, counters of a flush that died
+        midway are merged back by the next flush. Flushes run one at a time.
+        Returns number of flushed rollup rows.
+        """
+        redis = get_redis_connection('default')
+        if not redis.set(FLUSH_LOCK_KEY, 1, nx=True, ex=FLUSH_LOCK_TTL):
+            return 0  # another flush is running
+        try:
+            StatsService.merge_back_leftovers(redis)
+            return StatsService.flush_pending(redis)
+        finally:
+            redis.delete(FLUSH_LOCK_KEY)
+
+    @staticmethod
+    def merge_back_leftovers(redis):
+        """Returns counters of flushes that died midway to the pending hash, runs under the flush lock."""
+        for key in redis.scan_iter(f'{FLUSHING_PREFIX}*'):
+            merged = redis.eval(MERGE_BACK_SCRIPT, 2, key, PENDING_KEY)
+            print(f'STATS MERGED BACK: {merged} COUNTERS FROM {key.decode()}')
+
+    @staticmethod
+    def flush_pending(redis) -> int:
+        flushing_key = f'{FLUSHING_PREFIX}{uuid.uuid4().hex}'
+        try:
+            redis.rename(PENDING_KEY, flushing_key)
+        except ResponseError:  # no pending counters
+            return 0
+
+        try:
+            operations = []
+            for field, count in redis.hgetall(flushing_key).items():
+                parsed = parse_field(field)
+                if parsed is None:
+                    print(f'INVALID STATS COUNTER DROPPED: {field!r} {int(count)}')
+                    continue
+                hour, event, topic, gender_bucket = parsed
+                operations.append(UpdateOne(
+                    {
+                        'hour': hour,
+                        'event': event,
+                        'topic': topic,
+                        'gender_bucket': gender_bucket,
+                    },
+                    {'$inc': {'count': int(count)}},
+                    upsert=True
+                ))
+            if operations:
+                StatsRollup._get_collection().bulk_write(operations, ordered=False)
+        except Exception:
+            redis.eval(MERGE_BACK_SCRIPT, 2, flushing_key, PENDING_KEY)
+            raise
+        redis.delete(flushing_key)
+        return len(operations)
+
+    @staticmethod
+    def get_rollups(hours: int = 24, event: str = None, topic: str = None) -> list[dict]:
+        since = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0) - timedelta(hours=hours)
+        rollups = StatsRollup.objects.filter(hour__gte=since).order_by('hour')
+        if event:
+            rollups = rollups.filter(event=event)
+        if topic:
+            rollups = rollups.filter(topic=topic)
+        return [{
+            'hour': rollup.hour.strftime('%Y-%m-%dT%H:00'),
+            'event': rollup.event,
+            'topic': rollup.topic,
+            'gender_bucket': rollup.gender_bucket,
+            'count': rollup.count,
+        } for rollup in rollups]
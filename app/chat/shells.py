@@ -0,0 +1,78 @@
+import re
+
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.autoreload import file_changed
+from django.utils.html import conditional_escape
+
+SLOT_RE = re.compile(r'__slot_(\w+?)__')
+
+shells = []
+
+
+def slot(name):
+    """Placeholder rendered into the shell in place of a per-request value"""
+    return f'__slot_{name}__'
+
+
+class PageShell:
+    """
+    Page template rendered once per language with slots for the per-request values.
+    Serving it is a join of the cached fragments and the escaped values instead of a template render.
+    """
+
+    def __init__(self, template_name, context=None):
+        self.template_name = template_name
+        self.context = dict(context or {}, csrf_token=slot('csrf_token'))
+        self.fragments = {}
+        shells.append(self)
+
+    def get_fragments(self):
+        language = translation.get_language()
+        fragments = self.fragments.get(language)
+        if fragments is None:
+            html = get_template(self.template_name).render(self.context)
+            # Literal text at even indexes, slot names at odd ones
+            fragments = self.fragments[language] = SLOT_RE.split(html)
+        return fragments
+
+    def render(self, request, **values):
+        values['csrf_token'] = get_token(request)
+        fragments = self.get_fragments()
+        parts = fragments.copy()
+        for i in range(1, len(parts), 2):
+            parts[i] = conditional_escape(values[parts[i]])
+        return ''.join(parts)
+
+    def response(self, request, **values):
+        return HttpResponse(self.render(request, **values))
+
+    def clear(self):
+        self.fragments = {}
+
+
+def clear_shells():
+    for shell in shells:
+        shell.clear()
+
+
+@receiver(file_changed, dispatch_uid='chat_shells_template_changed')
+def template_changed(sender, file_path, **kwargs):
+    # The autoreloader resets cached template loaders without a restart, shells follow them
+    if file_path.suffix == '.html':
+        clear_shells()
+
+
+index_shell = PageShell('index.html', {
+    'request': {'path': slot('path')},
+})
+
+room_shell = PageShell('room.html', {
+    'room_id': slot('room_id'),
+    'session_key': slot('session_key'),
+    'heartbeat_interval': slot('heartbeat_interval'),
+    'filter_data': {key: slot(key) for key in ('my_gender', 'search_gender', 'topic')},
+})
@@ -15,34 +15,7 @@ function getCookie(name) {
     }
 
 function startNewChat(my_gender, search_gender, topic) {
-    fetch('/chat/search', {
-        method: 'POST',
-        headers: {
-            'X-CSRFToken': csrftoken, 'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            my_gender: my_gender,
-            search_gender: search_gender,
-            topic: topic
-        })
-    })
-        .then(response => response.json())
-        .then(data => {
-                if (data.status === 'success') {
-                    console.log('Room ID:', data.room_id);
-                    handleSearchResponse(data);
-                } else {
-                    console.error('Error:', data.message);
-                }
-            }
-        );
-
-    function handleSearchResponse(data) {
-        if (data.room_id.length > 0) {
-            window.location.href = '/chat/room/' + data.room_id;
-        } else {
-            alert("No room was found");
-        }
-    }
+    // The room page searches over its lobby socket, no request before the page
+    const filters = new URLSearchParams({my_gender: my_gender, search_gender: search_gender, topic: topic});
+    window.location.href = '/chat/room/?' + filters;
 }
-
@@ -1,10 +1,62 @@
+import asyncio
+import base64
+import gzip
 import json
+import os
+import re
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-from django.test import TestCase, Client
+import brotli
+from asgiref.sync import async_to_sync, sync_to_async
+from autobahn.websocket.compress import PerMessageDeflateOffer
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
+from django_redis import get_redis_connection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from redis.asyncio.client import Pipeline as AsyncPipeline, Redis as AsyncRedis
 
-from .models import ChatRoom, search_chat_room, create_chat_room
-from datetime import datetime
+from benchmarks import startup
+from chat import analytics, bans, events, frames, lifecycle, matchmaking, metrics, tracing, views
+from chat.consumers import ChatConsumer
+from chat.content_filter import ContentFilter, ReloadingContentFilter
+from chat.drain import controller
+from chat.heartbeat import ConnectionRegistry
+from chat.matchmaking import WAITING_KEY, MATCH_TIMES_KEY, pair_waiting, match_now, scheduler
+from chat.outbound import OutboundQueue, SlowConsumerError
+from chat.services.chat_service import ChatService
+from chat.services.moderation_service import ModerationService
+from chat.services.persistence_service import PersistenceService
+from chat.services.stats_service import StatsService
+from chat.shells import clear_shells
+from chat.tracing import tracer
+from config import mongo
+from config.asgi import websocket_urlpatterns
+from config.redis_pool import get_redis
+from config.server import SendBackpressure, accept_deflate, report_status
+from config.static_files import StaticFilesApp
+from config.supervisor import Supervisor
+from .models import ChatRoom, Message, StatsRollup, search_chat_room, create_chat_room
+
+
+def waiting_keys() -> list:
+    """Waiting searchers and their bucket indexes"""
+    return [WAITING_KEY, *get_redis_connection('default').keys('waiting:*')]
 
 
 class ChatRoomModelTest(TestCase):
@@ -144,6 +196,7 @@ class ChatRoomSearchTest(TestCase):
 class IndexViewTests(TestCase):
     def setUp(self):
         """Setups Client for views tests."""
+        clear_shells()
         self.client = Client()
 
     def test_index_view_template(self):
@@ -155,6 +208,7 @@ class IndexViewTests(TestCase):
 
 class SearchOrCreateChatRoomTests(TestCase):
     def setUp(self):
+        get_redis_connection('default').delete(*waiting_keys())
         self.client = Client()
         self.topic = "chat"
         self.gender = "male"
@@ -206,3 +260,1406 @@ class SearchOrCreateChatRoomTests(TestCase):
     def tearDownClass(cls):
         """DB clear after tests."""
         ChatRoom.objects.all().delete()
+
+
+class MessageSequenceTests(TestCase):
+    def setUp(self):
+        get_redis_connection('default').delete(events.STREAM_KEY)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+        self.room_id = str(self.room.id)
+
+    async def test_sequence_is_monotonic(self):
+        """Tests that every saved message gets the next room sequence number."""
+        chat_service = ChatService(redis=await get_redis(), room_id=self.room_id, session_id='s1')
+        seqs = [await chat_service.store_message(f'msg {i}', self.room_id, 's1') for i in range(3)]
+        await chat_service.delete_redis_data()
+
+        self.assertEqual(seqs, [1, 2, 3])
+
+    async def test_concurrent_messages_keep_history_in_order(self):
+        """Tests that messages sent at once are all stored, history and events log agreeing on their sequences."""
+        redis = await get_redis()
+        services = [ChatService(redis=redis, room_id=self.room_id, session_id=f's{i % 2}') for i in range(50)]
+        seqs = await asyncio.gather(*(service.store_message(f'msg {i}', self.room_id, service.session_id)
+                                      for i, service in enumerate(services)))
+        history = await redis.xrange(f'history:{self.room_id}')
+        logged = [events.decode(fields) for _, fields in await redis.xrange(events.STREAM_KEY)]
+        await services[0].delete_redis_data()
+
+        self.assertEqual(sorted(seqs), list(range(1, 51)))
+        self.assertEqual([int(entry_id.split(b'-')[0]) for entry_id, _ in history], list(range(1, 51)))
+        self.assertEqual({(event['seq'], event['content']) for event in logged},
+                         {(str(seq), f'msg {i}') for i, seq in enumerate(seqs)})
+
+    async def test_missed_messages_from_history_stream(self):
+        """Tests that only messages after last seen sequence are returned on reconnect."""
+        chat_service = ChatService(redis=await get_redis(), room_id=self.room_id, session_id='s1')
+        for i in range(1, 4):
+            await chat_service.store_message(f'msg {i}', self.room_id, 's1')
+
+        missed = await chat_service.get_missed_messages(1)
+        nothing_missed = await chat_service.get_missed_messages(3)
+        await chat_service.delete_redis_data()
+
+        self.assertEqual([m['seq'] for m in missed], [2, 3])
+        self.assertEqual([m['message'] for m in missed], ['msg 2', 'msg 3'])
+        self.assertEqual(nothing_missed, [])
+
+    async def test_retried_message_is_saved_once(self):
+        """Tests that a message resent with the same client id is acknowledged with the original sequence."""
+        chat_service = ChatService(redis=await get_redis(), room_id=self.room_id, session_id='s1')
+        first = await chat_service.ingest_message('hello', self.room_id, 's1', client_id='c1')
+        retry = await chat_service.ingest_message('hello', self.room_id, 's1', client_id='c1')
+        other = await chat_service.ingest_message('hello', self.room_id, 's1', client_id='c2')
+        await chat_service.redis.delete(f'client_message:{self.room_id}:c1', f'client_message:{self.room_id}:c2')
+        await chat_service.delete_redis_data()
+
+        await sync_to_async(PersistenceService.process)('test')
+
+        self.assertEqual(first, (1, True))
+        self.assertEqual(retry, (1, False))
+        self.assertEqual(other, (2, True))
+        self.assertEqual(await sync_to_async(Message.objects.count)(), 2)
+
+    def test_posted_message_deduplicated_like_websocket_messages(self):
+        """Tests that post_message dedups retries by client id and ignores client ids the websocket rejects."""
+        def post(client_id):
+            response = Client().post(reverse('post_message'), json.dumps({
+                'room_id': self.room_id, 'session_id': 's1', 'content': 'hello', 'client_id': client_id,
+            }), content_type='application/json')
+            return response.json()
+
+        first, retry = post('c1'), post('c1')
+        oversized = [post('x' * 65)['seq'] for _ in range(2)]
+        get_redis_connection('default').delete(f'client_message:{self.room_id}:c1', f'seq:{self.room_id}',
+                                               f'history:{self.room_id}')
+
+        self.assertEqual((first['seq'], retry), (1, {'status': 'success', 'duplicate': True, 'seq': 1}))
+        self.assertEqual(oversized, [2, 3])
+
+    async def test_missed_messages_fallback_to_mongo(self):
+        """Tests that missed messages are loaded from Mongo when the history stream was trimmed."""
+        chat_service = ChatService(redis=await get_redis(), room_id=self.room_id, session_id='s1')
+        for i in range(1, 4):
+            await chat_service.store_message(f'msg {i}', self.room_id, 's1')
+        await sync_to_async(PersistenceService.process)('test')
+        await chat_service.redis.delete(f'history:{self.room_id}')
+
+        missed = await chat_service.get_missed_messages(1)
+        await chat_service.delete_redis_data()
+
+        self.assertEqual([m['seq'] for m in missed], [2, 3])
+
+    def tearDown(self):
+        Message.objects.all().delete()
+        ChatRoom.objects.all().delete()
+
+
+class IdleConsumer:
+    """Minimal consumer stand-in recording reaps."""
+
+    def __init__(self):
+        self.reaped = False
+
+    async def reap(self):
+        self.reaped = True
+
+
+@override_settings(CHAT_IDLE_TIMEOUT=60)
+class ConnectionRegistryTests(TestCase):
+    async def test_sweep_reaps_only_idle_connections(self):
+        """Tests that connections idle beyond the timeout are reaped and counted."""
+        registry = ConnectionRegistry()
+        idle, active = IdleConsumer(), IdleConsumer()
+        registry.last_seen = {idle: 0, active: 100}
+        reaped_before = metrics.get('connections_reaped')
+
+        reaped = await registry.sweep(now=120)
+
+        self.assertEqual(reaped, [idle])
+        self.assertTrue(idle.reaped)
+        self.assertFalse(active.reaped)
+        self.assertNotIn(idle, registry.last_seen)
+        self.assertEqual(metrics.get('connections_reaped'), reaped_before + 1)
+
+    async def test_touch_keeps_connection_alive(self):
+        """Tests that a heartbeat refreshes last seen time."""
+        registry = ConnectionRegistry()
+        consumer = IdleConsumer()
+        registry.last_seen = {consumer: 0}
+
+        registry.touch(consumer)
+        reaped = await registry.sweep()
+
+        self.assertEqual(reaped, [])
+
+    @override_settings(CHAT_HEARTBEAT_INTERVAL=0.01)
+    async def test_due_removals_run_without_connections(self):
+        """Tests that removals scheduled by the worker still run after its last connection closed."""
+        registry = ConnectionRegistry()
+        consumer = IdleConsumer()
+        registry.register(consumer)
+        registry.unregister(consumer)
+        redis = await get_redis()
+        await redis.zadd('room_removals', {'removal-room': time.time() - 1})
+        try:
+            with mock.patch.object(ChatService, 'remove_left_user') as remove_left_user:
+                for _ in range(100):
+                    await asyncio.sleep(0.01)
+                    if remove_left_user.called:
+                        break
+            self.assertTrue(registry.sweeper.done())
+            remove_left_user.assert_called_once_with()
+            self.assertEqual(await redis.zcard('room_removals'), 0)
+        finally:
+            registry.removals.cancel()
+            await redis.delete('room_removals')
+
+
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text_data):
+        self.sent.append(text_data)
+
+    async def test_high_priority_sent_first_and_typing_merged(self):
+        """Tests that chat frames go before typing frames and typing frames are merged."""
+        queue = OutboundQueue(self.send, maxsize=10)
+        queue.put('typing...', OutboundQueue.LOW, merge_key='typing')
+        queue.put('message 1')
+        queue.put('stopped_typing', OutboundQueue.LOW, merge_key='typing')
+        queue.put('message 2')
+
+        await asyncio.sleep(0)
+        queue.close()
+
+        self.assertEqual(self.sent, ['message 1', 'message 2', 'stopped_typing'])
+
+    async def test_low_priority_dropped_when_backlogged(self):
+        """Tests that typing frames are dropped when the queue is half full."""
+        queue = OutboundQueue(self.send, maxsize=4)
+        queue.put('message 1')
+        queue.put('message 2')
+        queue.put('typing...', OutboundQueue.LOW, merge_key='typing')
+
+        self.assertEqual(len(queue), 2)
+        queue.close()
+
+    async def test_overflow_raises_slow_consumer_error(self):
+        """Tests that a full queue reports a slow consumer and stops accepting frames."""
+        queue = OutboundQueue(self.send, maxsize=2)
+        queue.put('message 1')
+        queue.put('message 2')
+
+        with self.assertRaises(SlowConsumerError):
+            queue.put('message 3')
+        queue.put('message 4')
+
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+
+    async def test_paused_transport_holds_frames_and_drops_typing(self):
+        """Tests that nothing is sent while the transport is paused, and typing frames are dropped meanwhile."""
+        backpressure = SendBackpressure()
+        queue = OutboundQueue(self.send, maxsize=10, backpressure=backpressure)
+        backpressure.pauseProducing()
+        queue.put('message 1')
+        queue.put('typing...', OutboundQueue.LOW, merge_key='typing')
+
+        await asyncio.sleep(0)
+        self.assertEqual((self.sent, len(queue)), ([], 1))
+
+        backpressure.resumeProducing()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual(self.sent, ['message 1'])
+        queue.close()
+
+
+def websocket_frame(text: str) -> bytes:
+    """Masked text frame as a client sends it, for payloads under 126 bytes"""
+    payload, mask = text.encode(), os.urandom(4)
+    return struct.pack('!BB', 0x81, 0x80 | len(payload)) + mask + bytes(
+        byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+class SendBackpressureTests(TestCase):
+    """Runs config.server, back-pressure comes from the real websocket transport."""
+    pings = 50000
+
+    def setUp(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        env = {**os.environ, 'CHAT_WS_SEND_BUFFER': '4096', 'PYTHONUNBUFFERED': '1'}
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'config.server', '-b', '127.0.0.1', '-p', str(self.port), '-v', '0',
+             'config.asgi:application'],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    def connect(self) -> socket.socket:
+        deadline = time.monotonic() + 20
+        while True:
+            try:
+                client = socket.create_connection(('127.0.0.1', self.port))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # A client that doesn't read: its receive window and the server's send buffer fill up quickly
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        key = base64.b64encode(os.urandom(16)).decode()
+        client.sendall((f'GET /ws/lobby/ HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\n'
+                        f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n')
+                       .encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            response += client.recv(1)
+        self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+        return client
+
+    def wait_for_output(self, text: str, timeout: float = 30) -> bool:
+        selector = selectors.DefaultSelector()
+        selector.register(self.server.stdout, selectors.EVENT_READ)
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                if selector.select(deadline - time.monotonic()) and text in self.server.stdout.readline():
+                    return True
+        finally:
+            selector.close()
+        return False
+
+    def test_client_not_reading_closed_as_slow_consumer(self):
+        """Tests that pongs pile up in the outbound queue once the transport pauses, and the client is closed."""
+        client = self.connect()
+        ping = websocket_frame(json.dumps({'action': 'ping'}))
+        client.sendall(ping * self.pings)
+
+        self.assertTrue(self.wait_for_output('SLOW CONSUMER'))
+        received = b''
+        client.settimeout(10)
+        try:
+            while chunk := client.recv(65536):
+                received += chunk
+        except ConnectionResetError:
+            pass  # closing handshake timed out, the close frame is stuck behind the unread pongs
+        client.close()
+        self.assertLess(received.count(b'pong'), self.pings)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.communicate()
+
+
+class Session:
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+
+@override_settings(CHAT_DRAIN_RECONNECT_DELAY=(1, 5))
+class RollingRestartTests(TestCase):
+    pairs = 20
+
+    def setUp(self):
+        get_redis_connection('default').delete('room_removals')
+        self.application = URLRouter(websocket_urlpatterns)
+        self.rooms = [create_chat_room(topic='chat', my_gender='male', search_gender='female')
+                      for _ in range(self.pairs)]
+
+    async def connect(self, room, session_key, query=''):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{room.id}/{query}')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def close_by_server(self, communicator):
+        """Reads frames until the server closes the socket, then delivers the disconnect like the server would."""
+        frames = []
+        while True:
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                await communicator.disconnect(code=output.get('code'))
+                return frames, output.get('code')
+            frames.append(json.loads(output['text']))
+
+    async def test_rolling_restart(self):
+        """
+        Tests that draining a worker with many pairs tells every client when to reconnect,
+        keeps rooms and hands user removal deadlines off to Redis, then all pairs resume on a new worker.
+        """
+        communicators = []
+        for i, room in enumerate(self.rooms):
+            communicators.append(await self.connect(room, f'restart-{i}-a'))
+            communicators.append(await self.connect(room, f'restart-{i}-b'))
+        for communicator in communicators:
+            self.assertEqual((await communicator.receive_json_from())['type'], 'second_user_joined')
+
+        drain = asyncio.create_task(controller.drain())
+        closed = await asyncio.gather(*(self.close_by_server(c) for c in communicators))
+        await drain
+
+        delays = set()
+        for frames, code in closed:
+            self.assertEqual(code, 4003)
+            self.assertEqual(frames[-1]['type'], 'reconnect_after')
+            self.assertTrue(1 <= frames[-1]['delay'] <= 5)
+            delays.add(frames[-1]['delay'])
+        self.assertGreater(len(delays), 1, 'Reconnect delays should be jittered')
+
+        self.assertEqual(ChatConsumer.deletion_timers, {})
+        redis = await get_redis()
+        self.assertEqual(await redis.zcard('room_removals'), self.pairs)
+
+        # New connections are turned away while draining
+        late = await self.connect(self.rooms[0], 'restart-0-a')
+        frames, code = await self.close_by_server(late)
+        self.assertEqual((frames[0]['type'], code), ('reconnect_after', 4003))
+
+        # New worker
+        controller.draining = False
+        communicators = []
+        for i, room in enumerate(self.rooms):
+            communicators.append(await self.connect(room, f'restart-{i}-a', '?last_seq=0'))
+            communicators.append(await self.connect(room, f'restart-{i}-b', '?last_seq=0'))
+        for communicator in communicators:
+            self.assertEqual((await communicator.receive_json_from())['type'], 'reconnect')
+
+        self.assertEqual(await redis.zcard('room_removals'), 0)
+        self.assertEqual(await sync_to_async(ChatRoom.objects.count)(), self.pairs)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        for room in self.rooms:
+            await ChatService(redis=redis, room_id=str(room.id), session_id='system').delete_redis_data()
+
+    def tearDown(self):
+        controller.draining = False
+        for timer in ChatConsumer.deletion_timers.values():
+            timer.cancel()
+        ChatConsumer.deletion_timers.clear()
+        ChatRoom.objects.all().delete()
+
+
+class ContentFilterTests(TestCase):
+    def setUp(self):
+        self.content_filter = ContentFilter(['spam', 'спам', 'bad site.com', 'глупак'])
+
+    def test_censor_whole_words(self):
+        """Tests that terms are masked as whole words only."""
+        self.assertEqual(self.content_filter.censor('buy SPAM now'), 'buy **** now')
+        self.assertEqual(self.content_filter.censor('spammer'), 'spammer')
+        self.assertEqual(self.content_filter.censor('hello'), 'hello')
+
+    def test_censor_folds_disguised_terms(self):
+        """Tests that look-alike characters, invisible characters and full width forms are folded."""
+        self.assertEqual(self.content_filter.censor('sp\u0430m'), '****')  # Cyrillic а
+        self.assertEqual(self.content_filter.censor('s\u200bpam!'), '*****!')
+        self.assertEqual(self.content_filter.censor('ｓｐａｍ'), '****')
+        self.assertEqual(self.content_filter.censor('СПАМ и Глупак'), '**** и ******')
+
+    def test_cyrillic_words_not_folded_into_latin_terms(self):
+        """Tests that Cyrillic letters alike only in uppercase don't turn ordinary words into Latin terms."""
+        content_filter = ContentFilter(['hot', 'max', 'bet'])
+        self.assertEqual(content_filter.censor('нот мах вет НОТ'), 'нот мах вет НОТ')
+        self.assertEqual(content_filter.censor('hоt mаx'), '*** ***')  # Cyrillic о and а
+
+    def test_censor_multi_token_terms(self):
+        """Tests links and multi-word terms."""
+        self.assertEqual(self.content_filter.censor('go to bad site.com/x'), 'go to *** ********/x')
+
+    @override_settings(CHAT_BANNED_TERMS_RELOAD_INTERVAL=0)
+    def test_hot_reload(self):
+        """Tests that the process-wide filter picks up terms file changes."""
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('# comment\nfoo\n')
+        try:
+            with self.settings(CHAT_BANNED_TERMS_FILES=[f.name]):
+                banned_terms = ReloadingContentFilter()
+                self.assertEqual(banned_terms.get().censor('foo bar'), '*** bar')
+
+                with open(f.name, 'w') as terms_file:
+                    terms_file.write('bar\n')
+                os.utime(f.name, ns=(0, 1))
+                self.assertEqual(banned_terms.get().censor('foo bar'), 'foo ***')
+        finally:
+            os.unlink(f.name)
+
+
+@override_settings(CHAT_MATCH_RELAXATION=[(20, 'search_gender'), (45, 'topic')])
+class MatchmakingTests(TestCase):
+    @staticmethod
+    def searcher(topic, my_gender, search_gender, enqueued_at):
+        return {'topic': topic, 'my_gender': my_gender, 'search_gender': search_gender, 'enqueued_at': enqueued_at}
+
+    def setUp(self):
+        get_redis_connection('default').delete(*waiting_keys(), MATCH_TIMES_KEY, 'matchmaking_lock')
+
+    def test_strict_pairs(self):
+        """Tests that compatible searchers are paired and the newer one moves to the older one's room."""
+        waiting = {
+            'r1': self.searcher('chat', 'male', 'female', 0),
+            'r2': self.searcher('chat', 'male', 'female', 1),
+            'r3': self.searcher('chat', 'female', 'male', 2),
+            'r4': self.searcher('flirt', 'female', 'male', 3),
+        }
+        self.assertEqual(pair_waiting(waiting, now=5), [('r1', 'r3')])
+
+    def test_constraints_relaxed_by_wait_time(self):
+        """Tests that gender preference and then topic are relaxed after waiting long enough."""
+        waiting = {
+            'r1': self.searcher('chat', 'male', 'female', 0),
+            'r2': self.searcher('chat', 'male', 'female', 0),
+        }
+        self.assertEqual(pair_waiting(waiting, now=10), [])
+        self.assertEqual(pair_waiting(waiting, now=25), [('r1', 'r2')])
+
+        waiting = {
+            'r1': self.searcher('chat', 'male', 'female', 0),
+            'r2': self.searcher('flirt', 'female', 'male', 0),
+        }
+        self.assertEqual(pair_waiting(waiting, now=25), [])
+        self.assertEqual(pair_waiting(waiting, now=50), [('r1', 'r2')])
+
+    def test_match_now_from_waiting_pool(self):
+        """Tests that a new searcher is matched to a waiting room without creating a new one."""
+        room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+
+        self.assertIsNone(match_now('chat', 'male', 'female'))
+        self.assertEqual(match_now('chat', 'female', 'male'), str(room.id))
+        self.assertIsNone(match_now('chat', 'female', 'male'), 'Matched room must leave the waiting pool')
+
+    def test_retried_search_keeps_waiting_room(self):
+        """Tests that repeating a search while waiting does not create another room."""
+        data = json.dumps({'topic': 'chat', 'my_gender': 'male', 'search_gender': 'female'})
+        first = self.client.post(reverse('search'), data, content_type='application/json').json()
+        retry = self.client.post(reverse('search'), data, content_type='application/json').json()
+
+        self.assertEqual(first['room_id'], retry['room_id'])
+        self.assertEqual(ChatRoom.objects.count(), 1)
+
+    async def test_batch_pass_records_time_to_match(self):
+        """Tests that a batch pass matches waiting rooms and records time to match per bucket."""
+        old = await sync_to_async(create_chat_room)(topic='chat', my_gender='male', search_gender='female')
+        new = await sync_to_async(create_chat_room)(topic='chat', my_gender='male', search_gender='female')
+        redis = await get_redis()
+
+        made = await scheduler.run_pass(redis, now=time.time() + 30)
+        match_times = await redis.hgetall(MATCH_TIMES_KEY)
+        waiting = await redis.hlen(WAITING_KEY)
+        await redis.delete('matchmaking_lock')
+
+        self.assertEqual(made, [(str(old.id), str(new.id))])
+        self.assertEqual(match_times, {b'["chat", "male", "female", "<60s"]': b'2'})
+        self.assertEqual(waiting, 0)
+
+    def test_match_now_skips_rooms_whose_creator_left(self):
+        """Tests that a waiting room whose creator never connected is dropped and a connected one is matched."""
+        redis = get_redis_connection('default')
+        gone = create_chat_room(topic='chat', my_gender='male', search_gender='female', session_id='gone')
+        there = create_chat_room(topic='chat', my_gender='male', search_gender='female', session_id='there')
+        for room in (gone, there):
+            matchmaking.enqueue(room, enqueued_at=time.time() - settings.CHAT_MATCH_CONNECT_TIMEOUT - 1)
+        redis.set('session:there:connections', 1, ex=60)
+
+        self.assertEqual(match_now('chat', 'female', 'male'), str(there.id))
+        self.assertFalse(matchmaking.is_waiting(str(gone.id)))
+        self.assertFalse(redis.exists(matchmaking.bucket_key('chat', 'male', 'female')))
+        redis.delete('session:there:connections')
+
+    def test_stats_with_separator_in_topic(self):
+        """Tests that user entered topics containing any separator are counted and reported."""
+        create_chat_room(topic='a|b', my_gender='male', search_gender='female')
+        self.assertIsNotNone(match_now('a|b', 'female', 'male'))
+
+        self.assertEqual(matchmaking.get_stats()['time_to_match'], [
+            {'topic': 'a|b', 'my_gender': 'male', 'search_gender': 'female', 'waited': {'<1s': 1}}
+        ])
+
+    def tearDown(self):
+        get_redis_connection('default').delete(*waiting_keys(), MATCH_TIMES_KEY)
+        ChatRoom.objects.all().delete()
+
+
+class StatsRollupTests(TestCase):
+    def setUp(self):
+        get_redis_connection('default').delete(analytics.PENDING_KEY)
+
+    def test_flush_accumulates_rollups(self):
+        """Tests that room events are counted in Redis and added up in the stats collection on every flush."""
+        room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+        room.join_second_user()
+        analytics.record(analytics.MESSAGE_SAVED, room, amount=3)
+
+        self.assertEqual(StatsService.flush(), 3)
+        self.assertEqual(StatsService.flush(), 0, 'Flushed counters must not be flushed again')
+
+        analytics.record(analytics.MESSAGE_SAVED, room)
+        StatsService.flush()
+
+        counts = {(r['event'], r['topic'], r['gender_bucket']): r['count'] for r in StatsService.get_rollups()}
+        self.assertEqual(counts, {
+            (analytics.ROOM_CREATED, 'chat', 'male>female'): 1,
+            (analytics.ROOM_JOINED, 'chat', 'male>female'): 1,
+            (analytics.MESSAGE_SAVED, 'chat', 'male>female'): 4,
+        })
+
+    def test_failed_flush_keeps_counters(self):
+        """
+        Tests that counters of a failed write and of a flush that died midway are flushed later,
+        and that a topic containing any separator is counted.
+        """
+        redis = get_redis_connection('default')
+        room = create_chat_room(topic='a|b', my_gender='male', search_gender='female')
+        with mock.patch.object(StatsRollup._get_collection(), 'bulk_write', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                StatsService.flush()
+        self.assertEqual(redis.hlen(analytics.PENDING_KEY), 1)
+
+        redis.rename(analytics.PENDING_KEY, 'stats:flushing:died')
+        analytics.record(analytics.ROOM_CREATED, room)
+        redis.hset(analytics.PENDING_KEY, 'not a field', 1)
+        self.assertEqual(StatsService.flush(), 1)
+
+        self.assertFalse(redis.keys('stats:flushing:*'))
+        self.assertEqual([(r['topic'], r['count']) for r in StatsService.get_rollups()], [('a|b', 2)])
+
+    def tearDown(self):
+        get_redis_connection('default').delete(analytics.PENDING_KEY, *waiting_keys())
+        StatsRollup.objects.all().delete()
+        ChatRoom.objects.all().delete()
+
+
+class StaticFilesTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Collected once, brotli at its best quality takes a while
+        cls.static_root = tempfile.TemporaryDirectory()
+        cls.settings_override = override_settings(STATIC_ROOT=cls.static_root.name)
+        cls.settings_override.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def setUp(self):
+        self.app = StaticFilesApp(None)
+
+    def get(self, path, headers=()):
+        async def request():
+            return await HttpCommunicator(self.app, 'GET', path, headers=list(headers)).get_response()
+        return async_to_sync(request)()
+
+    def test_hashed_file_served_precompressed_and_immutable(self):
+        """Tests that collected hashed files are served gzipped with long-lived cache headers and revalidated by etag."""
+        url = staticfiles_storage.url('chat/js/script.js')
+        self.assertNotEqual(url, '/static/chat/js/script.js', 'Static urls must carry the content hash')
+
+        response = self.get(url, [(b'accept-encoding', b'gzip, deflate')])
+        headers = dict(response['headers'])
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(headers[b'content-encoding'], b'gzip')
+        self.assertIn(b'immutable', headers[b'cache-control'])
+        with open(finders.find('chat/js/script.js'), 'rb') as f:
+            self.assertEqual(gzip.decompress(response['body']), f.read())
+
+        response = self.get(url, [(b'if-none-match', headers[b'etag']), (b'accept-encoding', b'gzip')])
+        self.assertEqual(response['status'], 304)
+        self.assertEqual(response['body'], b'')
+
+    def test_brotli_variant_built_and_preferred(self):
+        """Tests that collectstatic writes a .br variant and that it is served when the client accepts brotli."""
+        name = staticfiles_storage.stored_name('chat/js/script.js')
+        self.assertTrue(os.path.isfile(os.path.join(self.static_root.name, name + '.br')))
+
+        response = self.get(staticfiles_storage.url('chat/js/script.js'), [(b'accept-encoding', b'gzip, br')])
+        self.assertEqual(dict(response['headers'])[b'content-encoding'], b'br')
+        with open(finders.find('chat/js/script.js'), 'rb') as f:
+            self.assertEqual(brotli.decompress(response['body']), f.read())
+
+    def test_hashed_file_served_from_memory(self):
+        """Tests that once a hashed file was served, serving it again doesn't touch the file system."""
+        url = staticfiles_storage.url('chat/js/script.js')
+        first = self.get(url, [(b'accept-encoding', b'gzip')])
+        with mock.patch('config.static_files.os.stat') as stat, \
+                mock.patch('config.static_files.os.path.isfile') as isfile, \
+                mock.patch('builtins.open') as open_file:
+            again = self.get(url, [(b'accept-encoding', b'gzip')])
+        self.assertEqual((stat.call_count, isfile.call_count, open_file.call_count), (0, 0, 0))
+        self.assertEqual(again['body'], first['body'])
+
+    def test_unhashed_and_missing_files(self):
+        """Tests that plain names are revalidated, identity is sent when gzip isn't accepted and paths can't escape STATIC_ROOT."""
+        response = self.get('/static/chat/css/room.css')
+        headers = dict(response['headers'])
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(headers[b'cache-control'], b'no-cache')
+        self.assertNotIn(b'content-encoding', headers)
+
+        self.assertEqual(self.get('/static/chat/nothing.css')['status'], 404)
+        self.assertEqual(self.get('/static/../config/settings.py')['status'], 404)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.static_root.cleanup()
+        super().tearDownClass()
+
+
+class PageShellTests(TestCase):
+    CSRF_RE = re.compile(r'name="csrfmiddlewaretoken" value="\w+"')
+
+    def setUp(self):
+        clear_shells()
+        self.client = Client()
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+
+    def test_room_shell_matches_full_render(self):
+        """Tests that the cached room shell with injected values is the same page the template renders."""
+        session = self.client.session
+        session['filter_data'] = {'topic': 'chat', 'my_gender': 'male', 'search_gender': '<female>'}
+        session.save()
+
+        for _ in range(2):
+            response = self.client.get(reverse('room', args=[self.room.id]))
+            self.assertEqual(response.status_code, 200)
+            expected = render_to_string('room.html', {
+                'room_id': str(self.room.id),
+                'session_key': session.session_key,
+                'filter_data': session['filter_data'],
+                'heartbeat_interval': settings.CHAT_HEARTBEAT_INTERVAL,
+            }, response.wsgi_request)
+            self.assertEqual(self.CSRF_RE.sub('', response.content.decode()), self.CSRF_RE.sub('', expected))
+
+    def test_search_page_searches_over_the_lobby(self):
+        """Tests that the search page is the room page without a room, keeping the filters it searches with."""
+        self.client.get(reverse('index'))
+        filters = {'my_gender': 'male', 'search_gender': 'female', 'topic': 'chat'}
+        response = self.client.get(reverse('search_room'), filters)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.session['filter_data'], filters)
+        expected = render_to_string('room.html', {
+            'room_id': '',
+            'session_key': self.client.session.session_key,
+            'filter_data': filters,
+            'heartbeat_interval': settings.CHAT_HEARTBEAT_INTERVAL,
+        }, response.wsgi_request)
+        self.assertEqual(self.CSRF_RE.sub('', response.content.decode()), self.CSRF_RE.sub('', expected))
+        self.assertEqual(ChatRoom.objects.count(), 1, 'The lobby socket searches, not the page')
+
+        self.assertRedirects(self.client.get(reverse('search_room')), reverse('index'), fetch_redirect_response=False)
+
+    def test_shell_cached_per_language(self):
+        """Tests that every language gets its own shell and the injected csrf token is accepted."""
+        english = self.client.get(reverse('index'), HTTP_ACCEPT_LANGUAGE='en').content.decode()
+        bulgarian = self.client.get(reverse('index'), HTTP_ACCEPT_LANGUAGE='bg').content.decode()
+        self.assertNotEqual(english, bulgarian)
+        self.assertNotIn('__slot_', english)
+
+        client = Client(enforce_csrf_checks=True)
+        token = self.CSRF_RE.search(client.get(reverse('index')).content.decode()).group().split('"')[-2]
+        response = client.post(reverse('set_language'), {'language': 'bg', 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 302)
+
+    def tearDown(self):
+        ChatRoom.objects.all().delete()
+
+
+class StartupTests(TestCase):
+    def test_asgi_import_within_budget(self):
+        """Tests that a worker boots within the import budget without connecting to Mongo or importing consumers."""
+        result = startup.measure('config.asgi')
+        self.assertLess(result.import_time, startup.IMPORT_BUDGET)
+        self.assertFalse(result.mongo_connected, 'Mongo must be connected on first query, not at startup')
+        self.assertNotIn('chat.consumers', result.modules)
+
+    def test_health(self):
+        """Tests that the health check reports both connections."""
+        response = self.client.get(reverse('health'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'ok', 'checks': {'mongo': 'ok', 'redis': 'ok'}})
+        self.assertTrue(mongo.is_connected())
+
+
+class PersistenceTests(TestCase):
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        self.redis.delete(events.STREAM_KEY, events.DEAD_LETTER_KEY)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+        self.ended_room = create_chat_room(topic='chat', my_gender='female', search_gender='male')
+
+    async def publish_room_events(self):
+        chat_service = ChatService(redis=await get_redis(), room_id=str(self.room.id), session_id='s1')
+        for i in range(3):
+            await chat_service.store_message(f'msg {i}', chat_service.room_id, 's1')
+        await chat_service.join_second_user()
+
+        ended_service = ChatService(redis=await get_redis(), room_id=str(self.ended_room.id), session_id='s2')
+        await ended_service.store_message('bye', ended_service.room_id, 's2')
+        await ended_service.delete_chat_data()
+        await chat_service.delete_redis_data()
+
+    def test_events_persisted_in_bulk(self):
+        """Tests that one batch saves messages, joins and ended rooms, and that a replayed batch changes nothing."""
+        async_to_sync(self.publish_room_events)()
+        entries = self.redis.xrange(events.STREAM_KEY)
+        self.assertEqual([events.decode(fields)['type'] for _, fields in entries],
+                         ['message'] * 3 + ['join', 'message', 'end_chat'])
+
+        self.assertEqual(PersistenceService.process('test'), 6)
+        self.assertEqual(self.redis.xlen(events.STREAM_KEY), 0, 'Persisted events must be removed from the log')
+
+        PersistenceService.persist([events.decode(fields) for _, fields in entries])
+
+        self.assertEqual([(m.seq, m.content) for m in Message.objects(room=self.room).order_by('seq')],
+                         [(1, 'msg 0'), (2, 'msg 1'), (3, 'msg 2')])
+        self.assertTrue(ChatRoom.objects.get(id=self.room.id).second_user_joined)
+        ended_room = ChatRoom.objects.get(id=self.ended_room.id)
+        self.assertFalse(ended_room.is_active)
+        self.assertIsNotNone(ended_room.ended_at)
+        self.assertFalse(ChatRoom.active(id=self.ended_room.id).first())
+        self.assertEqual(Message.objects(room=self.ended_room.id).count(), 1, 'Kept for moderation')
+
+    def test_concurrent_persisters_save_message_once(self):
+        """
+        Tests that a message inserted by another persister between the upsert's lookup and insert is taken as
+        saved: the unique (room, seq) index turns the second insert into a duplicate key error.
+        """
+        batch = [events.event_fields(events.MESSAGE, str(self.room.id), 's1', seq=seq, content=f'msg {seq}')
+                 for seq in (1, 2)]
+        collection = Message._get_collection()
+        bulk_write = collection.bulk_write
+
+        def racing_bulk_write(operations, ordered):
+            # The other persister's insert lands between this upsert's lookup and its insert
+            message = {'room': self.room.id, 'seq': 1, 'session_id': 's1', 'content': 'msg 1'}
+            collection.insert_one(dict(message))
+            with self.assertRaises(DuplicateKeyError):
+                collection.insert_one(dict(message))
+            bulk_write(operations[1:], ordered=ordered)
+            raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'E11000'}],
+                                  'upserted': [{'index': 1, '_id': None}]})
+
+        with mock.patch.object(collection, 'bulk_write', side_effect=racing_bulk_write), \
+                mock.patch.object(analytics, 'record') as record:
+            PersistenceService.persist(batch)
+        self.assertEqual(Message.objects(room=self.room).count(), 2)
+        record.assert_called_once_with(analytics.MESSAGE_SAVED, mock.ANY, amount=1)
+
+        with mock.patch.object(collection, 'bulk_write', side_effect=BulkWriteError(
+                {'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'Document failed validation'}], 'upserted': []})):
+            with self.assertRaises(BulkWriteError):
+                PersistenceService.persist(batch)
+
+    def test_ended_rooms_purged_after_retention(self):
+        """Tests that ended rooms and their messages are kept for the retention window, then purged."""
+        async_to_sync(self.publish_room_events)()
+        PersistenceService.process('test')
+        ended_at = ChatRoom.objects.get(id=self.ended_room.id).ended_at
+        retention = timedelta(days=settings.CHAT_MODERATION_RETENTION_DAYS)
+
+        self.assertEqual(PersistenceService.purge_expired(ended_at + retention - timedelta(minutes=1)), 0)
+        self.assertEqual(PersistenceService.purge_expired(ended_at + retention + timedelta(minutes=1)), 1)
+        self.assertFalse(ChatRoom.objects(id=self.ended_room.id).first())
+        self.assertEqual(Message.objects(room=self.ended_room.id).count(), 0)
+        self.assertEqual(Message.objects(room=self.room).count(), 3)
+
+    @override_settings(CHAT_EVENTS_RETRY_AFTER=0, CHAT_EVENTS_MAX_DELIVERIES=3)
+    def test_failed_batch_retried_then_dead_lettered(self):
+        """Tests that a failed batch stays pending, is retried, and is moved aside after too many deliveries."""
+        async_to_sync(self.publish_room_events)()
+
+        with mock.patch.object(PersistenceService, 'persist', side_effect=RuntimeError('mongo down')):
+            with self.assertRaises(RuntimeError):
+                PersistenceService.process('worker-1')
+        self.assertEqual(Message.objects.count(), 0)
+
+        self.assertEqual(PersistenceService.process('worker-2'), 6, 'Pending batch must be retried by any worker')
+        self.assertEqual(Message.objects(room=self.room).count(), 3)
+
+        self.redis.xadd(events.STREAM_KEY, events.event_fields(events.MESSAGE, str(self.room.id), 's1', seq=4, content='x'))
+        with mock.patch.object(PersistenceService, 'persist', side_effect=RuntimeError('bad event')):
+            for _ in range(3):
+                with self.assertRaises(RuntimeError):
+                    PersistenceService.process('worker-1')
+        self.assertEqual(PersistenceService.process('worker-1'), 0)
+        self.assertEqual(self.redis.xlen(events.DEAD_LETTER_KEY), 1)
+        self.assertEqual(self.redis.xlen(events.STREAM_KEY), 0)
+
+    def tearDown(self):
+        self.redis.delete(events.STREAM_KEY, events.DEAD_LETTER_KEY, analytics.PENDING_KEY, *waiting_keys())
+        Message.objects.all().delete()
+        ChatRoom.objects.all().delete()
+
+
+class FrameLimitsTests(TestCase):
+    def setUp(self):
+        get_redis_connection('default').delete(events.STREAM_KEY)
+        self.application = URLRouter(websocket_urlpatterns)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+
+    async def connect(self, session_key):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room.id}/')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @override_settings(CHAT_WS_MAX_MESSAGE_SIZE=2048)
+    async def test_oversized_frame_closed_before_parsing(self):
+        """Tests that a frame over the size limit closes the connection without being parsed."""
+        communicator = await self.connect('limits-a')
+        await communicator.send_to(text_data='{"message": "' + 'x' * 4096 + '"}')
+        output = await communicator.receive_output()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1009))
+        await communicator.disconnect(code=1009)
+
+    @override_settings(CHAT_WS_MAX_MESSAGE_SIZE=2048)
+    async def test_size_limit_counts_bytes(self):
+        """Tests that the limit counts encoded bytes, multi-byte text under the limit in characters is rejected."""
+        communicator = await self.connect('limits-a')
+        await communicator.send_to(text_data='{"message": "' + '€' * 1000 + '"}')
+        output = await communicator.receive_output()
+        self.assertEqual((output['type'], output['code']), ('websocket.close', 1009))
+        await communicator.disconnect(code=1009)
+
+    async def test_too_long_message_rejected_before_storage(self):
+        """Tests that messages over the content limit get an error frame and are neither broadcast nor stored."""
+        communicator = await self.connect('limits-a')
+        await communicator.send_json_to({'message': 'x' * 1501, 'room_id': str(self.room.id), 'client_id': 'c1'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['type'], frame['client_id']), ('error', 'c1'))
+
+        await communicator.send_json_to({'message': 'x' * 1500, 'room_id': str(self.room.id)})
+        self.assertEqual(len((await communicator.receive_json_from())['message']), 1500)
+        await communicator.disconnect()
+
+        redis = await get_redis()
+        self.assertEqual(await redis.xlen(events.STREAM_KEY), 2, 'Only the valid message and the ended chat are logged')
+
+    def test_deflate_without_context_takeover(self):
+        """Tests that the deflate offer of a browser is accepted with per-message contexts and a small window."""
+        offer = PerMessageDeflateOffer(accept_no_context_takeover=True, accept_max_window_bits=True)
+        accept = accept_deflate([offer])
+        self.assertTrue(accept.no_context_takeover)
+        self.assertTrue(accept.request_no_context_takeover)
+        self.assertEqual(accept.window_bits, settings.CHAT_WS_COMPRESSION_WINDOW_BITS)
+        self.assertIn('client_max_window_bits', accept.get_extension_string())
+
+    def tearDown(self):
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys())
+        ChatRoom.objects.all().delete()
+
+
+class PreSerializedFrameTests(TestCase):
+    def setUp(self):
+        self.application = URLRouter(websocket_urlpatterns)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+
+    async def connect(self, session_key):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room.id}/')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_frame_forwarded_verbatim(self):
+        """Tests that recipients send the frame encoded by the sender, and events of older workers still work."""
+        a = await self.connect('frames-a')
+        b = await self.connect('frames-b')
+        for communicator in (a, b):
+            await communicator.receive_json_from()  # second_user_joined
+
+        await a.send_json_to({'message': 'здравей', 'room_id': str(self.room.id)})
+        expected = frames.chat_message('здравей', 'frames-a', str(self.room.id), 1)['frame']
+        self.assertEqual(await a.receive_from(), expected)
+        self.assertEqual(await b.receive_from(), expected)
+        self.assertIn('здравей', expected, 'Non-ASCII text must not be escaped')
+
+        layer = get_channel_layer()
+        await layer.group_send(f'chat_{self.room.id}', {
+            'type': 'chat_message', 'message': 'old', 'session_id': 'frames-a', 'room_id': str(self.room.id), 'seq': 2
+        })
+        self.assertEqual((await b.receive_json_from())['message'], 'old')
+
+        await a.disconnect()
+        await b.disconnect()
+
+    def tearDown(self):
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys(), 'room_removals')
+        ChatRoom.objects.all().delete()
+
+
+class RedisCommandCounter:
+    """Counts Redis commands sent by the chat services, channel layer commands are left out."""
+
+    def __init__(self):
+        self.commands = []
+        self.patches = [
+            mock.patch.object(AsyncRedis, 'execute_command', autospec=True, side_effect=self.command(AsyncRedis.execute_command)),
+            mock.patch.object(AsyncPipeline, 'execute', autospec=True, side_effect=self.pipeline(AsyncPipeline.execute)),
+        ]
+
+    def record(self, args):
+        if not any(isinstance(arg, (str, bytes)) and arg[:4] in ('asgi', b'asgi') for arg in args[1:]):
+            self.commands.append((args[0].upper(), *args[1:]))
+
+    def command(self, execute_command):
+        async def counted(client, *args, **options):
+            self.record(args)
+            return await execute_command(client, *args, **options)
+        return counted
+
+    def pipeline(self, execute):
+        async def counted(pipe, *args, **kwargs):
+            for command_args, _ in pipe.command_stack:
+                self.record(command_args)
+            return await execute(pipe, *args, **kwargs)
+        return counted
+
+    def count(self, name: str) -> int:
+        return sum(1 for command in self.commands if command[0] == name)
+
+    def __enter__(self):
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patch in self.patches:
+            patch.stop()
+
+
+class RoomLifecycleTests(TestCase):
+    def setUp(self):
+        get_redis_connection('default').delete(events.STREAM_KEY, 'room_removals')
+        self.application = URLRouter(websocket_urlpatterns)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+        self.room_id = str(self.room.id)
+
+    async def connect(self, session_key):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room_id}/')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def run_ended_chat(self, counter):
+        a = await self.connect('lifecycle-a')
+        b = await self.connect('lifecycle-b')
+        for communicator in (a, b):
+            self.assertEqual((await communicator.receive_json_from())['type'], 'second_user_joined')
+        self.assertEqual(await ChatService(await get_redis(), self.room_id, 'x').get_room_state(), lifecycle.ACTIVE)
+
+        with counter:
+            await a.send_json_to({'action': 'end_chat', 'room_id': self.room_id})
+            for communicator in (a, b):
+                self.assertEqual((await communicator.receive_json_from())['type'], 'end_chat')
+            await a.disconnect()
+            await b.disconnect()
+            # Removal timer of another worker firing late
+            await ChatService(await get_redis(), self.room_id, 'system').remove_left_user()
+
+    def test_teardown_done_once(self):
+        """
+        Tests that ending a chat and both users disconnecting deletes room data, logs the end and
+        ends the room in Mongo once, instead of once per actor.
+        """
+        counter = RedisCommandCounter()
+        async_to_sync(self.run_ended_chat)(counter)
+
+        redis = get_redis_connection('default')
+        self.assertEqual(redis.get(lifecycle.state_key(self.room_id)), lifecycle.CLOSED.encode())
+        self.assertFalse(redis.exists(f'session:lifecycle-a:connections', f'session:lifecycle-b:connections'))
+        self.assertEqual(counter.count('DEL'), 1, counter.commands)
+        self.assertEqual(counter.count('XADD'), 1, counter.commands)
+        self.assertEqual(counter.count('ZADD'), 0, 'No user removal is scheduled for an ended room')
+        self.assertEqual(len(counter.commands), 10, counter.commands)
+
+        collection = ChatRoom._get_collection()
+        with mock.patch.object(collection, 'update_many', wraps=collection.update_many) as room_updates:
+            self.assertEqual(PersistenceService.process('test'), 2)  # join, end
+        self.assertEqual(room_updates.call_count, 2)  # second user joined, ended
+        self.assertFalse(ChatRoom.active(id=self.room.id).first())
+
+    async def test_single_winner_per_transition(self):
+        """Tests that of concurrent actors exactly one activates the room and exactly one ends it."""
+        redis = await get_redis()
+        services = [ChatService(redis, self.room_id, f'actor-{i}') for i in range(5)]
+        joined = await asyncio.gather(*(service.join_second_user() for service in services))
+        ended = await asyncio.gather(*(service.end_room(service.session_id) for service in services))
+        self.assertEqual((sum(joined), sum(ended)), (1, 1))
+        self.assertFalse(await services[0].join_second_user(), 'Closed rooms are never activated again')
+
+        entries = await redis.xrange(events.STREAM_KEY)
+        self.assertEqual([events.decode(fields)['type'] for _, fields in entries], [events.JOIN, events.END_CHAT])
+
+    async def test_ended_room_rejects_connections(self):
+        """Tests that an ended room turns new connections away while it is still in Mongo."""
+        await ChatService(await get_redis(), self.room_id, 'lifecycle-a').end_room('lifecycle-a')
+        communicator = await self.connect('lifecycle-c')
+        self.assertEqual((await communicator.receive_json_from())['type'], 'redirect')
+        await communicator.disconnect(code=4000)
+
+    async def test_room_without_state_is_closed(self):
+        """Tests that a new room is waiting and one whose closed state expired stays closed, not waiting again."""
+        service = ChatService(await get_redis(), self.room_id, 'lifecycle-a')
+        self.assertEqual(await service.get_room_state(), lifecycle.WAITING)
+        await service.end_room('lifecycle-a')
+        await service.redis.delete(lifecycle.state_key(self.room_id))  # CHAT_CLOSED_ROOM_TTL passed
+
+        self.assertEqual(await service.get_room_state(), lifecycle.CLOSED)
+        self.assertFalse(await service.join_second_user())
+        communicator = await self.connect('lifecycle-c')
+        self.assertEqual((await communicator.receive_json_from())['type'], 'redirect')
+        await communicator.disconnect(code=4000)
+
+    def tearDown(self):
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys(), 'room_removals',
+                                               lifecycle.state_key(self.room_id))
+        Message.objects.all().delete()
+        ChatRoom.objects.all().delete()
+
+
+class LobbyTests(TestCase):
+    filters = {'topic': 'chat', 'my_gender': 'male', 'search_gender': 'not-specified'}
+
+    def setUp(self):
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys(), 'room_removals')
+        self.application = URLRouter(websocket_urlpatterns)
+
+    async def connect(self, session_key, query=''):
+        communicator = WebsocketCommunicator(self.application, f'/ws/lobby/{query}')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def search(self, communicator, action='search'):
+        await communicator.send_json_to({'action': action, **self.filters})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'room')
+        return frame['room_id']
+
+    async def test_search_chat_and_next_over_one_connection(self):
+        """Tests that users are matched, chat, and skip to the next partner without reconnecting."""
+        a = await self.connect('lobby-a')
+        b = await self.connect('lobby-b')
+
+        room_id = await self.search(a)
+        self.assertEqual(await self.search(b), room_id, 'Second searcher joins the waiting room')
+        for communicator in (a, b):
+            self.assertEqual((await communicator.receive_json_from())['type'], 'second_user_joined')
+
+        await a.send_json_to({'message': 'hi', 'room_id': 'not-this-one'})
+        for communicator in (a, b):
+            frame = await communicator.receive_json_from()
+            self.assertEqual((frame['message'], frame['room_id'], frame['seq']), ('hi', room_id, 1))
+
+        # a skips to the next partner, b is told the chat ended and c gets matched with a
+        next_room_id = await self.search(a, 'next')
+        self.assertNotEqual(next_room_id, room_id)
+        self.assertEqual((await b.receive_json_from())['type'], 'end_chat')
+        c = await self.connect('lobby-c')
+        self.assertEqual(await self.search(c), next_room_id)
+        for communicator in (a, c):
+            self.assertEqual((await communicator.receive_json_from())['type'], 'second_user_joined')
+
+        redis = await get_redis()
+        self.assertEqual(await ChatService(redis, room_id, 'x').get_room_state(), lifecycle.CLOSED)
+        self.assertEqual(await ChatService(redis, next_room_id, 'x').get_room_state(), lifecycle.ACTIVE)
+        for communicator in (a, b, c):
+            await communicator.disconnect()
+
+    async def test_matched_by_batch_pass(self):
+        """Tests that a connection waiting in its room moves to the partner's room found by the batch pass."""
+        a = await self.connect('lobby-a')
+        waiting_room_id = await self.search(a)
+        partner_room = await sync_to_async(create_chat_room)('chat', 'female', 'male')
+        await get_channel_layer().group_send(f'chat_{waiting_room_id}', frames.matched(str(partner_room.id)))
+
+        self.assertEqual((await a.receive_json_from())['room_id'], str(partner_room.id))
+        redis = await get_redis()
+        self.assertEqual(await ChatService(redis, waiting_room_id, 'x').get_room_state(), lifecycle.CLOSED)
+        self.assertTrue(await redis.sismember(f'sessions:{partner_room.id}', 'lobby-a'))
+        await a.disconnect()
+
+    async def test_reconnect_to_room(self):
+        """Tests that a reconnecting client gets back into its room, and to the lobby if the room is gone."""
+        a = await self.connect('lobby-a')
+        room_id = await self.search(a)
+        await a.send_json_to({'message': 'hi'})
+        await a.receive_json_from()
+        await a.disconnect()  # alone in the room, the room is ended
+
+        b = await self.connect('lobby-b')
+        room_id = await self.search(b)
+        c = await self.connect('lobby-c')
+        await self.search(c)
+        await c.send_json_to({'message': 'missed'})
+        await c.disconnect(code=1006)
+
+        c = await self.connect('lobby-c', f'?room_id={room_id}&last_seq=0')
+        self.assertEqual(await c.receive_json_from(), {'type': 'room', 'room_id': room_id})
+        self.assertEqual((await c.receive_json_from())['type'], 'reconnect')
+        self.assertEqual((await c.receive_json_from())['message'], 'missed')
+
+        gone = await self.connect('lobby-d', '?room_id=6ad6517dac9c4b94e9b28157')
+        self.assertEqual((await gone.receive_json_from())['type'], 'lobby')
+        await gone.send_json_to({'message': 'hi'})
+        self.assertEqual((await gone.receive_json_from())['type'], 'error')
+        for communicator in (b, c, gone):
+            await communicator.disconnect()
+
+    def tearDown(self):
+        for timer in ChatConsumer.deletion_timers.values():
+            timer.cancel()
+        ChatConsumer.deletion_timers.clear()
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys(), 'room_removals')
+        Message.objects.all().delete()
+        ChatRoom.objects.all().delete()
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        tracer.reset()
+        self.application = URLRouter(websocket_urlpatterns)
+        self.room = create_chat_room(topic='chat', my_gender='male', search_gender='female')
+
+    async def connect(self, session_key):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room.id}/')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def exchange_message(self):
+        a = await self.connect('tracing-a')
+        b = await self.connect('tracing-b')
+        for communicator in (a, b):
+            await communicator.receive_json_from()  # second_user_joined
+        tracer.reset()
+        await a.send_json_to({'message': 'hi', 'room_id': str(self.room.id)})
+        await a.receive_json_from()
+        await b.receive_json_from()
+        await a.disconnect()
+        await b.disconnect()
+
+    def test_disabled_records_nothing(self):
+        """Tests that nothing is recorded while tracing is off."""
+        tracer.disable()
+        async_to_sync(self.exchange_message)()
+        self.assertEqual(tracer.stats, {})
+        self.assertIs(tracer.span('x'), tracing.NO_SPAN)
+
+    def test_trace_propagated_through_group_send(self):
+        """Tests that service and layer calls are children of the handler span and recipients continue the trace."""
+        tracer.enable(60)
+        try:
+            async_to_sync(self.exchange_message)()
+        finally:
+            tracer.disable()
+
+        spans = list(tracer.recent)
+        receive = next(span for span in spans if span.name == 'consumer.websocket.receive')
+        children = {span.name for span in spans if span.parent_id == receive.span_id}
+        self.assertTrue({'chat.ingest_message', 'layer.group_send'} <= children, children)
+        self.assertIn('redis.append_message', {span.name for span in spans if span.trace_id == receive.trace_id})
+
+        delivered = [span for span in spans if span.name == 'consumer.chat_message']
+        self.assertEqual(len(delivered), 2)
+        send = next(span for span in spans if span.name == 'layer.group_send' and span.trace_id == receive.trace_id)
+        self.assertEqual({(span.trace_id, span.parent_id) for span in delivered}, {(receive.trace_id, send.span_id)})
+
+    def test_tracing_seconds_validated(self):
+        """Tests that the tracing view turns down durations that would leave tracing on forever."""
+        for seconds in ('nan', 'inf', '-5', '0', 'soon'):
+            request = RequestFactory().post(reverse('tracing'), {'seconds': seconds})
+            request.user = mock.Mock(is_active=True, is_staff=True)
+            self.assertEqual(views.tracing(request).status_code, 400, seconds)
+        self.assertFalse(tracer.enabled)
+
+    def test_profiler_writes_collapsed_stacks(self):
+        """Tests that the sampling profiler writes collapsed stacks including the sampled thread's frames."""
+        with tempfile.TemporaryDirectory() as directory, override_settings(CHAT_PROFILE_DIR=directory):
+            path = tracing.profiler.start(0.2, interval=0.01)
+            with self.assertRaises(RuntimeError):
+                tracing.profiler.start(1)
+            deadline = time.monotonic() + 0.3
+            while time.monotonic() < deadline:
+                sum(range(1000))
+            tracing.profiler.thread.join()
+
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertTrue(any('test_profiler_writes_collapsed_stacks' in line for line in lines))
+
+    def tearDown(self):
+        tracer.disable()
+        tracer.reset()
+        get_redis_connection('default').delete(events.STREAM_KEY, *waiting_keys(), 'room_removals')
+        ChatRoom.objects.all().delete()
+
+
+class SupervisorTests(TestCase):
+    """Tests the runworkers supervisor's status reports, health checks and metrics aggregation."""
+
+    def setUp(self):
+        self.supervisor = Supervisor(2, '127.0.0.1', 0)
+
+    def test_reads_worker_status_reports(self):
+        """Tests that a status line written by a worker updates its metrics and last report time."""
+        worker = self.supervisor.workers[0]
+        read_fd, write_fd = os.pipe()
+        worker.status = read_fd
+        self.supervisor.selector.register(read_fd, selectors.EVENT_READ, worker)
+        try:
+            metrics.incr('messages_sent', 3)
+            report_status(write_fd)
+            self.supervisor.read_reports(1)
+        finally:
+            self.supervisor.selector.unregister(read_fd)
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEqual(worker.metrics, metrics.snapshot())
+        self.assertEqual(worker.buffer, b'')
+
+    def test_closed_status_pipe_unregistered(self):
+        """Tests that the status pipe of an exited worker is closed, not selected as readable on every pass."""
+        worker = self.supervisor.workers[0]
+        read_fd, write_fd = os.pipe()
+        worker.status = read_fd
+        self.supervisor.selector.register(read_fd, selectors.EVENT_READ, worker)
+        os.close(write_fd)
+        self.supervisor.read_reports(1)
+        self.assertIsNone(worker.status)
+        self.assertEqual(self.supervisor.selector.get_map(), {})
+        with self.assertRaises(OSError):
+            os.fstat(read_fd)
+
+    def test_restarts_exited_and_kills_unresponsive_workers(self):
+        """Tests that an exited worker is respawned and one that stopped reporting is killed."""
+        exited, hung = self.supervisor.workers
+        exited.process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.process.wait()
+        hung.process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+        now = time.monotonic()
+        exited.started = hung.started = hung.last_report = now - settings.CHAT_WORKER_HEALTH_TIMEOUT - 1
+
+        with mock.patch.object(Supervisor, 'spawn') as spawn:
+            self.supervisor.check(now)
+        spawn.assert_called_once_with(exited)
+        self.assertEqual(exited.restarts, 1)
+        self.assertIsNotNone(hung.process.poll())
+
+    def test_aggregates_worker_metrics(self):
+        """Tests that the published metrics sum the workers' metrics and keep them per worker."""
+        for worker, sent in zip(self.supervisor.workers, (2, 5)):
+            worker.metrics = {'messages_sent': sent, 'connections': 1}
+        aggregate = self.supervisor.aggregate()
+        self.assertEqual(aggregate['total'], {'messages_sent': 7, 'connections': 2})
+        self.assertEqual(aggregate['workers'][1]['metrics']['messages_sent'], 5)
+        self.assertFalse(aggregate['workers'][0]['alive'])
+
+
+class ModerationTests(TestCase):
+    """Tests the session moderation queries and the in-process ban list."""
+
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        self.redis.delete(events.STREAM_KEY, bans.BANS_KEY, bans.VERSION_KEY, 'room_removals')
+        self.application = URLRouter(websocket_urlpatterns)
+        self.created = create_chat_room(topic='chat', my_gender='male', search_gender='female', session_id='reported')
+        self.joined = create_chat_room(topic='chat', my_gender='female', search_gender='male', session_id='partner')
+
+    def persist_messages(self):
+        started = time.time() - 100
+        batch = [events.event_fields(events.JOIN, str(self.joined.id), 'reported', ts=repr(started))]
+        for i in range(5):
+            room = self.created if i % 2 else self.joined
+            batch.append(events.event_fields(events.MESSAGE, str(room.id), 'reported', seq=i + 1,
+                                             content=f'message {i}', ts=repr(started + i)))
+        batch.append(events.event_fields(events.MESSAGE, str(self.joined.id), 'partner', seq=6,
+                                         content='reply', ts=repr(started + 10)))
+        PersistenceService.persist(batch)
+
+    def test_session_rooms_and_messages(self):
+        """Tests that a session's rooms and messages are found, newest first, paginated and time bounded."""
+        self.persist_messages()
+        self.assertEqual(set(ChatRoom.objects.get(id=self.joined.id).session_ids), {'reported', 'partner'})
+
+        rooms, next_cursor = ModerationService.get_session_rooms('reported')
+        self.assertEqual([room['room_id'] for room in rooms], [str(self.joined.id), str(self.created.id)])
+        self.assertIsNone(next_cursor)
+
+        pages, cursor = [], None
+        while True:
+            messages, cursor = ModerationService.get_session_messages('reported', cursor=cursor, limit=2)
+            pages.append([message['message'] for message in messages])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['message 4', 'message 3'], ['message 2', 'message 1'], ['message 0']])
+
+        in_room, _ = ModerationService.get_session_messages('reported', room_id=str(self.created.id))
+        self.assertEqual([message['message'] for message in in_room], ['message 3', 'message 1'])
+        since = datetime.fromisoformat(in_room[1]['timestamp'])
+        bounded, _ = ModerationService.get_session_messages('reported', since=since, until=since + timedelta(seconds=2))
+        self.assertEqual([message['message'] for message in bounded], ['message 2', 'message 1'])
+
+    async def connect(self, session_key):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.created.id}/')
+        communicator.scope['session'] = Session(session_key)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def assert_banned(self, communicator):
+        self.assertEqual((await communicator.receive_json_from())['type'], 'banned')
+        self.assertEqual((await communicator.receive_output())['code'], bans.BANNED_CLOSE_CODE)
+
+    async def test_banned_session_turned_away_without_redis(self):
+        """Tests that connect checks the cached ban list, a banned session costs no Redis command."""
+        await sync_to_async(bans.ban)(self.redis, 'reported', 60)
+        self.assertTrue(await bans.bans.refresh(await get_redis()))
+        self.assertFalse(await bans.bans.refresh(await get_redis()), 'Unchanged list is not reloaded')
+
+        with RedisCommandCounter() as counter:
+            communicator = await self.connect('reported')
+            await self.assert_banned(communicator)
+        self.assertEqual(counter.commands, [])
+
+    async def test_ban_closes_open_connections(self):
+        """Tests that a ban closes the session's open connection and that lifting it reaches the workers."""
+        communicator = await self.connect('reported')
+        await sync_to_async(bans.ban)(self.redis, 'reported')
+        await bans.bans.refresh(await get_redis())
+        await self.assert_banned(communicator)
+        await communicator.disconnect(code=bans.BANNED_CLOSE_CODE)
+
+        self.assertTrue(await sync_to_async(bans.unban)(self.redis, 'reported'))
+        await bans.bans.refresh(await get_redis())
+        self.assertFalse(bans.bans.is_banned('reported'))
+        self.assertEqual(await sync_to_async(bans.list_bans)(self.redis), {})
+
+    def test_ban_seconds_validated_and_expired_bans_dropped(self):
+        """Tests that a ban needs positive seconds, zero is not a permanent ban, and that bans drop the expired."""
+        for seconds in (0, -60):
+            with self.assertRaises(ValueError):
+                bans.ban(self.redis, 'reported', seconds)
+        self.assertFalse(self.redis.hexists(bans.BANS_KEY, 'reported'))
+
+        self.redis.hset(bans.BANS_KEY, mapping={'expired': repr(time.time() - 1), 'permanent': '0'})
+        bans.ban(self.redis, 'reported', 60)
+        self.assertEqual(sorted(self.redis.hkeys(bans.BANS_KEY)), [b'permanent', b'reported'])
+
+    def tearDown(self):
+        self.redis.delete(events.STREAM_KEY, bans.BANS_KEY, bans.VERSION_KEY, 'room_removals', *waiting_keys(),
+                          lifecycle.state_key(str(self.created.id)))
+        bans.bans.banned = {}
+        bans.bans.version = None
+        Message.objects.all().delete()
+        ChatRoom.objects.all().delete()
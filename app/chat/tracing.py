@@ -0,0 +1,271 @@
+"""
+Tracing and on-demand profiling of a live worker.
+
+Spans are recorded around every consumer handler (ChatConsumer.dispatch), service call (trace_methods on
+RedisService, ChatService and the Mongo services) and channel layer operation (TracingChannelLayer).
+group_send carries the current span in the event's 'trace' field, so the handlers of the recipients
+continue the trace of the sender. Tracing is off unless CHAT_TRACING is set or it's enabled for a while
+from the admin api (views.tracing), disabled spans cost one attribute check, see benchmarks/tracing_overhead.py.
+
+The sampling profiler samples the stacks of all threads of the worker for a number of seconds and writes
+them as collapsed stacks (flamegraph.pl, speedscope) to CHAT_PROFILE_DIR.
+"""
+import contextvars
+import inspect
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import wraps
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'started', 'duration', 'token')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f'{next(_ids):x}'
+        self.parent_id = parent_id
+        self.started = None
+        self.duration = None
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self.started
+        _current_span.reset(self.token)
+        tracer.record(self)
+        return False
+
+    def context(self) -> dict:
+        """Context propagated to other processes in channel layer events"""
+        return {'trace': self.trace_id, 'span': self.span_id}
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    """
+    Per-process span recorder. Keeps count, total and max duration per span name and the most recent
+    CHAT_TRACE_BUFFER spans, and prints spans slower than CHAT_TRACE_SLOW_MS.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.until = 0.0
+        self.slow = None
+        self.stats = {}
+        self.recent = deque(maxlen=settings.CHAT_TRACE_BUFFER)
+        if settings.CHAT_TRACING:
+            self.enable(float('inf'))
+
+    def enable(self, seconds: float):
+        self.until = time.monotonic() + seconds
+        self.slow = settings.CHAT_TRACE_SLOW_MS / 1000
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name: str, remote: dict = None):
+        """Span of the current trace, a new trace if there is none, or of the remote one an event carried."""
+        if not self.enabled:
+            return NO_SPAN
+        if time.monotonic() > self.until:
+            self.enabled = False
+            return NO_SPAN
+
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(name, parent.trace_id, parent.span_id)
+        if remote:
+            return Span(name, remote.get('trace'), remote.get('span'))
+        return Span(name, f'{os.getpid():x}-{next(_ids):x}', None)
+
+    def record(self, span: Span):
+        stats = self.stats.get(span.name)
+        if stats is None:
+            stats = self.stats[span.name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += span.duration
+        stats[2] = max(stats[2], span.duration)
+        self.recent.append(span)
+
+        if span.duration >= self.slow:
+            print(f'SLOW SPAN {span.name} {span.duration * 1000:.1f}ms trace {span.trace_id}')
+
+    def reset(self):
+        self.stats.clear()
+        self.recent.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'seconds_left': max(0, round(self.until - time.monotonic(), 1)) if self.enabled else 0,
+            'spans': {name: {
+                'count': count,
+                'avg_ms': round(total / count * 1000, 3),
+                'max_ms': round(longest * 1000, 3),
+            } for name, (count, total, longest) in sorted(self.stats.items())},
+            'recent': [{
+                'name': span.name,
+                'trace': span.trace_id,
+                'span': span.span_id,
+                'parent': span.parent_id,
+                'ms': round(span.duration * 1000, 3),
+            } for span in self.recent],
+        }
+
+
+tracer = Tracer()
+
+
+def inject(event: dict) -> dict:
+    """Returns the event carrying the current span, for the handlers receiving it"""
+    span = _current_span.get()
+    if span is None:
+        return event
+    return {**event, 'trace': span.context()}
+
+
+def traced(name: str):
+    """Records calls of the decorated function or coroutine function as spans"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return func(*args, **kwargs)
+                with tracer.span(name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_methods(prefix: str):
+    """Class decorator tracing the public methods the class defines, named prefix.method"""
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith('_'):
+                continue
+            if isinstance(value, staticmethod):
+                setattr(cls, attr, staticmethod(traced(f'{prefix}.{attr}')(value.__func__)))
+            elif inspect.isfunction(value):
+                setattr(cls, attr, traced(f'{prefix}.{attr}')(value))
+        return cls
+    return decorator
+
+
+class TracingChannelLayer(RedisChannelLayer):
+    """Redis channel layer recording its operations as spans, group_send propagates the trace to recipients"""
+
+    async def send(self, channel, message):
+        if not tracer.enabled:
+            return await super().send(channel, message)
+        with tracer.span('layer.send'):
+            return await super().send(channel, inject(message))
+
+    async def group_send(self, group, message):
+        if not tracer.enabled:
+            return await super().group_send(group, message)
+        with tracer.span('layer.group_send'):
+            return await super().group_send(group, inject(message))
+
+    async def group_add(self, group, channel):
+        if not tracer.enabled:
+            return await super().group_add(group, channel)
+        with tracer.span('layer.group_add'):
+            return await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        if not tracer.enabled:
+            return await super().group_discard(group, channel)
+        with tracer.span('layer.group_discard'):
+            return await super().group_discard(group, channel)
+
+
+def collapse(frame) -> str:
+    """Stack of the frame in collapsed format, outermost call first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{getattr(code, "co_qualname", code.co_name)} '
+                     f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples the stacks of the worker's threads from a background thread, one run at a time."""
+
+    def __init__(self):
+        self.thread = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float, interval: float = None) -> str:
+        """Starts sampling for seconds, returns the path the collapsed stacks will be written to."""
+        if self.running:
+            raise RuntimeError('Profiler is already running')
+
+        os.makedirs(settings.CHAT_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(settings.CHAT_PROFILE_DIR, f'profile-{os.getpid()}-{int(time.time())}.folded')
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True,
+                                       args=(seconds, interval or settings.CHAT_PROFILE_INTERVAL, path))
+        self.thread.start()
+        return path
+
+    def run(self, seconds: float, interval: float, path: str):
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id not in threads:
+                    threads = {thread.ident: thread.name for thread in threading.enumerate()}
+                stacks[f'{threads.get(thread_id, thread_id)};{collapse(frame)}'] += 1
+            time.sleep(interval)
+
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        print(f'PROFILE WRITTEN: {path} ({sum(stacks.values())} samples)')
+
+
+profiler = SamplingProfiler()
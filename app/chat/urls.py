@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('room/', views.search_room, name='search_room'),
     path('room/<str:room_id>/', views.room, name='room'),
     path('search', views.search_or_create_chat_room, name='search'),
     path('post_message/', views.post_message, name='post_message'),
@@ -11,5 +12,16 @@ urlpatterns = [
     path('api/check_room_status/<int:room_id>/', views.check_room_status, name='check_room_status'),
     path('api/join_room/<int:room_id>/', views.join_room, name='join_room'),
     path('api/end_chat/', views.end_chat, name='end_chat'),
-    path('api/get_users_in_chat/', views.get_users_in_chat, name='get_users_in_chat')
+    path('api/get_users_in_chat/', views.get_users_in_chat, name='get_users_in_chat'),
+    path('api/health/', views.health, name='health'),
+    path('api/metrics/', views.get_metrics, name='metrics'),
+    path('api/workers/', views.get_worker_metrics, name='worker_metrics'),
+    path('api/matchmaking/', views.get_matchmaking_stats, name='matchmaking_stats'),
+    path('api/stats/', views.get_stats, name='stats'),
+    path('api/tracing/', views.tracing, name='tracing'),
+    path('api/moderation/sessions/<str:session_id>/rooms/', views.moderation_rooms, name='moderation_rooms'),
+    path('api/moderation/sessions/<str:session_id>/messages/', views.moderation_messages,
+         name='moderation_messages'),
+    path('api/moderation/sessions/<str:session_id>/ban/', views.ban_session, name='ban_session'),
+    path('api/moderation/bans/', views.get_bans, name='bans'),
 ]
@@ -1,14 +1,34 @@
 import json
+import math
+import os
+from datetime import datetime
 
+from asgiref.sync import sync_to_async
 from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
 from django.http import JsonResponse, HttpResponse
-from django.shortcuts import render, redirect
+from django.shortcuts import redirect
 from django.views.decorators.http import require_POST
+from django_redis import get_redis_connection
 from mongoengine import DoesNotExist, ValidationError
+from redis.exceptions import RedisError
 
+from config import mongo, supervisor
 from config.redis_pool import get_redis
-from .models import ChatRoom, Message, search_chat_room, create_chat_room
+from . import bans, lifecycle, matchmaking, metrics
+from .models import ChatRoom, Message, create_chat_room
+from .pipeline import process_message, valid_client_id, validate_content
+from .services.chat_service import ChatService
+from .services.moderation_service import ModerationService
+from .services.stats_service import StatsService
 from .services.redis_service import RedisService
+from .shells import index_shell, room_shell
+from .tracing import profiler, tracer
+
+USERS_IN_CHAT_CACHE_KEY = 'users_in_chat'
 
 
 def index(request):
@@ -18,7 +38,8 @@ def index(request):
     :return:
     """
     request.session.create()
-    return render(request, 'index.html', {'users_in_chat': ChatRoom.objects.count()})
+    # Online counter is loaded by htmx right after the page, the rest of the page is the cached shell
+    return index_shell.response(request, path=request.path)
 
 
 async def room(request, room_id):
@@ -28,9 +49,7 @@ async def room(request, room_id):
     :param room_id:
     :return:
     """
-    try:
-        chat_room: ChatRoom = ChatRoom.objects.get(id=room_id)
-    except DoesNotExist:
+    if not ChatRoom.active(id=room_id).only('id').first():
         return redirect('index')
 
     session_id = request.session.session_key
@@ -38,16 +57,42 @@ async def room(request, room_id):
     redis = await get_redis()
     redis_service = RedisService(redis, room_id, session_id)
     is_connected = await redis_service.is_already_connected()
-    await redis_service.close_redis()
 
-    if is_connected:
+    if is_connected or await redis_service.get_room_state() in lifecycle.ENDED_STATES:
         return redirect('index')
 
-    return render(request, 'room.html', {
-        'room_id': room_id,
-        'session_key': request.session.session_key,
-        'filter_data': request.session.get('filter_data')
-    })
+    filter_data = request.session.get('filter_data') or {}
+    return room_shell.response(
+        request,
+        room_id=room_id,
+        session_key=request.session.session_key,
+        my_gender=filter_data.get('my_gender', ''),
+        search_gender=filter_data.get('search_gender', ''),
+        topic=filter_data.get('topic', ''),
+        heartbeat_interval=settings.CHAT_HEARTBEAT_INTERVAL,
+    )
+
+
+def search_room(request):
+    """
+    Chat room page before there is a room: its lobby socket sends the search with the filters of the query
+    string and enters the room it gets, the first match costs no request besides the page and the socket.
+    :param request:
+    :return:
+    """
+    filter_data = {key: request.GET.get(key, '') for key in ('my_gender', 'search_gender', 'topic')}
+    if not filter_data['topic']:
+        return redirect('index')
+    if not request.session.session_key:
+        request.session.create()
+    request.session['filter_data'] = filter_data
+    return room_shell.response(
+        request,
+        room_id='',
+        session_key=request.session.session_key,
+        heartbeat_interval=settings.CHAT_HEARTBEAT_INTERVAL,
+        **filter_data,
+    )
 
 
 @require_POST
@@ -62,15 +107,22 @@ def search_or_create_chat_room(request):
         topic = data.get('topic')
         creator_gender = data.get('my_gender')
         search_gender = data.get('search_gender')
+        # Retried search while still waiting with the same filters keeps the same room
+        waiting_room_id = request.session.get('waiting_room_id')
+        if waiting_room_id and request.session.get('filter_data') == data and matchmaking.is_waiting(waiting_room_id):
+            return JsonResponse({'status': 'success', 'room_id': waiting_room_id})
+
         request.session['filter_data'] = data
 
         print(data)
 
-        chat_room = search_chat_room(topic, creator_gender, search_gender)
-        if not chat_room or chat_room.is_full():
-            chat_room = create_chat_room(topic, creator_gender, search_gender)
+        room_id = matchmaking.match_now(topic, creator_gender, search_gender)
+        if not room_id:
+            room_id = str(create_chat_room(topic, creator_gender, search_gender,
+                                           session_id=request.session.session_key).id)
+            request.session['waiting_room_id'] = room_id
 
-        return JsonResponse({'status': 'success', 'room_id': str(chat_room.id)})
+        return JsonResponse({'status': 'success', 'room_id': room_id})
 
     except Exception as e:
         print(e)
@@ -78,9 +130,9 @@ def search_or_create_chat_room(request):
 
 
 @require_POST
-def post_message(request):
+async def post_message(request):
     """
-    Posting a new message to a room.
+    Posting a new message to a room, saved the same way as websocket messages.
     :param request:
     :return:
     """
@@ -88,22 +140,27 @@ def post_message(request):
         data = json.loads(request.body)
         room_id = data['room_id']
         session_id = data['session_id']
-        content = data['content']
-
-        room = ChatRoom.objects.get(id=room_id)
-
-        # Create and save the new message
-        message = Message(room=room, session_id=session_id, content=content)
-        message.save()
-
-        return JsonResponse({'status': 'success', 'message_id': str(message.id)})
+        error = validate_content(data['content'])
+        if error:
+            return JsonResponse({'status': 'error', 'message': error}, status=400)
+        content = process_message(data['content'])
+        client_id = valid_client_id(data.get('client_id'))
+
+        room = await sync_to_async(ChatRoom.active.get)(id=room_id)
+        chat_service = ChatService(redis=await get_redis(), room_id=str(room.id), session_id=session_id)
+        # Retried message with the same client id is acknowledged without saving it again
+        seq, is_new = await chat_service.ingest_message(content, str(room.id), session_id, client_id=client_id)
+        if not is_new:
+            return JsonResponse({'status': 'success', 'duplicate': True, 'seq': seq})
+
+        return JsonResponse({'status': 'success', 'seq': seq})
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
 def check_room_status(request, room_id):
     try:
-        room = ChatRoom.objects.get(id=room_id)
+        room = ChatRoom.active.get(id=room_id)
         return JsonResponse({'second_user_joined': room.second_user_joined})
     except DoesNotExist:
         return JsonResponse({'error': 'Room not found'}, status=404)
@@ -111,7 +168,7 @@ def check_room_status(request, room_id):
 
 def join_room(request, room_id):
     try:
-        room = ChatRoom.objects.get(id=room_id)
+        room = ChatRoom.active.get(id=room_id)
         room.join_second_user()
         return JsonResponse({'success': 'User joined the room'})
     except DoesNotExist:
@@ -132,7 +189,7 @@ def get_messages(request, room_id):
             return JsonResponse({'error': 'Invalid room ID'}, status=400)
 
         try:
-            room = ChatRoom.objects.get(id=room_id_obj)
+            room = ChatRoom.active.get(id=room_id_obj)
         except DoesNotExist:
             return JsonResponse({'error': 'Room not found'}, status=404)
 
@@ -141,29 +198,44 @@ def get_messages(request, room_id):
         messages_data = [{
             'session_id': message.session_id,
             'message': message.content,
+            'seq': message.seq,
             'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S')
         } for message in messages]
 
+        # Messages the persisters haven't saved yet are still in the recent history stream
+        last_seq = max((message['seq'] or 0 for message in messages_data), default=0)
+        for entry_id, fields in get_redis_connection('default').xrange(f'history:{room_id}', min=f'{last_seq + 1}-0'):
+            messages_data.append({
+                'session_id': fields[b'session_id'].decode(),
+                'message': fields[b'message'].decode(),
+                'seq': int(entry_id.split(b'-')[0]),
+                'timestamp': None
+            })
+
         return JsonResponse(
             {'status': 'success', 'messages': messages_data, 'second_user_joined': room.second_user_joined})
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
-def end_chat(request):
+@require_POST
+async def end_chat(request):
     """
-    Ends chat.
+    Ends chat, same as the end_chat websocket action. Whichever of the two arrives first ends it.
     :param request:
     :return:
     """
     try:
-        data = json.loads(request.body)
-        room_id = data['room_id']
-        chat = ChatRoom.objects.get(id=room_id)
-        chat.is_active = False
-        chat.save()
-    except DoesNotExist:
-        return JsonResponse({'statur': 'error', 'message': 'Room does not exists'}, status=500)
+        room_id = str(json.loads(request.body)['room_id'])
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'status': 'error', 'message': 'Invalid request'}, status=400)
+
+    session_id = request.session.session_key
+    chat_service = ChatService(redis=await get_redis(), room_id=room_id, session_id=session_id)
+    if not await chat_service.in_session_ids():
+        return JsonResponse({'status': 'error', 'message': 'Room does not exists'}, status=404)
+
+    await chat_service.end_room(session_id)
     return JsonResponse({'status': 'success'})
 
 
@@ -173,4 +245,191 @@ def get_users_in_chat(request):
     :param request:
     :return:
     """
-    return HttpResponse(f'<span style="padding-left: 5px">{ChatRoom.objects.count()}</span>')
+    users_in_chat = cache.get_or_set(USERS_IN_CHAT_CACHE_KEY, ChatRoom.active.count, settings.CHAT_ONLINE_COUNT_TTL)
+    return HttpResponse(f'<span style="padding-left: 5px">{users_in_chat}</span>')
+
+
+def health(request):
+    """
+    Liveness of the Mongo and Redis connections of this process, 503 if one of them is down.
+    :param request:
+    :return:
+    """
+    checks = {'mongo': mongo.check()}
+    try:
+        get_redis_connection('default').ping()
+        checks['redis'] = None
+    except RedisError as e:
+        checks['redis'] = str(e)
+
+    healthy = not any(checks.values())
+    return JsonResponse({
+        'status': 'ok' if healthy else 'error',
+        'checks': {name: error or 'ok' for name, error in checks.items()},
+    }, status=200 if healthy else 503)
+
+
+@staff_member_required
+def get_metrics(request):
+    """
+    Returns process-local connection metrics.
+    :param request:
+    :return:
+    """
+    return JsonResponse(metrics.snapshot())
+
+
+@staff_member_required
+def get_worker_metrics(request):
+    """
+    Returns metrics of all workers run by the runworkers command, summed and per worker.
+    :param request:
+    :return:
+    """
+    data = get_redis_connection('default').get(supervisor.METRICS_KEY)
+    if data is None:
+        return JsonResponse({'status': 'error', 'message': 'No supervisor is running'}, status=404)
+    return JsonResponse(json.loads(data))
+
+
+@staff_member_required
+def get_matchmaking_stats(request):
+    """
+    Returns time-to-match distribution and waiting searchers.
+    :param request:
+    :return:
+    """
+    return JsonResponse(matchmaking.get_stats())
+
+
+@staff_member_required
+def get_stats(request):
+    """
+    Returns hourly room and message rollups, read from the stats collection only.
+    Query params: hours (default 24), event, topic.
+    :param request:
+    :return:
+    """
+    try:
+        hours = min(int(request.GET.get('hours', 24)), 24 * 90)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid hours'}, status=400)
+
+    rollups = StatsService.get_rollups(hours, request.GET.get('event'), request.GET.get('topic'))
+    return JsonResponse({'status': 'success', 'rollups': rollups})
+
+
+@staff_member_required
+def tracing(request):
+    """
+    Tracing of the worker serving the request.
+    GET returns span stats and recent spans. POST enables tracing for `seconds` (default 30),
+    with `profile` set also runs the sampling profiler for that long and returns the file it writes.
+    :param request:
+    :return:
+    """
+    if request.method != 'POST':
+        return JsonResponse({'pid': os.getpid(), **tracer.snapshot()})
+
+    try:
+        seconds = float(request.POST.get('seconds', 30))
+    except ValueError:
+        seconds = 0
+    if not math.isfinite(seconds) or seconds <= 0:  # nan would never compare past the deadline
+        return JsonResponse({'status': 'error', 'message': 'Invalid seconds'}, status=400)
+    seconds = min(seconds, settings.CHAT_PROFILE_MAX_SECONDS)
+
+    tracer.reset()
+    tracer.enable(seconds)
+    response = {'status': 'success', 'pid': os.getpid(), 'seconds': seconds}
+    if request.POST.get('profile'):
+        try:
+            response['profile'] = profiler.start(seconds)
+        except RuntimeError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=409)
+    return JsonResponse(response)
+
+
+def moderation_query(request) -> dict:
+    """Time range, cursor and page size of a moderation query, raises ValueError for invalid ones"""
+    since, until = request.GET.get('since'), request.GET.get('until')
+    limit = int(request.GET.get('limit', settings.CHAT_MODERATION_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return {
+        'since': datetime.fromisoformat(since) if since else None,
+        'until': datetime.fromisoformat(until) if until else None,
+        'cursor': request.GET.get('cursor'),
+        'limit': min(limit, settings.CHAT_MODERATION_MAX_PAGE_SIZE),
+    }
+
+
+@staff_member_required
+def moderation_rooms(request, session_id):
+    """
+    Rooms the session created, joined or wrote in, newest first.
+    Query params: since, until (ISO datetimes), cursor (next of the previous page), limit.
+    :param request:
+    :param session_id:
+    :return:
+    """
+    try:
+        rooms, next_cursor = ModerationService.get_session_rooms(session_id, **moderation_query(request))
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'rooms': rooms, 'next': next_cursor})
+
+
+@staff_member_required
+def moderation_messages(request, session_id):
+    """
+    Messages the session sent, newest first.
+    Query params: room, since, until (ISO datetimes), cursor (next of the previous page), limit.
+    :param request:
+    :param session_id:
+    :return:
+    """
+    try:
+        messages, next_cursor = ModerationService.get_session_messages(
+            session_id, request.GET.get('room'), **moderation_query(request)
+        )
+    except (ValueError, InvalidId) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'messages': messages, 'next': next_cursor})
+
+
+@staff_member_required
+def get_bans(request):
+    """
+    Returns the banned sessions and when their bans expire (0 for permanent).
+    :param request:
+    :return:
+    """
+    return JsonResponse({'status': 'success', 'bans': bans.list_bans(get_redis_connection('default'))})
+
+
+@staff_member_required
+def ban_session(request, session_id):
+    """
+    POST bans the session, for `seconds` if given, permanently otherwise. DELETE lifts the ban.
+    Workers pick the change up within CHAT_BAN_LIST_REFRESH_INTERVAL and close the session's connections.
+    :param request:
+    :param session_id:
+    :return:
+    """
+    redis = get_redis_connection('default')
+    if request.method == 'DELETE':
+        if not bans.unban(redis, session_id):
+            return JsonResponse({'status': 'error', 'message': 'Session is not banned'}, status=404)
+        return JsonResponse({'status': 'success'})
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Method not allowed'}, status=405)
+
+    try:
+        seconds = int(request.POST['seconds']) if request.POST.get('seconds') else None
+    except ValueError:
+        seconds = 0
+    if seconds is not None and seconds <= 0:
+        return JsonResponse({'status': 'error', 'message': 'Invalid seconds'}, status=400)
+    bans.ban(redis, session_id, seconds)
+    return JsonResponse({'status': 'success', 'session_id': session_id, 'seconds': seconds})
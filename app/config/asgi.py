@@ -9,24 +9,41 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.sessions import SessionMiddlewareStack
 from django.core.asgi import get_asgi_application
 from django.urls import path
+from django.utils.module_loading import import_string
 
-from chat.consumers import ChatConsumer
+from config.static_files import StaticFilesApp
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 django_asgi_app = get_asgi_application()
 
+
+class LazyConsumer:
+    """Imports the consumer on the first connection instead of at worker boot"""
+
+    def __init__(self, consumer_path):
+        self.consumer_path = consumer_path
+        self.app = None
+
+    async def __call__(self, scope, receive, send):
+        if self.app is None:
+            self.app = import_string(self.consumer_path).as_asgi()
+        return await self.app(scope, receive, send)
+
+
 websocket_urlpatterns = [
-    path('ws/chat/<room_id>/', ChatConsumer.as_asgi()),
+    path('ws/chat/<room_id>/', LazyConsumer('chat.consumers.ChatConsumer')),
+    path('ws/lobby/', LazyConsumer('chat.consumers.LobbyConsumer')),
 ]
 
 application = ProtocolTypeRouter({
-    'http': django_asgi_app,
-    'websocket': AuthMiddlewareStack(
+    'http': StaticFilesApp(django_asgi_app),
+    # Consumers only need the session, not the (lazy) user object
+    'websocket': SessionMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
@@ -0,0 +1,52 @@
+"""
+Lazy, per-process Mongo connection.
+
+Only the connection settings are registered at startup, the MongoClient (and its pool) is created by
+mongoengine on the first query of the process, so management commands that never touch Mongo and
+workers booting while Mongo is down don't wait for it. A forked child drops the client it inherited
+and opens its own on first use.
+"""
+import os
+
+import mongoengine
+from django.conf import settings
+from mongoengine.connection import DEFAULT_CONNECTION_NAME
+from pymongo.errors import PyMongoError
+
+registered_db = None
+
+
+def register(db=None):
+    """Registers the connection settings, replacing any client already opened in this process"""
+    global registered_db
+    registered_db = db or settings.MONGODB_NAME
+    mongoengine.disconnect(DEFAULT_CONNECTION_NAME)
+    mongoengine.register_connection(
+        DEFAULT_CONNECTION_NAME, db=registered_db, host=settings.MONGODB_URL, **settings.MONGODB_OPTIONS
+    )
+
+
+def reset():
+    """Drops the client of this process, the next query opens a new one with the same settings"""
+    if registered_db is not None:
+        register(registered_db)
+
+
+def get_database():
+    return mongoengine.get_db(DEFAULT_CONNECTION_NAME)
+
+
+def is_connected():
+    return DEFAULT_CONNECTION_NAME in mongoengine.connection._connections
+
+
+def check():
+    """Health check: pings the server, returns an error message or None"""
+    try:
+        get_database().command('ping')
+    except PyMongoError as e:
+        return str(e)
+    return None
+
+
+os.register_at_fork(after_in_child=reset)
@@ -1,8 +1,20 @@
+import asyncio
+import weakref
+
 from redis import asyncio as aioredis
 from redis import Redis
 from django.conf import settings
 
+_clients = weakref.WeakKeyDictionary()
+
 
 async def get_redis() -> Redis:
-    redis = await aioredis.from_url(settings.REDIS_URL)
+    """
+    Returns the shared Redis client of the running event loop.
+    Connections come from the client's pool, so callers must not close it.
+    """
+    loop = asyncio.get_running_loop()
+    redis = _clients.get(loop)
+    if redis is None:
+        redis = _clients[loop] = aioredis.from_url(settings.REDIS_URL)
     return redis
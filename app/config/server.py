@@ -0,0 +1,145 @@
+"""
+Daphne with websocket compression and payload limits.
+
+Same command line as daphne, e.g.:
+    python -m config.server -b 0.0.0.0 -p 8000 config.asgi:application
+
+Negotiates permessage-deflate without context takeover and with a small window and memLevel, so the zlib
+state kept per connection stays small. Compresses only frames of at least CHAT_WS_COMPRESSION_THRESHOLD
+bytes, and closes connections sending messages larger than CHAT_WS_MAX_MESSAGE_SIZE before they reach
+the application. Hands every websocket application its transport's send back-pressure, see SendBackpressure,
+with the socket's send buffer capped at CHAT_WS_SEND_BUFFER so it shows soon after a client stops reading.
+
+Run by config.supervisor (runworkers command), a worker reports its metrics over the CHAT_WORKER_STATUS_FD
+pipe every CHAT_WORKER_REPORT_INTERVAL seconds, the supervisor treats a worker that stops reporting as hung.
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from daphne.ws_protocol import WebSocketProtocol
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from django.conf import settings
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
+from zope.interface import implementer
+
+from chat import metrics
+from chat.outbound import BACKPRESSURE_EXTENSION
+
+
+def accept_deflate(offers):
+    """Accepts the client's permessage-deflate offer, both sides reset the compression context per message"""
+    window_bits = settings.CHAT_WS_COMPRESSION_WINDOW_BITS
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer,
+                request_no_context_takeover=offer.accept_no_context_takeover,
+                request_max_window_bits=window_bits if offer.accept_max_window_bits else 0,
+                no_context_takeover=True,
+                window_bits=min(window_bits, offer.request_max_window_bits or window_bits),
+                mem_level=settings.CHAT_WS_COMPRESSION_MEM_LEVEL,
+            )
+    return None
+
+
+@implementer(IPushProducer)
+class SendBackpressure:
+    """
+    Push producer registered on a websocket's transport. Twisted pauses it when the transport's write buffer
+    holds more than bufferSize (64 KiB), the client isn't reading, and resumes it once the buffer drained.
+    Writing to the transport never blocks, so this is the only way the application can tell a slow client.
+    """
+
+    def __init__(self):
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self.resumed.is_set()
+
+    async def wait(self):
+        await self.resumed.wait()
+
+    def pauseProducing(self):
+        self.resumed.clear()
+
+    def resumeProducing(self):
+        self.resumed.set()
+
+    def stopProducing(self):
+        self.resumed.set()  # connection lost, sends are dropped from now on
+
+
+class CompressingWebSocketProtocol(WebSocketProtocol):
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.transport.getHandle().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings.CHAT_WS_SEND_BUFFER)
+        # The HTTP channel the connection was upgraded from is still the transport's producer
+        self.transport.unregisterProducer()
+        self.send_backpressure = SendBackpressure()
+        self.transport.registerProducer(self.send_backpressure, True)
+
+    def sendMessage(self, payload, isBinary=False, fragmentSize=None, sync=False, doNotCompress=False):
+        # Typing, pong and ack frames cost more CPU and header bytes compressed than they save
+        if len(payload) < settings.CHAT_WS_COMPRESSION_THRESHOLD:
+            doNotCompress = True
+        super().sendMessage(payload, isBinary, fragmentSize, sync, doNotCompress)
+
+
+class ChatServer(Server):
+
+    def create_application(self, protocol, scope):
+        backpressure = getattr(protocol, 'send_backpressure', None)
+        if backpressure is not None:
+            scope['extensions'] = {**scope.get('extensions', {}), BACKPRESSURE_EXTENSION: backpressure}
+        return super().create_application(protocol, scope)
+
+    def run(self):
+        # Daphne creates its websocket factory in run(), it's configured before the reactor accepts connections
+        reactor.callWhenRunning(self.configure_websockets)
+        status_fd = os.environ.get('CHAT_WORKER_STATUS_FD')
+        if status_fd:
+            reactor.callWhenRunning(self.start_status_reports, int(status_fd))
+        super().run()
+
+    def configure_websockets(self):
+        self.ws_factory.protocol = CompressingWebSocketProtocol
+        self.ws_factory.setProtocolOptions(
+            perMessageCompressionAccept=accept_deflate,
+            maxMessagePayloadSize=settings.CHAT_WS_MAX_MESSAGE_SIZE,
+            maxFramePayloadSize=settings.CHAT_WS_MAX_MESSAGE_SIZE,
+        )
+
+    def start_status_reports(self, fd):
+        os.set_blocking(fd, False)
+        # Kept on the server, a LoopingCall nobody references is garbage collected
+        self.status_reports = LoopingCall(report_status, fd)
+        self.status_reports.start(settings.CHAT_WORKER_REPORT_INTERVAL)
+
+
+def report_status(fd):
+    """Writes a status line from the event loop, so a report also means the loop isn't blocked"""
+    line = json.dumps({'pid': os.getpid(), 'time': time.time(), 'metrics': metrics.snapshot()}) + '\n'
+    try:
+        os.write(fd, line.encode())
+    except BlockingIOError:
+        pass  # supervisor is behind reading, the next report will do
+    except OSError:
+        pass  # supervisor is gone
+
+
+class ChatCommandLineInterface(CommandLineInterface):
+    server_class = ChatServer
+
+
+if __name__ == '__main__':
+    ChatCommandLineInterface.entrypoint()
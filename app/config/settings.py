@@ -10,7 +10,6 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
-import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -72,8 +71,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept for the life of the process (reset by the autoreloader in development)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -89,16 +94,25 @@ ASGI_APPLICATION = 'config.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
-from mongoengine import connect
 from decouple import config  # SPECIFY YOUR VARIABLES IN .env FILE
 
 MONGODB_URL = config('MONGODB_URL')
+MONGODB_NAME = config('MONGODB_NAME', default='nqkoione')
 REDIS_URL = config('REDIS_URL')
 
-if 'test' in sys.argv:
-    connect('test', host=MONGODB_URL)
-else:
-    connect('nqkoione', host=MONGODB_URL)
+# Passed to MongoClient, which config.mongo creates lazily on the first query of each process
+MONGODB_OPTIONS = {
+    'maxPoolSize': config('MONGODB_MAX_POOL_SIZE', default=50, cast=int),
+    'minPoolSize': config('MONGODB_MIN_POOL_SIZE', default=0, cast=int),
+    'connectTimeoutMS': config('MONGODB_CONNECT_TIMEOUT_MS', default=5000, cast=int),
+    'serverSelectionTimeoutMS': config('MONGODB_SERVER_SELECTION_TIMEOUT_MS', default=5000, cast=int),
+    'socketTimeoutMS': config('MONGODB_SOCKET_TIMEOUT_MS', default=10000, cast=int),
+    'waitQueueTimeoutMS': config('MONGODB_WAIT_QUEUE_TIMEOUT_MS', default=5000, cast=int),
+    'heartbeatFrequencyMS': config('MONGODB_HEARTBEAT_FREQUENCY_MS', default=10000, cast=int),
+}
+
+# Tests run against test_<MONGODB_NAME>, dropped afterwards
+TEST_RUNNER = 'config.test_runner.TestRunner'
 
 DATABASES = {
     'default': {
@@ -109,7 +123,7 @@ DATABASES = {
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.tracing.TracingChannelLayer',
         'CONFIG': {
             "hosts": [REDIS_URL],
             "symmetric_encryption_keys": [SECRET_KEY],
@@ -161,8 +175,106 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = '/static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic writes content-hashed names plus .gz/.br variants, served by config.static_files.StaticFilesApp
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'config.static_files.CompressedManifestStaticFilesStorage',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Chat
+# Recent messages kept per room in Redis stream for reconnect replays
+CHAT_HISTORY_STREAM_MAXLEN = 200
+
+# Seconds between client pings and idle seconds after which a connection is reaped
+CHAT_HEARTBEAT_INTERVAL = 20
+CHAT_IDLE_TIMEOUT = 60
+
+# Max queued outbound frames per connection before a slow client is disconnected
+CHAT_OUTBOUND_QUEUE_SIZE = 100
+
+# Seconds a disconnected user has to reconnect before the chat is ended for the other one
+CHAT_USER_REMOVAL_DELAY = 30
+
+# Graceful shutdown: jittered reconnect delay range sent to clients and max seconds to wait per drain step
+CHAT_DRAIN_RECONNECT_DELAY = (1, 10)
+CHAT_DRAIN_TIMEOUT = 10
+
+# Stages every message content passes through before it is saved and broadcast
+CHAT_MESSAGE_PIPELINE = [
+    'chat.content_filter.filter_stage',
+]
+
+# Banned terms lists (one per LANGUAGES entry) and how often running workers check them for changes, in seconds
+CHAT_BANNED_TERMS_FILES = [os.path.join(BASE_DIR, f'chat/banned_terms/{code}.txt') for code, _ in LANGUAGES]
+CHAT_BANNED_TERMS_RELOAD_INTERVAL = 30
+
+# Seconds a client message id is remembered, retries within the window are not saved again
+CHAT_MESSAGE_DEDUP_WINDOW = 120
+
+# Matchmaking: seconds between batch passes and (seconds waited, constraint dropped) relaxation steps
+CHAT_MATCH_INTERVAL = 1
+CHAT_MATCH_RELAXATION = [
+    (20, 'search_gender'),
+    (45, 'topic'),
+]
+# Seconds the creator of a waiting room has to connect to it, then the room leaves the waiting searchers
+# unless the creator is connected
+CHAT_MATCH_CONNECT_TIMEOUT = 60
+
+# Seconds the chats online count is cached for, every index page polls it
+CHAT_ONLINE_COUNT_TTL = 3
+
+# Room events persisters (persist_events command): events per bulk write, seconds before an unacknowledged
+# event is retried, and deliveries after which it is moved to the dead letter stream
+CHAT_EVENTS_BATCH_SIZE = 500
+CHAT_EVENTS_RETRY_AFTER = 30
+CHAT_EVENTS_MAX_DELIVERIES = 5
+
+# Websocket frames (config.server): max inbound message bytes, and permessage-deflate for outbound frames
+# of at least the threshold bytes. Window bits (8-15) and memLevel (1-9) size the zlib state every
+# connection keeps after its first compressed frame, see benchmarks/frame_compression.py
+# Send buffer is the kernel's per connection socket buffer, the server sees a client isn't reading once it's
+# full, left to autotuning it grows to megabytes before that
+CHAT_WS_MAX_MESSAGE_SIZE = 16 * 1024
+CHAT_WS_SEND_BUFFER = config('CHAT_WS_SEND_BUFFER', default=64 * 1024, cast=int)
+CHAT_WS_COMPRESSION_THRESHOLD = 512
+CHAT_WS_COMPRESSION_WINDOW_BITS = 11
+CHAT_WS_COMPRESSION_MEM_LEVEL = 4
+
+# Seconds a closed room keeps its lifecycle state, late connects and disconnects see it's over (chat.lifecycle)
+CHAT_CLOSED_ROOM_TTL = 3600
+
+# Tracing and profiling (chat.tracing): tracing always on, spans printed as slow, spans kept for the admin
+# api, and the sampling profiler's output directory, seconds between samples and max seconds per run
+CHAT_TRACING = config('CHAT_TRACING', default=False, cast=bool)
+CHAT_TRACE_SLOW_MS = 100
+CHAT_TRACE_BUFFER = 1000
+CHAT_PROFILE_DIR = BASE_DIR / 'profiles'
+CHAT_PROFILE_INTERVAL = 0.005
+CHAT_PROFILE_MAX_SECONDS = 120
+
+# Multi-process runner (runworkers command, config.supervisor): listen backlog, seconds between worker
+# status reports, seconds without a report after which a worker is restarted, min seconds between restarts
+CHAT_WORKER_BACKLOG = 2048
+CHAT_WORKER_REPORT_INTERVAL = 2
+CHAT_WORKER_HEALTH_TIMEOUT = 15
+CHAT_WORKER_RESTART_DELAY = 1
+
+# Moderation api: default and max page size of the session rooms and messages queries (chat.services.
+# moderation_service), and seconds between checks of the ban list version by every worker (chat.bans)
+CHAT_MODERATION_PAGE_SIZE = 50
+CHAT_MODERATION_MAX_PAGE_SIZE = 500
+# Days ended rooms and their messages are kept for moderation before the persisters purge them
+CHAT_MODERATION_RETENTION_DAYS = 30
+CHAT_BAN_LIST_REFRESH_INTERVAL = 5
@@ -0,0 +1,218 @@
+import gzip
+import mimetypes
+import os
+
+import brotli
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.http import http_date
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.json', '.txt', '.html', '.xml')
+
+# Preferred first; (Accept-Encoding token, variant file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE = b'public, max-age=31536000, immutable'
+REVALIDATE = b'no-cache'
+
+# Files up to this size are kept in memory after the first read
+MEMORY_CACHE_MAX_FILE_SIZE = 1024 * 1024
+
+
+def compress_file(path):
+    """Writes .gz and .br next to the file if they are smaller than it"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0)), ('.br', brotli.compress(data, quality=11))]
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+        elif os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Hashed file names plus precompressed variants written by collectstatic"""
+
+    def stored_name(self, name):
+        # Without a manifest (collectstatic not run, e.g. tests) fall back to plain names
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, *args, **kwargs):
+        yield from super().post_process(*args, **kwargs)
+        if kwargs.get('dry_run'):
+            return
+
+        names = set(self.hashed_files) | set(self.hashed_files.values())
+        for name in names:
+            if name.endswith(COMPRESSIBLE_EXTENSIONS) and self.exists(name):
+                compress_file(self.path(name))
+
+
+class StaticFilesApp:
+    """
+    Serves STATIC_URL straight from STATIC_ROOT before Django is involved.
+    Picks the precompressed variant the client accepts, marks hashed names immutable,
+    and hands the file to the server (zero-copy / path send ASGI extensions) when it can.
+    File system calls run in a thread, never on the event loop. Hashed files never change, once resolved
+    and read they are served from memory without touching the file system.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.prefix = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else '/' + settings.STATIC_URL
+        self.root = str(settings.STATIC_ROOT)
+        self.hashed_names = None
+        self.cache = {}
+        self.resolved = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(self.prefix):
+            await self.serve(scope, send)
+        else:
+            await self.app(scope, receive, send)
+
+    def get_hashed_names(self):
+        if self.hashed_names is None:
+            self.hashed_names = frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+        return self.hashed_names
+
+    def find(self, name):
+        try:
+            path = safe_join(self.root, name)
+        except (SuspiciousFileOperation, ValueError):
+            return None
+        if os.path.isfile(path):
+            return path
+        if settings.DEBUG:
+            return finders.find(name)
+        return None
+
+    def resolve(self, name, accepted):
+        """File serving name in an accepted encoding: (path, encoding or None, stat), None if there is none"""
+        path = self.find(name)
+        if path is None:
+            return None
+        encoding = None
+        if name.endswith(COMPRESSIBLE_EXTENSIONS):
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.isfile(path + suffix):
+                    path += suffix
+                    encoding = candidate
+                    break
+        return path, encoding, os.stat(path)
+
+    async def resolve_cached(self, name, accepted, immutable):
+        if not immutable:
+            return await sync_to_async(self.resolve, thread_sensitive=False)(name, accepted)
+        key = (name, frozenset(encoding for encoding, _ in ENCODINGS if encoding in accepted))
+        resolved = self.resolved.get(key)
+        if resolved is None:
+            resolved = await sync_to_async(self.resolve, thread_sensitive=False)(name, accepted)
+            if resolved is not None:
+                self.resolved[key] = resolved
+        return resolved
+
+    @staticmethod
+    def accepted_encodings(scope):
+        for key, value in scope['headers']:
+            if key == b'accept-encoding':
+                accepted = set()
+                for token in value.decode('latin-1').split(','):
+                    coding, _, params = token.strip().partition(';')
+                    if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                        accepted.add(coding.strip().lower())
+                return accepted
+        return set()
+
+    @staticmethod
+    def header(scope, name):
+        for key, value in scope['headers']:
+            if key == name:
+                return value
+        return None
+
+    def cached(self, path, stat):
+        """Contents of the file if they are in memory and current"""
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        return None
+
+    def read(self, path, stat):
+        key = (stat.st_mtime_ns, stat.st_size)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if stat.st_size <= MEMORY_CACHE_MAX_FILE_SIZE:
+            self.cache[path] = (key, data)
+        return data
+
+    async def respond(self, send, status, headers=(), body=b''):
+        await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def serve(self, scope, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, [(b'allow', b'GET, HEAD')])
+            return
+
+        name = scope['path'][len(self.prefix):]
+        if self.hashed_names is None:
+            await sync_to_async(self.get_hashed_names, thread_sensitive=False)()  # reads the manifest once
+        immutable = name in self.hashed_names
+        compressible = name.endswith(COMPRESSIBLE_EXTENSIONS)
+        resolved = await self.resolve_cached(name, self.accepted_encodings(scope) if compressible else set(), immutable)
+        if resolved is None:
+            await self.respond(send, 404, [(b'content-type', b'text/plain')], b'Not Found')
+            return
+        path, encoding, stat = resolved
+
+        content_type, _ = mimetypes.guess_type(name)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+
+        headers = [(b'content-type', content_type.encode())]
+        if compressible:
+            headers.append((b'vary', b'Accept-Encoding'))
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode()))
+
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'.encode()
+        headers += [
+            (b'etag', etag),
+            (b'last-modified', http_date(stat.st_mtime).encode()),
+            (b'cache-control', IMMUTABLE if immutable else REVALIDATE),
+        ]
+
+        if self.header(scope, b'if-none-match') == etag:
+            await self.respond(send, 304, headers)
+            return
+
+        headers.append((b'content-length', str(stat.st_size).encode()))
+        if scope['method'] == 'HEAD':
+            await self.respond(send, 200, headers)
+            return
+
+        extensions = scope.get('extensions') or {}
+        if 'http.response.zerocopysend' in extensions:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            f = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+            with f:
+                await send({'type': 'http.response.zerocopysend', 'file': f})
+        elif 'http.response.pathsend' in extensions:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            await send({'type': 'http.response.pathsend', 'path': os.path.abspath(path)})
+        else:
+            body = self.cached(path, stat)
+            if body is None:
+                body = await sync_to_async(self.read, thread_sensitive=False)(path, stat)
+            await self.respond(send, 200, headers, body)
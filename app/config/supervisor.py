@@ -0,0 +1,199 @@
+"""
+Multi-process runner: N config.server workers sharing one listening port, supervised by this process.
+
+The supervisor binds the port once and passes the socket to every worker (--fd), the kernel spreads
+accepted connections over the workers. With reuse_port each worker gets its own SO_REUSEPORT socket bound
+to the same port instead, which balances connections more evenly.
+
+Workers report their metrics over a pipe every CHAT_WORKER_REPORT_INTERVAL seconds from their event loop.
+A worker that exits is restarted, a worker that stops reporting for CHAT_WORKER_HEALTH_TIMEOUT seconds
+(blocked or hung event loop) is killed and restarted. The metrics of all workers, summed and per worker,
+are published to Redis under METRICS_KEY for the workers admin api.
+
+Room state shared by workers is already in Redis: user removal deadlines (room_removals) are run by
+whichever worker claims them, matchmaking passes are serialized by a Redis lock.
+"""
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+METRICS_KEY = 'worker_metrics'
+
+
+class Worker:
+    __slots__ = ('index', 'sock', 'process', 'status', 'buffer', 'started', 'last_report', 'metrics', 'restarts')
+
+    def __init__(self, index: int, sock: socket.socket):
+        self.index = index
+        self.sock = sock
+        self.process = None
+        self.status = None
+        self.buffer = b''
+        self.started = 0.0
+        self.last_report = 0.0
+        self.metrics = {}
+        self.restarts = 0
+
+
+class Supervisor:
+
+    def __init__(self, workers: int, host: str, port: int, application: str = 'config.asgi:application',
+                 reuse_port: bool = False, server_args: tuple = ()):
+        self.host = host
+        self.port = port
+        self.application = application
+        self.reuse_port = reuse_port
+        self.server_args = tuple(server_args)
+        self.workers = [Worker(index, None) for index in range(workers)]
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+
+    def listen(self):
+        """Binds the listening socket, one shared by all workers or one per worker with SO_REUSEPORT."""
+        shared = None if self.reuse_port else self.bind()
+        for worker in self.workers:
+            worker.sock = self.bind() if self.reuse_port else shared
+        self.port = self.workers[0].sock.getsockname()[1]
+
+    def bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if self.reuse_port and not self.port:
+            self.port = sock.getsockname()[1]  # the next workers bind the same port
+        sock.listen(settings.CHAT_WORKER_BACKLOG)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, worker: Worker):
+        read_fd, write_fd = os.pipe()
+        fd = worker.sock.fileno()
+        env = {**os.environ, 'CHAT_WORKER_ID': str(worker.index), 'CHAT_WORKER_STATUS_FD': str(write_fd)}
+        worker.process = subprocess.Popen(
+            [sys.executable, '-m', 'config.server', '--fd', str(fd), *self.server_args, self.application],
+            pass_fds=(fd, write_fd), env=env, cwd=settings.BASE_DIR,
+        )
+        os.close(write_fd)
+
+        self.close_status(worker)
+        worker.status = read_fd
+        worker.buffer = b''
+        worker.started = worker.last_report = time.monotonic()
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+        print(f'WORKER {worker.index} STARTED, PID {worker.process.pid}')
+
+    def close_status(self, worker: Worker):
+        """Stops watching the worker's status pipe and closes it"""
+        if worker.status is not None:
+            self.selector.unregister(worker.status)
+            os.close(worker.status)
+            worker.status = None
+
+    def read_reports(self, timeout: float):
+        """Reads the status lines workers wrote, waits up to timeout for the first one."""
+        for key, _ in self.selector.select(timeout):
+            worker = key.data
+            try:
+                data = os.read(worker.status, 65536)
+            except OSError:
+                data = b''
+            if not data:  # worker closed its end, exit is handled by check()
+                self.close_status(worker)  # a pipe at EOF stays readable, select would return at once forever
+                continue
+            *lines, worker.buffer = (worker.buffer + data).split(b'\n')
+            for line in lines:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    continue
+                worker.last_report = time.monotonic()
+                worker.metrics = report.get('metrics', {})
+
+    def check(self, now: float = None):
+        """Restarts workers that exited, kills workers that stopped reporting (restarted on the next check)."""
+        now = time.monotonic() if now is None else now
+        for worker in self.workers:
+            code = worker.process.poll()
+            if code is not None:
+                if now - worker.started < settings.CHAT_WORKER_RESTART_DELAY:
+                    continue  # crashing on start, don't restart it in a tight loop
+                print(f'WORKER {worker.index} (PID {worker.process.pid}) EXITED WITH {code}, RESTARTING')
+                worker.restarts += 1
+                worker.metrics = {}
+                self.spawn(worker)
+            elif now - worker.last_report > settings.CHAT_WORKER_HEALTH_TIMEOUT:
+                print(f'WORKER {worker.index} (PID {worker.process.pid}) NOT RESPONDING, KILLING')
+                worker.process.kill()
+                worker.process.wait()
+
+    def aggregate(self) -> dict:
+        now = time.monotonic()
+        total = Counter()
+        workers = {}
+        for worker in self.workers:
+            total.update(worker.metrics)
+            workers[worker.index] = {
+                'pid': worker.process.pid if worker.process else None,
+                'alive': worker.process is not None and worker.process.poll() is None,
+                'restarts': worker.restarts,
+                'last_report_seconds_ago': round(now - worker.last_report, 1),
+                'metrics': worker.metrics,
+            }
+        return {'total': dict(total), 'workers': workers}
+
+    def publish_metrics(self):
+        try:
+            get_redis_connection('default').set(
+                METRICS_KEY, json.dumps(self.aggregate()), ex=settings.CHAT_WORKER_HEALTH_TIMEOUT * 3
+            )
+        except Exception as e:
+            print(f'WORKER METRICS NOT PUBLISHED: {e}')
+
+    def request_stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        self.listen()
+        print(f'LISTENING ON {self.host}:{self.port} WITH {len(self.workers)} WORKERS')
+        for worker in self.workers:
+            self.spawn(worker)
+
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        published = 0.0
+        while not self.stopping:
+            self.read_reports(settings.CHAT_WORKER_REPORT_INTERVAL)
+            if self.stopping:
+                break
+            self.check()
+            if time.monotonic() - published >= settings.CHAT_WORKER_REPORT_INTERVAL:
+                self.publish_metrics()
+                published = time.monotonic()
+        self.stop()
+
+    def stop(self):
+        """Stops the workers with SIGTERM, so they drain their connections, and kills the ones that don't exit."""
+        print('STOPPING WORKERS')
+        running = [worker.process for worker in self.workers if worker.process and worker.process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + settings.CHAT_DRAIN_TIMEOUT * 3
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for sock in {worker.sock for worker in self.workers if worker.sock}:
+            sock.close()
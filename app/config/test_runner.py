@@ -0,0 +1,17 @@
+from django.test.runner import DiscoverRunner
+
+from config import mongo
+
+
+class TestRunner(DiscoverRunner):
+    """Points the Mongo connection at test_<MONGODB_NAME> for the run and drops it afterwards"""
+
+    def setup_databases(self, **kwargs):
+        self.mongo_db = f'test_{mongo.registered_db}'
+        mongo.register(self.mongo_db)
+        return super().setup_databases(**kwargs)
+
+    def teardown_databases(self, old_config, **kwargs):
+        if not self.keepdb:
+            mongo.get_database().client.drop_database(self.mongo_db)
+        super().teardown_databases(old_config, **kwargs)